@@ -2,10 +2,24 @@
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse
+from loguru import logger
 
-from app import db, movies
+from app import db, jobs, log, metrics, movies, profiling, tmdb, tmdb_config
+from app.config import (
+    get_api_settings,
+    get_client_settings,
+    get_job_settings,
+    get_log_settings,
+    get_settings,
+)
+
+log.configure(get_log_settings())
 
-app = FastAPI()
+api_settings = get_api_settings()
+app = FastAPI(
+    default_response_class=(ORJSONResponse if api_settings.api_orjson else JSONResponse)
+)
 
 
 # todo: remove once we have a proxy
@@ -17,14 +31,45 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if api_settings.api_metrics:
+    app.add_middleware(metrics.MetricsMiddleware)
+if api_settings.api_profiling != "off":
+    app.add_middleware(profiling.ProfilingMiddleware, settings=api_settings)
+app.add_middleware(log.RequestIdMiddleware)
 
 
 @app.on_event("startup")
 async def on_startup():
     await db.create_db_and_tables()
+    if api_settings.api_metrics:
+        metrics.instrument_engine(db.engine)
+    if api_settings.api_profiling != "off":
+        profiling.instrument_engine(db.engine)
+    client_settings = get_client_settings()
+    await tmdb.open_client(client_settings)
+    tmdb.open_search_cache(client_settings)
+    tmdb.open_rate_limiter(client_settings)
+    tmdb.open_retry_policy(client_settings)
+    await tmdb_config.start(get_settings(), tmdb.get_client())
+    await jobs.start_workers(get_job_settings())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await jobs.stop_workers()
+    await tmdb_config.stop()
+    await tmdb.close_client()
+    # write the messages still queued for the log handler
+    await logger.complete()
 
 
 app.include_router(movies.router)
+app.include_router(jobs.router)
+app.include_router(tmdb_config.router)
+if api_settings.api_metrics:
+    app.include_router(metrics.router)
+if api_settings.api_profiling != "off":
+    profiling.time_endpoints(app.routes)
 
 if __name__ == "__main__":
     import uvicorn
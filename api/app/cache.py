@@ -0,0 +1,89 @@
+"""In-process caching of upstream responses"""
+
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any
+
+
+class Cache(ABC):
+    """Interface for a response cache
+
+    Methods are async so that the same interface can be backed by a shared store
+    (e.g. redis) instead of process memory.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @abstractmethod
+    async def get(
+        self, key: Hashable, stale: bool = False, count: bool = True
+    ) -> Any | None:
+        """Return the cached value, or None if missing or expired
+
+        With stale=True expired values are returned too, if they are still stored
+        (e.g. to serve while upstream is down). With count=False the lookup isn't
+        counted in the hits and misses, e.g. for a second lookup of the same key
+        """
+
+    @abstractmethod
+    async def set(self, key: Hashable, value: Any):
+        """Store a value under key"""
+
+    @abstractmethod
+    async def clear(self):
+        """Remove all entries"""
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class TTLCache(Cache):
+    """Bounded LRU cache where each entry expires ttl seconds after it was set
+
+    Expired entries are kept (until evicted) so that they can be served stale
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # values are (expires_at, value), ordered from least to most recently used
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    async def get(
+        self, key: Hashable, stale: bool = False, count: bool = True
+    ) -> Any | None:
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            self.misses += count
+            return None
+
+        if expires_at <= time.monotonic() and not stale:
+            self.misses += count
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += count
+        return value
+
+    async def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def clear(self):
+        self._data.clear()
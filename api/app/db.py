@@ -1,10 +1,68 @@
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import event, text
+from sqlalchemy.engine import Connection, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-database_conn_str = "sqlite+aiosqlite:///database.sqlite"
-engine = create_async_engine(database_conn_str, echo=False)
+from app import search, versioning
+from app.config import DatabaseSettings, get_database_settings
+
+
+def create_engine(settings: DatabaseSettings) -> AsyncEngine:
+    """Create the engine, with a pool of connections, from the database settings"""
+    url = make_url(settings.database_url)
+    kwargs = {}
+
+    # sqlalchemy doesn't pool connections to sqlite files by default, and an in memory
+    # database is a different database for each connection so can't be pooled
+    in_memory = url.database in (None, "", ":memory:")
+    if url.get_backend_name() != "sqlite" or not in_memory:
+        kwargs = {
+            "poolclass": AsyncAdaptedQueuePool,
+            "pool_size": settings.database_pool_size,
+            "max_overflow": settings.database_max_overflow,
+            "pool_recycle": settings.database_pool_recycle,
+            "pool_pre_ping": settings.database_pool_pre_ping,
+        }
+
+    engine = create_async_engine(url, echo=settings.database_echo, **kwargs)
+
+    if url.get_backend_name() == "sqlite" and settings.database_sqlite_performance:
+        pragmas = sqlite_performance_pragmas(settings)
+        event.listen(engine.sync_engine, "connect", set_pragmas(pragmas))
+
+    return engine
+
+
+def sqlite_performance_pragmas(settings: DatabaseSettings) -> list[str]:
+    return [
+        "journal_mode=WAL",
+        f"synchronous={settings.database_sqlite_synchronous}",
+        f"mmap_size={settings.database_sqlite_mmap_size}",
+        f"cache_size={settings.database_sqlite_cache_size}",
+        f"busy_timeout={settings.database_sqlite_busy_timeout}",
+        "temp_store=MEMORY",
+    ]
+
+
+def set_pragmas(pragmas: list[str]):
+    """Listener for the connect event, which sets the pragmas on each new connection
+
+    https://docs.sqlalchemy.org/en/14/dialects/sqlite.html#foreign-key-support
+    """
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+
+    return on_connect
+
+
+engine = create_engine(get_database_settings())
 async_session_factory = sessionmaker(
     engine,
     class_=AsyncSession,  # pyright: ignore [reportGeneralTypeIssues]
@@ -12,10 +70,42 @@ async_session_factory = sessionmaker(
 )
 
 
+# (table, column, type) of the columns added to tables since they were first released,
+# which create_all doesn't add to existing tables
+ADDED_COLUMNS = [
+    ("movie", "overview", "VARCHAR"),
+    ("import_job", "owner", "VARCHAR"),
+    ("import_job", "lease_expires_at", "TIMESTAMP"),
+]
+
+
+def add_columns(conn: Connection):
+    """Add the ADDED_COLUMNS which are missing from existing tables"""
+    for table_name, column, column_type in ADDED_COLUMNS:
+        if conn.dialect.name == "postgresql":
+            conn.execute(
+                text(
+                    f"ALTER TABLE {table_name} "
+                    f"ADD COLUMN IF NOT EXISTS {column} {column_type}"
+                )
+            )
+            continue
+
+        columns = conn.execute(text(f"PRAGMA table_info({table_name})")).all()
+        if column not in {row.name for row in columns}:
+            conn.execute(
+                text(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+            )
+
+
 # todo: replace with Alembic
 async def create_db_and_tables():
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        # before the search index, which indexes movie.overview
+        await conn.run_sync(add_columns)
+        await conn.run_sync(search.create_search_index)
+        await conn.run_sync(versioning.create_version_triggers)
 
 
 async def get_session():
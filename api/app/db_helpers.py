@@ -1,7 +1,11 @@
+from collections.abc import Hashable, Iterable
+
 import sqlalchemy.exc
 from fastapi import HTTPException
 from loguru import logger
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.future import select
+from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.main import SQLModelMetaclass
 
@@ -13,22 +17,65 @@ async def get_object_or_404(session: AsyncSession, model: SQLModelMetaclass, id)
     return instance
 
 
-async def get_or_create(session: AsyncSession, model: SQLModelMetaclass, **kwargs):
-    instance = (await session.scalars(select(model).filter_by(**kwargs))).first()
-    if instance:
-        return instance
-    else:
-        instance = model(**kwargs)
-        session.add(instance)
-        logger.info("Created {}: {}", model.__name__, kwargs)
-        await session.flush()
-        return instance
+def insert(session: AsyncSession, model: SQLModelMetaclass):
+    """An insert statement for the session's database, supporting on_conflict_* clauses
+
+    Both sqlite and postgres support INSERT ... ON CONFLICT, but each dialect has its
+    own insert construct
+    """
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def get_or_create_many(
+    session: AsyncSession, model: SQLModelMetaclass, field: str, values: Iterable
+) -> dict[Hashable, SQLModel]:
+    """Get or create instances of model for each of the values of a unique field
+
+    Uses a constant number of statements no matter how many values: one SELECT ... IN
+    and, only if some are missing, one multi-row INSERT ... ON CONFLICT DO NOTHING
+    followed by a SELECT of the inserted rows
+
+    Returns a dict of {value: instance} in the order of values (without duplicates)
+    """
+    values = list(dict.fromkeys(values))
+    if not values:
+        return {}
+
+    column = getattr(model, field)
+    stmt = select(model).filter(column.in_(values))
+    instances = {getattr(i, field): i for i in await session.scalars(stmt)}
+
+    missing = [value for value in values if value not in instances]
+    if missing:
+        # on conflict in case another request inserts the same values concurrently
+        insert_stmt = (
+            insert(session, model)
+            .values([{field: value} for value in missing])
+            .on_conflict_do_nothing(index_elements=[field])
+        )
+        await session.execute(insert_stmt)
+        logger.info("Created {}: {}", model.__name__, missing)
+
+        stmt = select(model).filter(column.in_(missing))
+        instances |= {getattr(i, field): i for i in await session.scalars(stmt)}
+
+    return {value: instances[value] for value in values}
 
 
 # if you need an update_or_create:
 # https://github.com/falkben/steam-to-sqlite/blob/ea3873b9daf725e6b58af7ac70e5b8a54087886e/steam2sqlite/handler.py#L32-L48
 
 
+def is_unique_violation(exc: sqlalchemy.exc.IntegrityError) -> bool:
+    """Whether the error is from a unique constraint, rather than e.g. a check"""
+    # asyncpg's sqlstate, or sqlite's extended error code
+    return getattr(exc.orig, "sqlstate", None) == "23505" or getattr(
+        exc.orig, "sqlite_errorname", None
+    ) in ("SQLITE_CONSTRAINT_UNIQUE", "SQLITE_CONSTRAINT_PRIMARYKEY")
+
+
 async def commit(session: AsyncSession):
     """session.commit() with some exception handling"""
     try:
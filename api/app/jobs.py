@@ -0,0 +1,340 @@
+"""Background jobs importing movies from TMDB, for more tmdb_ids than fit in a request
+
+Jobs are stored in the import_job table and run by asyncio workers in this process.
+Jobs that were pending, or interrupted by a restart, are queued again on startup.
+
+A worker claims a job before running it, with a single UPDATE, so that each job runs in
+one process when there are several (e.g. uvicorn --workers). The claim is a lease which
+is renewed while the job runs: a running job is only resumed by another process once
+its lease has expired, e.g. if the process running it was killed.
+
+While the TMDB circuit breaker is open a job waits, rather than failing its tmdb_ids.
+"""
+
+import asyncio
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import APIRouter, Body, Depends, HTTPException
+from loguru import logger
+from sqlalchemy import and_, func, or_, update
+from sqlalchemy.future import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import db, tables, tmdb, tmdb_cache
+from app.config import JobSettings, Settings, get_settings
+from app.db_helpers import commit
+from app.movies import create_movies_from_tmdb_ids
+
+router = APIRouter()
+
+# the jobs claimed by this process are owned by it
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+# ids of the jobs waiting for a worker, and the workers running them (and the task
+# queueing the jobs whose lease expired), created on app startup
+queue: asyncio.Queue[int] | None = None
+workers: list[asyncio.Task] = []
+
+
+def lease_expired(now: datetime):
+    """Filter for the running jobs that no process holds"""
+    return and_(
+        tables.ImportJob.status == tables.ImportJobStatus.running,
+        or_(
+            tables.ImportJob.lease_expires_at.is_(None),
+            tables.ImportJob.lease_expires_at < now,
+        ),
+    )
+
+
+def claimable(now: datetime):
+    return or_(
+        tables.ImportJob.status == tables.ImportJobStatus.pending, lease_expired(now)
+    )
+
+
+async def queue_jobs(condition):
+    """Queue the ids of the jobs matching the condition"""
+    async with db.async_session_factory() as session:
+        stmt = (
+            select(tables.ImportJob.id).filter(condition).order_by(tables.ImportJob.id)
+        )
+        for job_id in await session.scalars(stmt):
+            queue.put_nowait(job_id)
+
+
+async def requeue_expired_jobs(settings: JobSettings):
+    """Queue the running jobs whose process stopped renewing their lease"""
+    while True:
+        await asyncio.sleep(settings.import_job_lease)
+        await queue_jobs(lease_expired(datetime.utcnow()))
+
+
+async def start_workers(settings: JobSettings):
+    """Start the workers, and queue the jobs that haven't finished"""
+    global queue, workers
+    queue = asyncio.Queue()
+
+    await queue_jobs(claimable(datetime.utcnow()))
+
+    workers = [
+        asyncio.create_task(worker(settings))
+        for _ in range(settings.import_job_workers)
+    ]
+    workers.append(asyncio.create_task(requeue_expired_jobs(settings)))
+
+
+async def stop_workers():
+    """Cancel the workers, a running job is resumed after the next startup
+
+    The leases of the jobs that were running are released, so that they can be resumed
+    straight away
+    """
+    global workers
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers = []
+
+    async with db.async_session_factory() as session:
+        await session.execute(
+            update(tables.ImportJob)
+            .where(
+                tables.ImportJob.owner == OWNER,
+                tables.ImportJob.status == tables.ImportJobStatus.running,
+            )
+            .values(lease_expires_at=None)
+        )
+        await commit(session)
+
+
+async def claim_job(session: AsyncSession, job_id: int, lease: float) -> bool:
+    """Take the job for this process, if it's pending or its lease expired
+
+    A single UPDATE, so only one of the processes trying to claim a job succeeds
+    """
+    now = datetime.utcnow()
+    result = await session.execute(
+        update(tables.ImportJob)
+        .where(tables.ImportJob.id == job_id, claimable(now))
+        .values(
+            status=tables.ImportJobStatus.running,
+            owner=OWNER,
+            lease_expires_at=now + timedelta(seconds=lease),
+            started_at=func.coalesce(tables.ImportJob.started_at, now),
+        )
+    )
+    await commit(session)
+    return result.rowcount == 1
+
+
+async def renew_lease(job_id: int, lease: float) -> bool:
+    """Extend the lease of a job run by this process, False if it lost the lease"""
+    async with db.async_session_factory() as session:
+        result = await session.execute(
+            update(tables.ImportJob)
+            .where(
+                tables.ImportJob.id == job_id,
+                tables.ImportJob.owner == OWNER,
+                tables.ImportJob.status == tables.ImportJobStatus.running,
+            )
+            .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=lease))
+        )
+        await commit(session)
+        return result.rowcount == 1
+
+
+async def keep_lease(job_id: int, lease: float):
+    """Renew the lease of the job until cancelled, returning if it's lost"""
+    while True:
+        await asyncio.sleep(lease / 3)
+        if not await renew_lease(job_id, lease):
+            logger.warning("Lost the lease of import job {}, stopping it", job_id)
+            return
+
+
+async def worker(settings: JobSettings):
+    while True:
+        job_id = await queue.get()
+        try:
+            await run_job(job_id, get_settings(), tmdb.get_client(), settings)
+        except Exception as exc:
+            logger.exception("Import job {} failed", job_id)
+            try:
+                await mark_failed(job_id, exc)
+            except Exception:
+                # the worker carries on with the next job
+                logger.exception("Could not mark import job {} failed", job_id)
+        finally:
+            queue.task_done()
+
+
+async def mark_failed(job_id: int, exc: Exception):
+    async with db.async_session_factory() as session:
+        job = await session.get(tables.ImportJob, job_id)
+        # unless it was deleted, or another process has taken the job over
+        if job is not None and job.owner == OWNER:
+            job.status = tables.ImportJobStatus.failed
+            job.detail = repr(exc)
+            job.finished_at = datetime.utcnow()
+            await commit(session)
+
+
+async def wait_for_tmdb(job_id: int):
+    """Wait while the TMDB circuit is open, until it lets a trial request through"""
+    breaker = tmdb.circuit_breaker
+    while breaker.state == "open":
+        delay = breaker.opened_at + breaker.reset_timeout - time.monotonic()
+        logger.info("TMDB is unavailable, import job {} waits {:.1f}s", job_id, delay)
+        await asyncio.sleep(max(delay, 0.1))
+
+
+async def run_job(
+    job_id: int,
+    settings: Settings,
+    client: httpx.AsyncClient,
+    job_settings: JobSettings,
+):
+    """Claim the job and create its movies a batch at a time, saving its progress after
+    each
+
+    The job is updated in its own session, as creating movies rolls back its session
+    when a movie conflicts
+    """
+    batch_size = job_settings.import_job_batch_size
+    job_session = db.async_session_factory()
+    session = db.async_session_factory()
+    async with job_session, session:
+        if not await claim_job(job_session, job_id, job_settings.import_job_lease):
+            logger.info("Import job {} is finished or run by another process", job_id)
+            return
+
+        job = await job_session.get(tables.ImportJob, job_id)
+        if job.processed:
+            logger.info("Resuming import job {} at {}", job_id, job.processed)
+
+        heartbeat = asyncio.create_task(
+            keep_lease(job_id, job_settings.import_job_lease)
+        )
+        try:
+            while job.processed < len(job.tmdb_ids):
+                await wait_for_tmdb(job_id)
+                batch = job.tmdb_ids[job.processed : job.processed + batch_size]
+                outcomes, to_refresh = await create_movies_from_tmdb_ids(
+                    batch, settings, session, client
+                )
+                if to_refresh:
+                    await tmdb_cache.refresh_entries(to_refresh, settings, client)
+
+                # the job may have been claimed by another process
+                if heartbeat.done():
+                    return
+
+                if tmdb.circuit_breaker.state != "closed":
+                    # TMDB went down during the batch: keep the tmdb_ids before the
+                    # first that failed, the rest are retried once it's back
+                    for i, tmdb_id in enumerate(batch):
+                        status = outcomes[tmdb_id].status
+                        if status == tables.TMDBMovieStatus.upstream_error:
+                            batch = batch[:i]
+                            break
+
+                # a new dict, so that the change to the JSON column is detected
+                errors = dict(job.errors)
+                for tmdb_id in dict.fromkeys(batch):
+                    outcome = outcomes[tmdb_id]
+                    if outcome.status == tables.TMDBMovieStatus.created:
+                        job.created += 1
+                    elif outcome.status == tables.TMDBMovieStatus.existing:
+                        job.existing += 1
+                    else:
+                        errors[str(tmdb_id)] = {
+                            "status": outcome.status,
+                            "detail": outcome.detail,
+                        }
+                job.errors = errors
+                job.processed += len(batch)
+                await commit(job_session)
+        finally:
+            heartbeat.cancel()
+
+        job.status = tables.ImportJobStatus.done
+        job.finished_at = datetime.utcnow()
+        job.lease_expires_at = None
+        await commit(job_session)
+        logger.info(
+            "Import job {} done, created {} movies, {} failed",
+            job_id,
+            job.created,
+            len(job.errors),
+        )
+
+
+def job_read(job: tables.ImportJob) -> tables.ImportJobRead:
+    total = len(job.tmdb_ids)
+    throughput = None
+    if job.started_at is not None:
+        elapsed = (
+            (job.finished_at or datetime.utcnow()) - job.started_at
+        ).total_seconds()
+        if elapsed > 0:
+            throughput = job.processed / elapsed
+
+    return tables.ImportJobRead(
+        id=job.id,
+        status=job.status,
+        total=total,
+        processed=job.processed,
+        created=job.created,
+        existing=job.existing,
+        failed=len(job.errors),
+        progress=job.processed / total if total else 1,
+        throughput=throughput,
+        errors=[
+            tables.ImportJobError(tmdb_id=tmdb_id, **error)
+            for tmdb_id, error in job.errors.items()
+        ],
+        detail=job.detail,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+    )
+
+
+@router.post("/jobs/tmdb_movie/", response_model=tables.ImportJobRead, status_code=202)
+async def create_import_job(
+    tmdb_ids: list[int] = Body(
+        ..., embed=True, min_items=1, description="List of tmdb movie ids to create"
+    ),
+    session: AsyncSession = Depends(db.get_session),
+) -> tables.ImportJobRead:
+    """Import movies by tmdb id in the background, for lists too large for a request
+
+    Returns the job immediately, poll GET /jobs/{job_id} for its progress
+    """
+    if queue is None:
+        raise HTTPException(503, "Import jobs are not running")
+
+    job = tables.ImportJob(tmdb_ids=tmdb_ids)
+    session.add(job)
+    await commit(session)
+    await session.refresh(job)
+    queue.put_nowait(job.id)
+
+    logger.info("Queued import job {} of {} tmdb_ids", job.id, len(tmdb_ids))
+    return job_read(job)
+
+
+@router.get("/jobs/{job_id}", response_model=tables.ImportJobRead)
+async def read_import_job(
+    job_id: int, session: AsyncSession = Depends(db.get_session)
+) -> tables.ImportJobRead:
+    # the job is updated by a worker in another session, load its current state
+    job = await session.get(tables.ImportJob, job_id, populate_existing=True)
+    if not job:
+        raise HTTPException(status_code=404, detail="ImportJob not found")
+    return job_read(job)
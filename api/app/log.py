@@ -0,0 +1,114 @@
+"""Logging: a single loguru handler, configured by LogSettings
+
+Messages are written to stderr by a background thread (enqueue), so the event loop
+doesn't wait on it, as text or as JSON lines (log_json). Each record has the id of the
+request it was logged in (extra.request_id, see RequestIdMiddleware), and INFO (and
+lower) records can be sampled with log_info_sample_rate. WARNING and above are kept.
+
+Secrets aren't scrubbed from every message: log TMDB urls and requests through
+redact_url and redact_request, which hide the api_key query parameter.
+
+Log expensive arguments lazily, so they are only built if the record is logged:
+logger.opt(lazy=True).info("Created movie: {}", lambda: movie.dict())
+"""
+
+import random
+import re
+import sys
+import uuid
+from typing import Any, TextIO
+
+import httpx
+from loguru import logger
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import LogSettings
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
+    "<level>{level: <8}</level> | "
+    "<dim>{extra[request_id]}</dim> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+REDACTED = "xxxxxx"
+# query parameters that are never logged
+SECRET_PARAMS = ["api_key"]
+REQUEST_ID_HEADER = "X-Request-ID"
+# ids sent by clients that are logged as is, others are replaced
+REQUEST_ID_PATTERN = re.compile(r"[\w.-]{1,128}")
+
+
+def redact_url(url: httpx.URL | str) -> str:
+    url = httpx.URL(url)
+    for param in SECRET_PARAMS:
+        if param in url.params:
+            url = url.copy_set_param(param, REDACTED)
+    return str(url)
+
+
+def redact_request(request: httpx.Request) -> str:
+    return f"{request.method} {redact_url(request.url)}"
+
+
+def sampling_filter(info_sample_rate: float):
+    """Keep a fraction of the INFO (and lower) records, and all others"""
+    info = logger.level("INFO").no
+
+    def keep(record) -> bool:
+        return record["level"].no > info or random.random() < info_sample_rate
+
+    return keep
+
+
+def handler(settings: LogSettings, sink: TextIO = sys.stderr) -> dict[str, Any]:
+    """The loguru handler for the settings"""
+    config: dict[str, Any] = {
+        "sink": sink,
+        "level": settings.log_level,
+        "enqueue": settings.log_enqueue,
+        "serialize": settings.log_json,
+        # tracebacks without the values of variables, which can include secrets
+        "backtrace": False,
+        "diagnose": False,
+    }
+    if not settings.log_json:
+        config["format"] = TEXT_FORMAT
+    if settings.log_info_sample_rate < 1:
+        config["filter"] = sampling_filter(settings.log_info_sample_rate)
+    return config
+
+
+def configure(settings: LogSettings):
+    """Replace loguru's handlers with ours"""
+    logger.configure(handlers=[handler(settings)], extra={"request_id": "-"})
+
+
+class RequestIdMiddleware:
+    """Binds an id to the records logged while handling each request
+
+    The id is taken from the request's X-Request-ID header (e.g. set by a proxy), or
+    generated if there isn't a valid one, and is returned in the response's
+    X-Request-ID header
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get(REQUEST_ID_HEADER, "")
+        if not REQUEST_ID_PATTERN.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)[REQUEST_ID_HEADER] = request_id
+            await send(message)
+
+        with logger.contextualize(request_id=request_id):
+            await self.app(scope, receive, send_wrapper)
@@ -0,0 +1,301 @@
+"""Prometheus metrics, served at /metrics
+
+Requests are timed by MetricsMiddleware, per route name rather than path so that ids
+don't each make a new series, database queries by SQLAlchemy event hooks, and TMDB
+requests in tmdb_get. The counters the caches, rate limiter and circuit breaker already
+keep are read by collectors when /metrics is requested, so they cost nothing until then.
+
+Implements the parts of the text exposition format we need, instead of depending on
+prometheus_client: https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+
+import bisect
+import math
+import time
+from collections.abc import Callable, Iterator
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# the charset is added by the response
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+# queries per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+router = APIRouter()
+
+# in the order they're rendered
+registry: list["Metric"] = []
+# called before rendering, to set the metrics read from other objects' stats
+collectors: list[Callable[[], None]] = []
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\""),
+        )
+        for name, value in labels.items()
+    )
+    return "{" + pairs + "}"
+
+
+class Metric:
+    """A metric and its value for each combination of label values"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple[str, ...], float] = {}
+        registry.append(self)
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for labels, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, labels)), value
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        lines += [
+            f"{name}{format_labels(labels)} {format_value(value)}"
+            for name, labels, value in self.samples()
+        ]
+        return "\n".join(lines)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram(Metric):
+    """Counts of observations in buckets of upper bounds, and their sum
+
+    Counts are kept per bucket and made cumulative when rendered
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: a count for each bucket, then +Inf, then the sum
+        self.observations: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self.observations.get(labels)
+        if counts is None:
+            counts = self.observations[labels] = [0] * (len(self.buckets) + 2)
+        # the first bucket whose upper bound is >= value
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterator[tuple[str, dict[str, str], float]]:
+        for labels, counts in self.observations.items():
+            label_dict = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                yield f"{self.name}_bucket", label_dict | {
+                    "le": format_value(bound)
+                }, cumulative
+            yield f"{self.name}_sum", label_dict, counts[-1]
+            yield f"{self.name}_count", label_dict, cumulative
+
+
+http_requests = Counter(
+    "http_requests_total", "Requests by route", ("route", "method", "status")
+)
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time until the response was sent, by route",
+    ("route", "method"),
+)
+http_request_db_queries = Histogram(
+    "http_request_db_queries",
+    "Database queries per request, by route",
+    ("route",),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+http_request_db_duration = Histogram(
+    "http_request_db_duration_seconds",
+    "Time spent in database queries per request, by route",
+    ("route",),
+    buckets=DB_BUCKETS,
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Database queries, including those outside of requests",
+    buckets=DB_BUCKETS,
+)
+tmdb_requests = Counter(
+    "tmdb_requests_total",
+    "Requests to TMDB (each attempt) by endpoint and status, 'error' if no response",
+    ("endpoint", "status"),
+)
+tmdb_request_duration = Histogram(
+    "tmdb_request_duration_seconds", "Requests to TMDB by endpoint", ("endpoint",)
+)
+tmdb_rate_limit_wait = Histogram(
+    "tmdb_rate_limit_wait_seconds",
+    "Time requests to TMDB waited for the rate limiter",
+    buckets=(0, *DEFAULT_BUCKETS),
+)
+cache_hits = Counter("cache_hits_total", "Cache hits", ("cache",))
+cache_misses = Counter("cache_misses_total", "Cache misses", ("cache",))
+cache_evictions = Counter("cache_evictions_total", "Cache evictions", ("cache",))
+tmdb_coalesced_requests = Counter(
+    "tmdb_coalesced_requests_total",
+    "Requests to TMDB that waited on an identical request in flight",
+)
+tmdb_retries = Counter("tmdb_retries_total", "Requests to TMDB that were retried")
+tmdb_rate_limit_rate = Gauge(
+    "tmdb_rate_limit_rate", "Requests per second currently allowed to TMDB"
+)
+tmdb_rate_limit_tokens = Gauge(
+    "tmdb_rate_limit_tokens", "Requests to TMDB the rate limiter allows without waiting"
+)
+tmdb_rate_limit_waiting = Gauge(
+    "tmdb_rate_limit_waiting", "Requests to TMDB waiting for the rate limiter"
+)
+tmdb_rate_limit_throttled = Counter(
+    "tmdb_rate_limit_throttled_total", "429 responses from TMDB"
+)
+tmdb_circuit_state = Gauge(
+    "tmdb_circuit_state", "1 for the current state of the TMDB circuit", ("state",)
+)
+tmdb_circuit_rejected = Counter(
+    "tmdb_circuit_rejected_total", "Requests to TMDB not made as the circuit was open"
+)
+
+
+def render() -> str:
+    for collect in collectors:
+        collect()
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+@router.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+
+@dataclass
+class QueryStats:
+    count: int = 0
+    duration: float = 0.0
+
+
+# the database queries of the current request, see MetricsMiddleware
+request_queries: ContextVar[QueryStats | None] = ContextVar(
+    "request_queries", default=None
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - context._metrics_start
+    db_query_duration.observe(duration)
+    stats = request_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += duration
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Time the engine's queries, once even if the app is started again"""
+    sync_engine = engine.sync_engine
+    if not event.contains(sync_engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """Records the requests, their latency, and their database queries
+
+    A plain ASGI middleware (not BaseHTTPMiddleware) to keep the overhead low. The
+    latency is up to the end of the response body, not including background tasks
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        queries = QueryStats()
+        token = request_queries.set(queries)
+        status = 500
+        recorded = False
+
+        def record():
+            nonlocal recorded
+            recorded = True
+            # set on the scope by the router once a route matched
+            route = getattr(scope.get("route"), "name", "unmatched")
+            method = scope["method"]
+            http_requests.inc(route, method, str(status))
+            http_request_duration.observe(time.perf_counter() - start, route, method)
+            http_request_db_queries.observe(queries.count, route)
+            http_request_db_duration.observe(queries.duration, route)
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                record()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_queries.reset(token)
+            if not recorded:
+                record()
@@ -1,17 +1,69 @@
-import asyncio
-
-from fastapi import APIRouter, Body, Depends, Query
+import base64
+import csv
+import io
+import json
+import random
+from collections.abc import AsyncIterator
+from datetime import date
+from enum import Enum
+
+import httpx
+import sqlalchemy.exc
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Body,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from loguru import logger
+from sqlalchemy import func, insert, tuple_
 from sqlalchemy.future import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from app import db, tables
-from app.config import Settings, get_settings
-from app.db_helpers import commit, get_object_or_404, get_or_create
-from app.tmdb import TMDBMovieResult, TMDBSearchResult, get_movie_data, tmdb_search
+from app import db, search, serializers, tables, tmdb_cache, versioning
+from app.cache import Cache
+from app.config import ApiSettings, Settings, get_api_settings, get_settings
+from app.db_helpers import (
+    commit,
+    get_object_or_404,
+    get_or_create_many,
+    is_unique_violation,
+)
+from app.tmdb import (
+    TMDBMovieResult,
+    TMDBSearchResult,
+    get_client,
+    get_search_cache,
+    parse_movie_data,
+    search_cache_key,
+    tmdb_search,
+)
 
 router = APIRouter()
 
+# default and maximum number of movies returned per page by list_movies
+MOVIES_PAGE_LIMIT = 50
+MOVIES_PAGE_MAX_LIMIT = 200
+# release years accepted by the year filter, the following year must be a valid date
+MIN_YEAR = tables.RELEASE_DATE_CONSTR.year
+MAX_YEAR = date.max.year - 1
+# maximum number of movies drawn at once by draw_movies
+RANDOM_MAX_N = 20
+# default and maximum number of movies returned by search_local_movies
+MOVIES_SEARCH_LIMIT = 20
+MOVIES_SEARCH_MAX_LIMIT = 100
+# number of movies fetched from the database at a time by export_movies
+EXPORT_BATCH_SIZE = 500
+# number of movies inserted per transaction by import_movies, and errors reported
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_BATCH_SIZE = 5000
+IMPORT_MAX_ERRORS = 100
+
 
 @router.get("/search_movies/", response_model=list[TMDBSearchResult])
 async def search_movies(
@@ -19,6 +71,8 @@ async def search_movies(
     year: int | None = Query(None),
     page: int = 1,
     settings: Settings = Depends(get_settings),
+    client: httpx.AsyncClient = Depends(get_client),
+    search_cache: Cache = Depends(get_search_cache),
 ):
     params = {
         "api_key": settings.tmdb_api_key,
@@ -29,49 +83,130 @@ async def search_movies(
     if year is not None:
         params["year"] = year
 
-    return await tmdb_search(params, settings.tmdb_api_url)
-
-
-async def create_movie_from_tmdb(
-    tmdb_movie_result: tuple[TMDBMovieResult, str | None, list[str]],
-    session: AsyncSession,
-) -> tables.Movie:
-    movie_data, rating, genres = tmdb_movie_result
-
-    # create movie instance from tmdb response data
-    db_movie = tables.Movie(rating=rating, **movie_data.dict())
+    # identical searches are served from the cache, without calling TMDB
+    cache_key = search_cache_key(params)
+    results = await search_cache.get(cache_key)
+    if results is None:
+        try:
+            results = await tmdb_search(params, settings.tmdb_api_url, client)
+        except HTTPException as exc:
+            # when TMDB is down, serve an expired result if we still have it. The
+            # search was already counted as a miss
+            results = await search_cache.get(cache_key, stale=True, count=False)
+            if exc.status_code < 500 or results is None:
+                raise
+            logger.warning("Serving stale search results, TMDB: {}", exc.detail)
+        else:
+            await search_cache.set(cache_key, results)
+
+    return results
+
+
+async def insert_movies(session: AsyncSession, movies: list[tuple[dict, list[str]]]):
+    """Insert movies (as dicts of column values) and their genres
+
+    Uses a constant number of executemany statements, no matter how many movies.
+    Doesn't commit, and raises IntegrityError if a movie already exists.
+    """
+    if not movies:
+        return
+
+    db_genres = await get_or_create_many(
+        session, tables.Genre, "name", (g for _, genres in movies for g in genres)
+    )
+
+    await session.execute(insert(tables.Movie), [row for row, _ in movies])
+
+    # movies are unique on release_date and title
+    keys = [(row["release_date"], row["title"]) for row, _ in movies]
+    stmt = select(
+        tables.Movie.release_date, tables.Movie.title, tables.Movie.id
+    ).filter(tuple_(tables.Movie.release_date, tables.Movie.title).in_(keys))
+    movie_ids = {
+        (release_date, title): movie_id
+        for release_date, title, movie_id in await session.execute(stmt)
+    }
 
-    # adding genres to movie
-    db_genres = [
-        await get_or_create(session, tables.Genre, name=genre) for genre in genres
+    links = [
+        {"movie_id": movie_ids[key], "genre_id": db_genres[genre].id}
+        for key, (_, genres) in zip(keys, movies)
+        for genre in dict.fromkeys(genres)
     ]
+    if links:
+        await session.execute(insert(tables.GenreMovieLink), links)
 
-    db_movie.genres = db_genres
 
-    session.add(db_movie)
-    await commit(session)
-    await session.refresh(db_movie)
-
-    logger.info("Created movie: {}", db_movie.dict())
-
-    return db_movie
+async def create_movies_from_tmdb(
+    tmdb_movie_results: dict[int, tuple[TMDBMovieResult, str | None, list[str]]],
+    session: AsyncSession,
+) -> dict[int, tables.TMDBMovieOutcome]:
+    """Create the movies and their genre links in a single transaction
 
+    Uses executemany inserts, so the number of statements doesn't grow with the number
+    of movies. If the bulk insert fails (e.g. a movie conflicts with one already in the
+    database) we fall back to creating the movies one at a time, so that only the
+    movies that caused it fail.
 
-@router.post("/tmdb_movie/", response_model=dict[str, tables.MovieRead])
-async def create_movie_from_tmdb_id_endpoint(
-    tmdb_ids: list[int] = Body(
-        [], embed=True, description="List of tmdb movie ids to create"
-    ),
-    settings: Settings = Depends(get_settings),
-    session: AsyncSession = Depends(db.get_session),
-) -> dict[int, tables.Movie]:
-    """Create Movie by passing in tmdb id
+    Returns a dict of {tmdb_id: outcome} for the movies that couldn't be created
+    """
+    if not tmdb_movie_results:
+        return {}
 
-    If movie already exists, it doesn't create and returns data for that tmdb_id
+    movies = {
+        tmdb_id: ({"rating": rating, **movie_data.dict()}, genres)
+        for tmdb_id, (movie_data, rating, genres) in tmdb_movie_results.items()
+    }
 
-    Accepts a list of tmdb_ids
+    try:
+        await insert_movies(session, list(movies.values()))
+    except sqlalchemy.exc.IntegrityError as exc:
+        logger.warning("Bulk insert of movies failed, creating serially: {}", exc)
+        await session.rollback()
+    else:
+        await commit(session)
+        for movie_row, _ in movies.values():
+            log_created_movie(movie_row)
+        return {}
+
+    failed = {}
+    for tmdb_id, movie in movies.items():
+        try:
+            await insert_movies(session, [movie])
+            await session.commit()
+        except sqlalchemy.exc.StatementError as exc:
+            await session.rollback()
+            if isinstance(exc, sqlalchemy.exc.IntegrityError) and is_unique_violation(
+                exc
+            ):
+                failed[tmdb_id] = tables.TMDBMovieOutcome(
+                    status=tables.TMDBMovieStatus.conflict,
+                    detail="A movie with the same title and release date already exists",
+                )
+            else:
+                logger.error("Error creating movie for tmdb_id {}: {}", tmdb_id, exc)
+                failed[tmdb_id] = tables.TMDBMovieOutcome(
+                    status=tables.TMDBMovieStatus.error,
+                    detail=f"Database error: {exc.orig}",
+                )
+        else:
+            log_created_movie(movie[0])
+    return failed
+
+
+def log_created_movie(movie_row: dict):
+    logger.info("Created movie: {} ({})", movie_row["title"], movie_row["release_date"])
+
+
+async def create_movies_from_tmdb_ids(
+    tmdb_ids: list[int],
+    settings: Settings,
+    session: AsyncSession,
+    client: httpx.AsyncClient,
+) -> tuple[dict[int, tables.TMDBMovieOutcome], set[int]]:
+    """Create the movies for the tmdb_ids that we don't already have
 
-    Returns a dict of {tmdb_id: MovieData}
+    Returns a dict of {tmdb_id: outcome} in the order of tmdb_ids, and the set of
+    tmdb_ids whose tmdb_cache entries should be refreshed (see tmdb_cache.get_payloads)
     """
 
     # Was initially tempted to group all the work for each movie in a coroutine,
@@ -83,33 +218,90 @@ async def create_movie_from_tmdb_id_endpoint(
     # https://github.com/sqlalchemy/sqlalchemy/discussions/8554#discussioncomment-3700871
 
     tmdb_ids_uniq = set(tmdb_ids)
+    Status = tables.TMDBMovieStatus
+    outcomes: dict[int, tables.TMDBMovieOutcome] = {}
 
-    # get movies that have matching tmdb id's from our database
-    stmt = select(tables.Movie).filter(tables.Movie.tmdb_id.in_(tmdb_ids_uniq))
-    existing_movies: list[tables.Movie] = (await session.scalars(stmt)).unique().all()
+    # get the tmdb id's that we already have in our database
+    stmt = select(tables.Movie.tmdb_id).filter(tables.Movie.tmdb_id.in_(tmdb_ids_uniq))
+    existing_tmdb_ids = set(await session.scalars(stmt))
 
     # determine which tmdb's remain to be created
-    tmdb_ids_to_create = tmdb_ids_uniq - set([m.tmdb_id for m in existing_movies])
+    tmdb_ids_to_create = tmdb_ids_uniq - existing_tmdb_ids
+
+    # get the tmdb data for the tmdb_ids_to_create, from our tmdb_cache if we have it
+    payloads, errors, to_refresh = await tmdb_cache.get_payloads(
+        session, tmdb_ids_to_create, settings, client
+    )
+    for tmdb_id, exc in errors.items():
+        if exc.status_code == 404:
+            outcome = tables.TMDBMovieOutcome(
+                status=Status.not_found, detail="Movie not found on TMDB"
+            )
+        else:
+            outcome = tables.TMDBMovieOutcome(
+                status=Status.upstream_error, detail=exc.detail
+            )
+        outcomes[tmdb_id] = outcome
+
+    tmdb_movie_results = {}
+    for tmdb_id, payload in payloads.items():
+        try:
+            tmdb_movie_results[tmdb_id] = parse_movie_data(payload)
+        except HTTPException:
+            outcomes[tmdb_id] = tables.TMDBMovieOutcome(
+                status=Status.upstream_error, detail="Invalid movie data from TMDB"
+            )
+
+    # create the entries in the database, in one transaction
+    failed = await create_movies_from_tmdb(tmdb_movie_results, session)
+    outcomes |= failed
+    conflicts = {
+        tmdb_id
+        for tmdb_id, outcome in failed.items()
+        if outcome.status == Status.conflict
+    }
 
-    # get the tmdb data for the tmdb_ids_to_create
-    coros = [
-        get_movie_data(tmdb_id, settings.tmdb_api_url, settings.tmdb_api_key)
-        for tmdb_id in tmdb_ids_to_create
-    ]
-    tmdb_movie_results = await asyncio.gather(*coros)
+    # a single query to load the existing and created movies
+    stmt = select(tables.Movie).filter(tables.Movie.tmdb_id.in_(tmdb_ids_uniq))
+    for movie in await session.scalars(stmt):
+        # a conflict on the movie's own tmdb_id was another request creating it
+        if movie.tmdb_id in existing_tmdb_ids or movie.tmdb_id in conflicts:
+            status = Status.existing
+        else:
+            status = Status.created
+        outcomes[movie.tmdb_id] = tables.TMDBMovieOutcome(status=status, movie=movie)
 
-    # create the entries in the database, serially
-    db_movies = [
-        await create_movie_from_tmdb(tmdb_movie_result, session)
-        for tmdb_movie_result in tmdb_movie_results
-    ]
+    return {tmdb_id: outcomes[tmdb_id] for tmdb_id in tmdb_ids}, to_refresh
 
-    requested_movies = existing_movies + db_movies
-    db_tmdb_ids = [m.tmdb_id for m in requested_movies]
 
-    return {
-        tmdb_id: requested_movies[db_tmdb_ids.index(tmdb_id)] for tmdb_id in tmdb_ids
-    }
+@router.post("/tmdb_movie/", response_model=dict[str, tables.TMDBMovieOutcome])
+async def create_movie_from_tmdb_id_endpoint(
+    background_tasks: BackgroundTasks,
+    tmdb_ids: list[int] = Body(
+        [], embed=True, description="List of tmdb movie ids to create"
+    ),
+    settings: Settings = Depends(get_settings),
+    session: AsyncSession = Depends(db.get_session),
+    client: httpx.AsyncClient = Depends(get_client),
+) -> dict[int, tables.TMDBMovieOutcome]:
+    """Create Movie by passing in tmdb id
+
+    If movie already exists, it doesn't create and returns data for that tmdb_id
+
+    Accepts a list of tmdb_ids, for large imports see POST /jobs/tmdb_movie/
+
+    Returns a dict of {tmdb_id: outcome}, with a status for each tmdb_id (created,
+    existing, not_found, upstream_error or conflict). Movies that could be created are,
+    even if others fail, so a retry only needs to send the tmdb_ids that failed.
+    """
+    outcomes, to_refresh = await create_movies_from_tmdb_ids(
+        tmdb_ids, settings, session, client
+    )
+    if to_refresh:
+        background_tasks.add_task(
+            tmdb_cache.refresh_entries, to_refresh, settings, client
+        )
+    return outcomes
 
 
 # todo: admin only?
@@ -127,33 +319,478 @@ async def create_movie(
     db_movie = tables.Movie.from_orm(movie)
 
     # adding genres to movie
-    db_genres = []
-    for genre in genres:
-        db_genres.append(await get_or_create(session, tables.Genre, name=genre))
-    db_movie.genres = db_genres
+    db_genres = await get_or_create_many(session, tables.Genre, "name", genres)
+    db_movie.genres = list(db_genres.values())
 
     session.add(db_movie)
     await commit(session)
     await session.refresh(db_movie)
 
-    logger.info("Created movie: {}", db_movie.dict())
+    logger.opt(lazy=True).info("Created movie: {}", lambda: db_movie.dict())
 
     return db_movie
 
 
-@router.get("/movies/", response_model=list[tables.MovieRead])
+class MovieSort(str, Enum):
+    release_date = "release_date"
+    title = "title"
+
+
+def encode_cursor(sort: MovieSort, movie: tables.Movie) -> str:
+    """Opaque cursor of the sort value and id of the last movie in a page"""
+    value = getattr(movie, sort.value)
+    if isinstance(value, date):
+        value = value.isoformat()
+    data = json.dumps([sort.value, value, movie.id]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(sort: MovieSort, cursor: str) -> tuple[date | str, int]:
+    try:
+        cursor_sort, value, movie_id = json.loads(base64.urlsafe_b64decode(cursor))
+        if cursor_sort != sort.value or not isinstance(movie_id, int):
+            raise ValueError("cursor is for a different sort")
+        if sort == MovieSort.release_date:
+            value = date.fromisoformat(value)
+        elif not isinstance(value, str):
+            raise ValueError("title is not a string")
+    except (ValueError, TypeError) as exc:
+        logger.info("Invalid cursor {}: {}", cursor, exc)
+        raise HTTPException(400, "Invalid cursor")
+    return value, movie_id
+
+
+def movie_filters(
+    genre: str | None = None,
+    rating: str | None = None,
+    min_runtime: int | None = None,
+    max_runtime: int | None = None,
+    year: int | None = None,
+) -> list:
+    """Filter clauses for the movie query params shared by list_movies and draw_movies"""
+    filters = []
+    if genre is not None:
+        filters.append(tables.Movie.genres.any(tables.Genre.name == genre))
+    if rating is not None:
+        filters.append(tables.Movie.rating == rating)
+    if min_runtime is not None:
+        filters.append(tables.Movie.runtime >= min_runtime)
+    if max_runtime is not None:
+        filters.append(tables.Movie.runtime <= max_runtime)
+    if year is not None:
+        # a range, rather than extracting the year, so the release_date index is used
+        filters.extend(
+            [
+                tables.Movie.release_date >= date(year, 1, 1),
+                tables.Movie.release_date < date(year + 1, 1, 1),
+            ]
+        )
+    return filters
+
+
+@router.get("/movies/", response_model=tables.MoviesPage)
 async def list_movies(
+    request: Request,
+    response: Response,
+    sort: MovieSort = MovieSort.release_date,
+    desc: bool = False,
+    cursor: str | None = Query(None, description="next_cursor from the previous page"),
+    limit: int = Query(MOVIES_PAGE_LIMIT, ge=1, le=MOVIES_PAGE_MAX_LIMIT),
+    genre: str | None = None,
+    rating: str | None = Query(None, description="MPAA rating"),
+    min_runtime: int | None = None,
+    max_runtime: int | None = None,
+    year: int
+    | None = Query(None, ge=MIN_YEAR, le=MAX_YEAR, description="Release year"),
+    session: AsyncSession = Depends(db.get_session),
+    api_settings: ApiSettings = Depends(get_api_settings),
+) -> dict | Response:
+    """List movies, paginated by a cursor
+
+    Movies are ordered by the sort column and then id, and each page continues after
+    the last movie of the previous one (keyset pagination)
+
+    Responses have an ETag and Last-Modified from the version of the whole catalog,
+    which is checked before querying the movies
+    """
+    catalog_version = await versioning.get_catalog_version(session)
+    etag = versioning.catalog_etag(catalog_version, request.url.query)
+    headers = versioning.cache_headers(etag, catalog_version.modified_at)
+    if versioning.not_modified(request, etag, catalog_version.modified_at):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    sort_column = getattr(tables.Movie, sort.value)
+    stmt = select(tables.Movie).filter(
+        *movie_filters(genre, rating, min_runtime, max_runtime, year)
+    )
+
+    keyset = tuple_(sort_column, tables.Movie.id)
+    if cursor:
+        value, movie_id = decode_cursor(sort, cursor)
+        after = tuple_(value, movie_id)
+        stmt = stmt.filter(keyset < after if desc else keyset > after)
+
+    if desc:
+        stmt = stmt.order_by(sort_column.desc(), tables.Movie.id.desc())
+    else:
+        stmt = stmt.order_by(sort_column, tables.Movie.id)
+
+    # get one more than the limit, to know if there is a next page
+    movies = (await session.scalars(stmt.limit(limit + 1))).all()
+
+    next_cursor = None
+    if len(movies) > limit:
+        movies = movies[:limit]
+        next_cursor = encode_cursor(sort, movies[-1])
+
+    if api_settings.api_orjson:
+        content = {
+            "movies": [serializers.movie_dict(movie) for movie in movies],
+            "next_cursor": next_cursor,
+        }
+        return ORJSONResponse(content, headers=headers)
+    return {"movies": movies, "next_cursor": next_cursor}
+
+
+async def draw_movie_ids(
+    session: AsyncSession, filters: list, n: int, exclude: list[int]
+) -> list[int]:
+    """Randomly pick up to n distinct ids of movies matching the filters
+
+    Rather than ORDER BY random(), which reads every matching movie, each pick is the
+    first matching movie at or after a random id (or the last before it, if there are
+    none after), found with a seek on the primary key index. So a pick takes
+    O(log n) in the number of movies, as long as the filters match many of them.
+
+    Picks are only uniform when ids are evenly spread: a movie after a gap in the ids
+    (from deleted movies) is more likely to be picked.
+    """
+    # separate subqueries, as sqlite only reads min or max from the index when it is
+    # the only aggregate in a query
+    min_id, max_id = (
+        await session.execute(
+            select(
+                select(func.min(tables.Movie.id)).scalar_subquery(),
+                select(func.max(tables.Movie.id)).scalar_subquery(),
+            )
+        )
+    ).one()
+    if min_id is None:
+        return []
+
+    picked: list[int] = []
+    while len(picked) < n:
+        stmt = select(tables.Movie.id).filter(
+            *filters, tables.Movie.id.not_in([*exclude, *picked])
+        )
+        probe = random.randint(min_id, max_id)
+        movie_id = await session.scalar(
+            stmt.filter(tables.Movie.id >= probe).order_by(tables.Movie.id).limit(1)
+        )
+        if movie_id is None:
+            movie_id = await session.scalar(
+                stmt.filter(tables.Movie.id < probe)
+                .order_by(tables.Movie.id.desc())
+                .limit(1)
+            )
+        if movie_id is None:
+            # there are no more movies matching the filters
+            break
+        picked.append(movie_id)
+
+    return picked
+
+
+@router.get("/movies/random", response_model=list[tables.MovieRead])
+async def draw_movies(
+    n: int = Query(1, ge=1, le=RANDOM_MAX_N, description="Number of movies to draw"),
+    genre: str | None = None,
+    rating: str | None = Query(None, description="MPAA rating"),
+    min_runtime: int | None = None,
+    max_runtime: int | None = None,
+    year: int
+    | None = Query(None, ge=MIN_YEAR, le=MAX_YEAR, description="Release year"),
+    exclude: list[int] = Query([], description="Movie ids not to draw"),
     session: AsyncSession = Depends(db.get_session),
-) -> list[tables.Movie]:
-    movies = (await session.execute(select(tables.Movie))).scalars().unique().all()
+    api_settings: ApiSettings = Depends(get_api_settings),
+) -> list[tables.Movie] | Response:
+    """Draw n distinct movies at random from the hat
+
+    Returns fewer than n movies if fewer match the filters
+    """
+    filters = movie_filters(genre, rating, min_runtime, max_runtime, year)
+    movie_ids = await draw_movie_ids(session, filters, n, exclude)
+    if not movie_ids:
+        return []
+
+    stmt = select(tables.Movie).filter(tables.Movie.id.in_(movie_ids))
+    movies = {movie.id: movie for movie in await session.scalars(stmt)}
+    movies = [movies[movie_id] for movie_id in movie_ids]
+    if api_settings.api_orjson:
+        return ORJSONResponse([serializers.movie_dict(movie) for movie in movies])
     return movies
 
 
+@router.get("/movies/search", response_model=list[tables.MovieRead])
+async def search_local_movies(
+    q: str = Query(..., min_length=1, description="Words to search for"),
+    limit: int = Query(MOVIES_SEARCH_LIMIT, ge=1, le=MOVIES_SEARCH_MAX_LIMIT),
+    session: AsyncSession = Depends(db.get_session),
+    api_settings: ApiSettings = Depends(get_api_settings),
+) -> list[tables.Movie] | Response:
+    """Search the titles and overviews of the movies we have, best match first
+
+    Unlike /search_movies/, doesn't request TMDB. Each word matches words starting with
+    it, e.g. "big leb" matches "The Big Lebowski"
+    """
+    words = search.query_words(q)
+    if not words:
+        return []
+
+    stmt = search.search_stmt(session.bind.dialect.name, words).limit(limit)
+    movies = (await session.scalars(stmt)).all()
+    if api_settings.api_orjson:
+        return ORJSONResponse([serializers.movie_dict(movie) for movie in movies])
+    return movies
+
+
+class CatalogFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+# fields of MovieRead in the order they are exported, genres are joined by "|" in csv
+EXPORT_FIELDS = list(tables.MovieRead.__fields__)
+EXPORT_MEDIA_TYPES = {
+    CatalogFormat.ndjson: "application/x-ndjson",
+    CatalogFormat.csv: "text/csv",
+}
+
+
+def movie_csv_row(movie: tables.MovieRead) -> list:
+    row = movie.dict()
+    row["genres"] = "|".join(genre["name"] for genre in row["genres"])
+    return [row[field] for field in EXPORT_FIELDS]
+
+
+@router.get("/movies/export", response_class=StreamingResponse)
+async def export_movies(
+    format: CatalogFormat = CatalogFormat.ndjson,
+    session: AsyncSession = Depends(db.get_session),
+) -> StreamingResponse:
+    """Export all the movies as newline delimited json (or csv)
+
+    Movies are streamed from a server side cursor in batches, so memory use doesn't
+    depend on the number of movies
+    """
+    stmt = (
+        select(tables.Movie)
+        .order_by(tables.Movie.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+
+    async def export_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == CatalogFormat.csv:
+            writer.writerow(EXPORT_FIELDS)
+
+        result = await session.stream(stmt)
+        async for db_movies in result.scalars().partitions():
+            for db_movie in db_movies:
+                movie = tables.MovieRead.from_orm(db_movie)
+                if format == CatalogFormat.csv:
+                    writer.writerow(movie_csv_row(movie))
+                else:
+                    buffer.write(movie.json() + "\n")
+                # so the session doesn't keep every movie we've exported
+                session.expunge(db_movie)
+
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        # the header, if there were no movies
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    return StreamingResponse(
+        export_lines(),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f'attachment; filename="movies.{format.value}"'
+        },
+    )
+
+
+async def read_lines(
+    chunks: AsyncIterator[bytes],
+) -> AsyncIterator[tuple[int, bytes]]:
+    """Split a stream of bytes into (line number, line)
+
+    Lines are decoded by the caller, so one that isn't valid utf-8 can be skipped
+    like any other invalid line
+    """
+    line_number = 0
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            yield line_number, line.rstrip(b"\r")
+    if buffer:
+        yield line_number + 1, buffer.rstrip(b"\r")
+
+
+def parse_csv_line(header: list[str], line: str) -> dict:
+    """Parse a line of csv as exported by export_movies
+
+    Note: fields containing newlines are not supported
+    """
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"expected {len(header)} fields, got {len(values)}")
+    # empty fields are left out, so the defaults are used
+    record = {key: value for key, value in zip(header, values) if value != ""}
+    genres = record.get("genres")
+    record["genres"] = genres.split("|") if genres else []
+    return record
+
+
+async def import_batch(
+    session: AsyncSession,
+    movies: list[tuple[int, tables.MovieImport]],
+    summary: tables.ImportSummary,
+):
+    """Insert a batch of movies in one transaction, skipping duplicates"""
+    keys = {(movie.release_date, movie.title) for _, movie in movies}
+    stmt = select(tables.Movie.release_date, tables.Movie.title).filter(
+        tuple_(tables.Movie.release_date, tables.Movie.title).in_(keys)
+    )
+    existing = set((await session.execute(stmt)).all())
+
+    new_movies = []
+    for line_number, movie in movies:
+        key = (movie.release_date, movie.title)
+        if key in existing:
+            summary.duplicates += 1
+            continue
+        # also skips duplicates within the batch
+        existing.add(key)
+        new_movies.append((line_number, movie))
+
+    try:
+        await insert_movies(
+            session,
+            [(movie.dict(exclude={"genres"}), movie.genres) for _, movie in new_movies],
+        )
+        await session.commit()
+    except sqlalchemy.exc.IntegrityError as exc:
+        # e.g. a movie was created by another request since we checked for duplicates
+        logger.error("Error importing batch of movies: {}", exc)
+        await session.rollback()
+        summary.skipped += len(new_movies)
+        add_import_errors(summary, [line for line, _ in new_movies], "Database error")
+        return
+
+    summary.inserted += len(new_movies)
+
+
+def add_import_errors(summary: tables.ImportSummary, lines: list[int], detail: str):
+    for line in lines[: IMPORT_MAX_ERRORS - len(summary.errors)]:
+        summary.errors.append(tables.ImportLineError(line=line, detail=detail))
+
+
+@router.post("/movies/import", response_model=tables.ImportSummary)
+async def import_movies(
+    request: Request,
+    format: CatalogFormat = CatalogFormat.ndjson,
+    batch_size: int = Query(IMPORT_BATCH_SIZE, ge=1, le=IMPORT_MAX_BATCH_SIZE),
+    session: AsyncSession = Depends(db.get_session),
+) -> tables.ImportSummary:
+    """Import movies from a streamed body of newline delimited json (or csv)
+
+    Each line is a movie with its genres, in the same format as /movies/export.
+    Lines are validated as they are read and inserted in batches, each batch in its own
+    transaction. Movies with the same title and release_date as an existing movie are
+    counted as duplicates and not inserted.
+    """
+    summary = tables.ImportSummary()
+    batch: list[tuple[int, tables.MovieImport]] = []
+    header = None
+
+    async for line_number, raw_line in read_lines(request.stream()):
+        if not raw_line.strip():
+            continue
+
+        if format == CatalogFormat.csv and header is None:
+            header = next(csv.reader([raw_line.decode(errors="replace")]))
+            continue
+
+        try:
+            line = raw_line.decode()
+            if format == CatalogFormat.csv:
+                record = parse_csv_line(header, line)
+            else:
+                record = json.loads(line)
+            movie = tables.MovieImport.parse_obj(record)
+        except (ValueError, TypeError) as exc:
+            # note: decoding, json and pydantic validation errors are all ValueErrors
+            summary.skipped += 1
+            add_import_errors(summary, [line_number], str(exc))
+            continue
+
+        batch.append((line_number, movie))
+        if len(batch) >= batch_size:
+            await import_batch(session, batch, summary)
+            batch = []
+
+    if batch:
+        await import_batch(session, batch, summary)
+
+    logger.opt(lazy=True).info(
+        "Imported movies: {}", lambda: summary.dict(exclude={"errors"})
+    )
+    return summary
+
+
 @router.get("/movie/{movie_id}", response_model=tables.MovieRead)
 async def read_movie(
-    movie_id: int, session: AsyncSession = Depends(db.get_session)
-) -> tables.Movie:
+    movie_id: int,
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(db.get_session),
+    api_settings: ApiSettings = Depends(get_api_settings),
+) -> tables.Movie | Response:
+    """Get a movie, with an ETag and Last-Modified for conditional requests
+
+    The movie's version is checked before loading it (and its genres), so a request
+    with a current If-None-Match or If-Modified-Since gets a 304 for one small query
+    """
+    stmt = select(tables.Movie.created_at, tables.Movie.updated_at).filter(
+        tables.Movie.id == movie_id
+    )
+    version = (await session.execute(stmt)).first()
+    if version is None:
+        raise HTTPException(status_code=404, detail="Movie not found")
+
+    etag = versioning.movie_etag(movie_id, *version)
+    last_modified = version.updated_at or version.created_at
+    if versioning.not_modified(request, etag, last_modified):
+        return Response(
+            status_code=304, headers=versioning.cache_headers(etag, last_modified)
+        )
+
     movie = await get_object_or_404(session, tables.Movie, movie_id)
+    headers = versioning.cache_headers(
+        versioning.movie_etag(movie.id, movie.created_at, movie.updated_at),
+        movie.updated_at or movie.created_at,
+    )
+    if api_settings.api_orjson:
+        return ORJSONResponse(serializers.movie_dict(movie), headers=headers)
+    response.headers.update(headers)
     return movie
 
 
@@ -174,10 +811,12 @@ async def update_movie(
 
     # adding genres to movie
     if genres is not None:
-        db_genres = []
-        for genre in genres:
-            db_genres.append(await get_or_create(session, tables.Genre, name=genre))
-        db_movie.genres = db_genres
+        db_genres = await get_or_create_many(session, tables.Genre, "name", genres)
+        db_movie.genres = list(db_genres.values())
+
+        # the movie row isn't updated when only its genres change, but its version
+        # (and the catalog's) needs to be
+        db_movie.updated_at = tables.utcnow()
 
     # best attempt at not updating the movie if no data is actually passed in
     if movie or genres is not None:
@@ -185,7 +824,7 @@ async def update_movie(
         await commit(session)
         await session.refresh(db_movie)
 
-        logger.info("Updated movie: {}", db_movie.dict())
+        logger.opt(lazy=True).info("Updated movie: {}", lambda: db_movie.dict())
     return db_movie
 
 
@@ -197,5 +836,5 @@ async def delete_movie(
     await session.delete(movie)
     await commit(session)
 
-    logger.info("Deleted movie: {}", movie.dict())
+    logger.opt(lazy=True).info("Deleted movie: {}", lambda: movie.dict())
     return {"ok": True}
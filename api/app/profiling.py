@@ -0,0 +1,217 @@
+"""Opt-in profiling of requests, to find out where the time of a slow request went
+
+With API_PROFILING=header the requests sent with an X-Profile header are profiled, with
+API_PROFILING=always every request is (or a fraction, API_PROFILING_SAMPLE_RATE).
+Profiled responses get a Server-Timing header, shown by the browser's dev tools, with
+the milliseconds spent in:
+
+- db: database queries, and how many
+- tmdb: requests to TMDB, and how many
+- serialize: from the endpoint returning to the response being sent, i.e. validating
+  the response model and encoding it
+- app: everything else, e.g. dependencies and our own code
+- total
+
+The SQL statements of a profiled request, and a cProfile report, are logged with
+API_PROFILING_SQL and API_PROFILING_CPROFILE, or when the X-Profile header asks for
+them, e.g.: curl -H "X-Profile: sql,cprofile" localhost:8000/movies/
+
+cProfile profiles the whole event loop, so the report includes any other requests
+handled at the same time, and only one request is profiled with it at once.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import pstats
+import random
+import time
+from collections.abc import Callable, Iterable
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from fastapi.routing import APIRoute
+from loguru import logger
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.routing import BaseRoute
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import ApiSettings
+
+# lines of the cProfile report, by cumulative time
+CPROFILE_LINES = 30
+
+
+@dataclass
+class RequestProfile:
+    start: float = field(default_factory=time.perf_counter)
+    db_time: float = 0.0
+    db_queries: int = 0
+    tmdb_time: float = 0.0
+    tmdb_requests: int = 0
+    # set when the endpoint returns, see time_endpoints
+    endpoint_end: float | None = None
+    # (statement, seconds), if they are being recorded
+    statements: list[tuple[str, float]] | None = None
+
+
+# the profile of the current request, None if it isn't profiled
+current_profile: ContextVar[RequestProfile | None] = ContextVar(
+    "current_profile", default=None
+)
+# only one cProfile profiler can be enabled at a time
+cprofile_running = False
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile.get() is not None:
+        context._profile_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile.get()
+    start = getattr(context, "_profile_start", None)
+    if profile is None or start is None:
+        return
+    duration = time.perf_counter() - start
+    profile.db_time += duration
+    profile.db_queries += 1
+    if profile.statements is not None:
+        profile.statements.append((statement, duration))
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Time the engine's queries for profiled requests, once even if started again"""
+    sync_engine = engine.sync_engine
+    if not event.contains(sync_engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+def record_tmdb_request(duration: float):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.tmdb_time += duration
+        profile.tmdb_requests += 1
+
+
+def timed_endpoint(call: Callable) -> Callable:
+    @functools.wraps(call)
+    async def endpoint(**kwargs):
+        try:
+            return await call(**kwargs)
+        finally:
+            profile = current_profile.get()
+            if profile is not None:
+                profile.endpoint_end = time.perf_counter()
+
+    return endpoint
+
+
+def time_endpoints(routes: Iterable[BaseRoute]):
+    """Record when each endpoint returns, to tell its time apart from serializing
+
+    Replaces the call of the routes' dependant, after FastAPI has read its signature
+    """
+    for route in routes:
+        if isinstance(route, APIRoute) and asyncio.iscoroutinefunction(
+            route.dependant.call
+        ):
+            route.dependant.call = timed_endpoint(route.dependant.call)
+
+
+def server_timing(profile: RequestProfile, end: float) -> str:
+    total = end - profile.start
+    serialize = end - profile.endpoint_end if profile.endpoint_end else 0.0
+    app = max(0.0, total - profile.db_time - profile.tmdb_time - serialize)
+    return ", ".join(
+        [
+            f'db;dur={profile.db_time * 1000:.2f};desc="queries: {profile.db_queries}"',
+            f"tmdb;dur={profile.tmdb_time * 1000:.2f}"
+            f';desc="requests: {profile.tmdb_requests}"',
+            f"serialize;dur={serialize * 1000:.2f}",
+            f"app;dur={app * 1000:.2f}",
+            f"total;dur={total * 1000:.2f}",
+        ]
+    )
+
+
+def cprofile_report(profiler: cProfile.Profile) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(CPROFILE_LINES)
+    return stream.getvalue()
+
+
+class ProfilingMiddleware:
+    """Profiles the requests selected by the settings, or asking with X-Profile"""
+
+    def __init__(self, app: ASGIApp, settings: ApiSettings):
+        self.app = app
+        self.settings = settings
+
+    def profile_options(self, scope: Scope) -> set[str] | None:
+        """What to record for the request, None if it isn't profiled"""
+        header = Headers(scope=scope).get("x-profile")
+        if header is None and (
+            self.settings.api_profiling != "always"
+            or random.random() >= self.settings.api_profiling_sample_rate
+        ):
+            return None
+
+        options = {option.strip().lower() for option in (header or "").split(",")}
+        if self.settings.api_profiling_sql:
+            options.add("sql")
+        if self.settings.api_profiling_cprofile:
+            options.add("cprofile")
+        return options
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        global cprofile_running
+        options = None
+        if scope["type"] == "http":
+            options = self.profile_options(scope)
+        if options is None:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(statements=[] if "sql" in options else None)
+        token = current_profile.set(profile)
+        profiler = None
+        if "cprofile" in options and not cprofile_running:
+            cprofile_running = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        async def send_wrapper(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing", server_timing(profile, time.perf_counter())
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                cprofile_running = False
+
+            request = f"{scope['method']} {scope['path']}"
+            if profile.statements is not None:
+                logger.info(
+                    "SQL of {} ({} statements):\n{}",
+                    request,
+                    len(profile.statements),
+                    "\n".join(
+                        f"[{duration * 1000:.2f} ms] {statement}"
+                        for statement, duration in profile.statements
+                    ),
+                )
+            if profiler is not None:
+                logger.info("cProfile of {}:\n{}", request, cprofile_report(profiler))
@@ -0,0 +1,103 @@
+"""Rate limiting of requests to an upstream api"""
+
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header, which is seconds or an http date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Token bucket rate limiter, which adapts its rate to upstream responses
+
+    Tokens are added at `rate` per second up to `burst`, and each request takes one.
+    When there are none left, a request reserves the next token and waits for it, so
+    requests are let through in the order they arrived.
+
+    The rate is halved (down to min_rate) each time upstream responds with a 429,
+    and no requests are let through until its Retry-After has passed. Successful
+    responses increase the rate again, up to the configured rate.
+    """
+
+    def __init__(
+        self,
+        rate: float = 20,
+        burst: int = 20,
+        min_rate: float = 1,
+        default_retry_after: float = 1,
+    ):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.burst = burst
+        self.default_retry_after = default_retry_after
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # no requests are let through before this time (from a Retry-After)
+        self.blocked_until = 0.0
+        # requests waiting for a token
+        self.waiting = 0
+        self.throttled = 0
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Take a token, returning the seconds to wait before it can be used
+
+        tokens go negative when requests are waiting, which pushes later requests
+        further back
+        """
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait <= 0:
+            return
+        self.waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    def on_response(self, status_code: int, retry_after: str | None = None):
+        """Adapt the rate to an upstream response"""
+        if status_code == 429:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            delay = parse_retry_after(retry_after)
+            if delay is None:
+                delay = self.default_retry_after
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        elif status_code < 500 and self.rate < self.max_rate:
+            # additive increase, multiplicative decrease
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self) -> dict[str, float]:
+        self._refill(time.monotonic())
+        return {
+            "rate": self.rate,
+            "tokens": self.tokens,
+            "waiting": self.waiting,
+            "throttled": self.throttled,
+        }
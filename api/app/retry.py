@@ -0,0 +1,89 @@
+"""Retrying requests to an upstream api, and failing fast when it is down"""
+
+import random
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request while the circuit is open"""
+
+
+class CircuitBreaker:
+    """Stops requests to upstream after repeated failures
+
+    After failure_threshold consecutive failures the circuit opens and requests fail
+    immediately. Once reset_timeout has passed a single trial request is let through
+    (half open): if it succeeds the circuit closes, if it fails it opens again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def before_request(self):
+        """Raise CircuitOpenError if the request shouldn't be made"""
+        state = self.state
+        if state == "open":
+            self.rejected += 1
+            raise CircuitOpenError()
+        if state == "half_open":
+            # the trial request, others are rejected until it completes (or times out)
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class RetryPolicy:
+    """How many times, and how long to wait between, attempts of a request
+
+    Waits grow exponentially from backoff up to backoff_max, with "full jitter" so
+    that clients retrying at the same time spread out:
+    https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+
+    No attempt is started, or runs, after deadline seconds from the start of the first
+    """
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        backoff: float = 0.2,
+        backoff_max: float = 5,
+        deadline: float = 15,
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.retries = 0
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Seconds to wait after the attempt (starting at 0) failed"""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2**attempt))
+
+    def stats(self) -> dict:
+        return {"retries": self.retries}
@@ -0,0 +1,107 @@
+"""Full text search of the movies in our database
+
+On sqlite, an FTS5 virtual table (movie_fts) indexes the title and overview of each
+movie, kept in sync with the movie table by triggers. On postgres, a generated tsvector
+column (movie.search_vector) with a GIN index does the same.
+
+Each word of a query matches words starting with it, so that results can be shown as
+the user types. Matches in the title rank above matches in the overview.
+"""
+
+import re
+
+from sqlalchemy import column, func, literal_column, table, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.future import select
+from sqlalchemy.sql import Select
+
+from app import tables
+
+# prefix indexes for 2 and 3 characters make short type-ahead queries faster
+SQLITE_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE movie_fts USING fts5(
+        title, overview, content='movie', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER movie_fts_insert AFTER INSERT ON movie BEGIN
+        INSERT INTO movie_fts(rowid, title, overview)
+        VALUES (new.id, new.title, new.overview);
+    END
+    """,
+    """
+    CREATE TRIGGER movie_fts_delete AFTER DELETE ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title, overview)
+        VALUES ('delete', old.id, old.title, old.overview);
+    END
+    """,
+    """
+    CREATE TRIGGER movie_fts_update AFTER UPDATE OF title, overview ON movie BEGIN
+        INSERT INTO movie_fts(movie_fts, rowid, title, overview)
+        VALUES ('delete', old.id, old.title, old.overview);
+        INSERT INTO movie_fts(rowid, title, overview)
+        VALUES (new.id, new.title, new.overview);
+    END
+    """,
+    # index the movies that were added before the search index existed
+    "INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')",
+]
+
+POSTGRES_SEARCH_DDL = [
+    """
+    ALTER TABLE movie ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A')
+        || setweight(to_tsvector('english', coalesce(overview, '')), 'B')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_movie_search_vector ON movie USING GIN (search_vector)",
+]
+
+# bm25 weights of the title and overview columns of movie_fts
+SQLITE_FTS_WEIGHTS = (10.0, 1.0)
+
+movie_fts = table("movie_fts", column("rowid"))
+
+
+def create_search_index(conn: Connection):
+    """Create the search index, if it doesn't already exist"""
+    if conn.dialect.name == "postgresql":
+        for ddl in POSTGRES_SEARCH_DDL:
+            conn.execute(text(ddl))
+        return
+
+    exists = conn.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movie_fts'")
+    ).first()
+    if not exists:
+        for ddl in SQLITE_FTS_DDL:
+            conn.execute(text(ddl))
+
+
+def query_words(query: str) -> list[str]:
+    """The words of the query, without any search syntax (quotes, operators, etc.)"""
+    return re.findall(r"\w+", query.lower())
+
+
+def search_stmt(dialect_name: str, words: list[str]) -> Select:
+    """Select the movies matching the start of each of the words, best match first"""
+    if dialect_name == "postgresql":
+        search_vector = literal_column("movie.search_vector")
+        tsquery = func.to_tsquery("english", " & ".join(f"{word}:*" for word in words))
+        return (
+            select(tables.Movie)
+            .filter(search_vector.op("@@")(tsquery))
+            .order_by(func.ts_rank(search_vector, tsquery).desc(), tables.Movie.id)
+        )
+
+    fts = literal_column("movie_fts")
+    match = " ".join(f'"{word}"*' for word in words)
+    return (
+        select(tables.Movie)
+        .join(movie_fts, movie_fts.c.rowid == tables.Movie.id)
+        .filter(fts.op("MATCH")(match))
+        .order_by(func.bm25(fts, *SQLITE_FTS_WEIGHTS), tables.Movie.id)
+    )
@@ -1,8 +1,9 @@
 import re
-from datetime import date, datetime
+from datetime import date, datetime, timezone
+from enum import Enum
 
 from pydantic import validator
-from sqlalchemy import CheckConstraint, Column, DateTime, UniqueConstraint
+from sqlalchemy import JSON, CheckConstraint, Column, DateTime, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlmodel import Field, Relationship, SQLModel
 
@@ -17,6 +18,10 @@ RELEASE_DATE_CONSTR = date(1871, 1, 1)
 re_date_format = re.compile("^([0-9]{4})-?(1[0-2]|0[1-9])-?(3[01]|0[1-9]|[12][0-9])$")
 
 
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class GenreMovieLink(SQLModel, table=True):
     genre_id: int | None = Field(default=None, foreign_key="genre.id", primary_key=True)
     movie_id: int | None = Field(default=None, foreign_key="movie.id", primary_key=True)
@@ -27,10 +32,12 @@ class Genre(SQLModel, table=True):
 
     id: int | None = Field(default=None, primary_key=True)
     name: str
+    # a genre can have a lot of movies, so they are only loaded when asked for with
+    # a loader option, e.g.: select(Genre).options(selectinload(Genre.movies))
     movies: list["Movie"] = Relationship(
         back_populates="genres",
         link_model=GenreMovieLink,
-        sa_relationship_kwargs={"lazy": "joined"},
+        sa_relationship_kwargs={"lazy": "raise"},
     )
 
 
@@ -41,6 +48,7 @@ class MovieBase(SQLModel):
     tmdb_id: int | None = Field(default=None, description="TMDB ID", index=True)
     imdb_id: str | None = Field(default=None, description="IMBD ID")
     poster: str | None = Field(default=None, description="TMDB poster path")
+    overview: str | None = Field(default=None, description="Plot summary")
     # note: MPAA rating is under release_dates in TMDB
     # http://api.themoviedb.org/3/movie/550?api_key=###&append_to_response=release_dates
     rating: str | None = Field(default=None, description="MPAA rating")
@@ -87,22 +95,116 @@ class Movie(MovieBase, table=True):
     created_at: datetime | None = Field(
         sa_column=Column(DateTime(timezone=True), server_default=func.now())
     )
+    # set in python rather than with now(), which is only to the second on sqlite, so
+    # that each update changes the movie's version (see versioning.py)
     updated_at: datetime | None = Field(
-        sa_column=Column(DateTime(timezone=True), onupdate=func.now())
+        sa_column=Column(DateTime(timezone=True), onupdate=utcnow)
     )
     # todo: cascade on delete (sa_relationship_kwargs)
+    # loaded with a separate SELECT ... IN query for all the movies in a result, so
+    # rows aren't multiplied by the number of genres as with a join
+    # ordered, as the order the links are inserted in is not guaranteed
     genres: list[Genre] = Relationship(
         back_populates="movies",
         link_model=GenreMovieLink,
-        sa_relationship_kwargs={"lazy": "joined"},
+        sa_relationship_kwargs={"lazy": "selectin", "order_by": "Genre.name"},
     )
     # todo: created_by (user)
 
 
+class TMDBCache(SQLModel, table=True):
+    """Raw TMDB movie responses, so that we don't need to request them again"""
+
+    __tablename__ = "tmdb_cache"
+
+    tmdb_id: int = Field(default=..., primary_key=True)
+    payload: dict = Field(default=..., sa_column=Column(JSON, nullable=False))
+    fetched_at: datetime = Field(default_factory=datetime.utcnow)
+    # validators TMDB sends with the response, used to revalidate stale entries
+    etag: str | None = None
+    last_modified: str | None = None
+
+
+class TMDBConfig(SQLModel, table=True):
+    """A single row, the last TMDB configuration response (e.g. the images base url)
+
+    See tmdb_config.py
+    """
+
+    __tablename__ = "tmdb_config"
+
+    id: int = Field(default=1, primary_key=True)
+    payload: dict = Field(default=..., sa_column=Column(JSON, nullable=False))
+    fetched_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class CatalogVersion(SQLModel, table=True):
+    """A single row, updated by triggers on every change to the movies or their genres
+
+    See versioning.py
+    """
+
+    __tablename__ = "catalog_version"
+
+    id: int = Field(default=1, primary_key=True)
+    version: int = 0
+    modified_at: datetime = Field(default_factory=datetime.utcnow)
+
+
+class ImportJobStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class ImportJob(SQLModel, table=True):
+    """A background import of movies from TMDB, see jobs.py
+
+    Progress is committed after each batch, so a job interrupted by a restart resumes
+    from the first tmdb_id it hadn't processed. A running job is held by the process
+    running it (owner) until its lease expires
+    """
+
+    __tablename__ = "import_job"
+
+    id: int | None = Field(default=None, primary_key=True)
+    status: ImportJobStatus = ImportJobStatus.pending
+    tmdb_ids: list[int] = Field(default=..., sa_column=Column(JSON, nullable=False))
+    # number of tmdb_ids processed, from the start of tmdb_ids
+    processed: int = 0
+    created: int = 0
+    existing: int = 0
+    # {tmdb_id: {"status": ..., "detail": ...}} for the tmdb_ids that failed
+    errors: dict = Field(default_factory=dict, sa_column=Column(JSON, nullable=False))
+    detail: str | None = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+    # host:pid of the process running the job
+    owner: str | None = None
+    lease_expires_at: datetime | None = None
+
+
 class MovieCreate(MovieBase):
     pass
 
 
+class MovieImport(MovieCreate):
+    """A movie and its genres, as imported by /movies/import
+
+    Genres can also be passed as they are exported, e.g.: [{"id": 1, "name": "Drama"}]
+    """
+
+    genres: list[str] = []
+
+    @validator("genres", pre=True, each_item=True)
+    def genre_name(cls, value):
+        if isinstance(value, dict):
+            return value.get("name")
+        return value
+
+
 class MovieRead(MovieBase):
     id: int
     created_at: datetime
@@ -110,6 +212,77 @@ class MovieRead(MovieBase):
     genres: list[Genre] = []
 
 
+class MoviesPage(SQLModel):
+    """A page of movies, pass next_cursor to get the following page"""
+
+    movies: list[MovieRead]
+    next_cursor: str | None = None
+
+
+class ImportLineError(SQLModel):
+    line: int
+    detail: str
+
+
+class ImportSummary(SQLModel):
+    inserted: int = 0
+    # movies with the same title and release_date as one that already exists
+    duplicates: int = 0
+    # lines that couldn't be parsed or validated, errors lists the first of those
+    skipped: int = 0
+    errors: list[ImportLineError] = []
+
+
+class TMDBMovieStatus(str, Enum):
+    created = "created"
+    existing = "existing"
+    # tmdb doesn't have a movie with this id
+    not_found = "not_found"
+    # tmdb couldn't be reached, or responded with an error or data we couldn't parse
+    upstream_error = "upstream_error"
+    # a movie with the same title and release_date, but another tmdb_id, exists
+    conflict = "conflict"
+    # the movie couldn't be stored in the database
+    error = "error"
+
+
+class TMDBMovieOutcome(SQLModel):
+    """What happened to one of the tmdb_ids requested to be created
+
+    Only created and existing outcomes have a movie, the others have a detail
+    """
+
+    status: TMDBMovieStatus
+    movie: MovieRead | None = None
+    detail: str | None = None
+
+
+class ImportJobError(SQLModel):
+    tmdb_id: int
+    status: TMDBMovieStatus
+    detail: str | None = None
+
+
+class ImportJobRead(SQLModel):
+    id: int
+    status: ImportJobStatus
+    total: int
+    processed: int
+    created: int
+    existing: int
+    failed: int
+    # fraction of the tmdb_ids processed, from 0 to 1
+    progress: float
+    # tmdb_ids processed per second since the job started
+    throughput: float | None = None
+    errors: list[ImportJobError] = []
+    # why the job failed, if it did
+    detail: str | None = None
+    created_at: datetime
+    started_at: datetime | None = None
+    finished_at: datetime | None = None
+
+
 class MovieUpdate(MovieBase):
     """used when updating movie data
 
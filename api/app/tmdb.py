@@ -1,33 +1,22 @@
 import asyncio
 import re
-import sys
+import time
+from collections.abc import Awaitable, Callable, Hashable
 from datetime import date
+from typing import Any
+from urllib.parse import urlsplit
 
 import httpx
 from fastapi import HTTPException
 from loguru import logger
-from loguru._defaults import LOGURU_FORMAT
 from pydantic import BaseModel, Field, ValidationError
 
-
-def obfuscate_message(message: str):
-    """Obfuscate sensitive information."""
-    result = re.sub(r"api_key=[a-zA-Z0-9]*", "api_key=xxxxxx", message)
-    return result
-
-
-def formatter(record):
-    record["extra"]["obfuscated_message"] = obfuscate_message(record["message"])
-
-    new_format = LOGURU_FORMAT.replace("message", "extra[obfuscated_message]")
-
-    # when using a callable it seems we need to add a terminator to the message
-    return new_format + "\n"
-
-
-# replace the default handler with one that obfuscates the api key
-logger.remove(0)
-logger.add(sys.stderr, colorize=True, format=formatter)
+from app import metrics, profiling
+from app.cache import Cache, TTLCache
+from app.config import ClientSettings
+from app.log import redact_request, redact_url
+from app.rate_limit import RateLimiter
+from app.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
 
 
 class TMDBSearchResult(BaseModel):
@@ -49,6 +38,7 @@ class TMDBMovieResult(BaseModel):
     runtime: int
     imdb_id: str | None = None
     poster: str | None = Field(None, alias="poster_path")
+    overview: str | None = None
     adult: bool = False
 
 
@@ -69,23 +59,162 @@ class ReleaseDates(BaseModel):
     results: list[Result]
 
 
-# use a semaphore to avoid overloading the tmdb api
-# https://rednafi.github.io/reflections/limit-concurrency-with-semaphore-in-python-asyncio.html
-# https://anyio.readthedocs.io/en/stable/synchronization.html
-sem = asyncio.Semaphore(3)
+# rate limit requests to avoid overloading the tmdb api, shared by all requests
+# replaced with a limiter configured from the client settings on app startup
+rate_limiter = RateLimiter()
+
+# responses that are worth trying the request again for
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# retry failed requests, and stop requesting when tmdb is down, shared by all requests
+# replaced with ones configured from the client settings on app startup
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+
+# a single client for the lifetime of the app so that connections to TMDB are pooled
+# and kept alive, instead of paying for a new TCP + TLS handshake on every request
+# https://www.python-httpx.org/advanced/#why-use-a-client
+client: httpx.AsyncClient | None = None
+
+
+def create_client(settings: ClientSettings) -> httpx.AsyncClient:
+    """Create an httpx client configured from the client settings"""
+    limits = httpx.Limits(
+        max_connections=settings.tmdb_max_connections,
+        max_keepalive_connections=settings.tmdb_max_keepalive_connections,
+        keepalive_expiry=settings.tmdb_keepalive_expiry,
+    )
+    timeout = httpx.Timeout(
+        settings.tmdb_timeout, connect=settings.tmdb_connect_timeout
+    )
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=settings.tmdb_http2)
+
+
+async def open_client(settings: ClientSettings):
+    """Create the shared client, called on app startup"""
+    global client
+    if client is None:
+        client = create_client(settings)
+
+
+async def close_client():
+    """Close the shared client, called on app shutdown"""
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+# cache of search results, replaced with a configured cache on app startup
+search_cache: Cache = TTLCache()
+
+
+def open_search_cache(settings: ClientSettings):
+    """Create the search results cache, called on app startup"""
+    global search_cache
+    search_cache = TTLCache(
+        maxsize=settings.tmdb_search_cache_maxsize,
+        ttl=settings.tmdb_search_cache_ttl,
+    )
+
+
+def open_rate_limiter(settings: ClientSettings):
+    """Create the rate limiter, called on app startup"""
+    global rate_limiter
+    rate_limiter = RateLimiter(
+        rate=settings.tmdb_rate_limit,
+        burst=settings.tmdb_rate_limit_burst,
+        min_rate=settings.tmdb_rate_limit_min,
+    )
+
+
+def open_retry_policy(settings: ClientSettings):
+    """Create the retry policy and circuit breaker, called on app startup"""
+    global retry_policy, circuit_breaker
+    retry_policy = RetryPolicy(
+        attempts=settings.tmdb_retry_attempts,
+        backoff=settings.tmdb_retry_backoff,
+        backoff_max=settings.tmdb_retry_backoff_max,
+        deadline=settings.tmdb_retry_deadline,
+    )
+    circuit_breaker = CircuitBreaker(
+        failure_threshold=settings.tmdb_circuit_failure_threshold,
+        reset_timeout=settings.tmdb_circuit_reset_timeout,
+    )
+
+
+def get_search_cache() -> Cache:
+    """dependency for returning the search results cache"""
+    return search_cache
+
+
+def search_cache_key(params: dict) -> tuple:
+    """Key for the search cache from the tmdb search params
+
+    The api_key is excluded and the query normalized, as TMDB search is case
+    insensitive
+    """
+    query = " ".join(params["query"].split()).casefold()
+    return (
+        query,
+        params.get("year"),
+        params.get("page", 1),
+        params.get("include_adult", False),
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """dependency for returning the shared TMDB client"""
+    if client is None:
+        raise RuntimeError("TMDB client is not open, was the startup event run?")
+    return client
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into a single in-flight call
+
+    The first caller for a key starts the call, callers arriving while it is in flight
+    await the same result (or exception) instead of making a duplicate request.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._in_flight.get(key)
+        if fut is None:
+            self.calls += 1
+            fut = asyncio.ensure_future(fn())
+            self._in_flight[key] = fut
+            fut.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.coalesced += 1
+
+        # shield so that one cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(fut)
+
+    def _forget(self, key: Hashable, fut: asyncio.Future):
+        if self._in_flight.get(key) is fut:
+            del self._in_flight[key]
+
+    def stats(self) -> dict[str, int]:
+        return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+# shared by tmdb_search and get_movie_data, keys are namespaced by the request type
+single_flight = SingleFlight()
 
 
 def resp_error_handling(resp: httpx.Response):
     """Generalized error handler for tmdb responses"""
 
-    # todo: remove sensitive info (api key) from logged data
-    # in the query argument of resp.request URL
-
     if 400 <= resp.status_code < 500:
         # error in user submission
         logger.error(
             "Error from TMDB. Request: {}, Response: {}",
-            resp.request,
+            redact_request(resp.request),
             resp,
         )
         raise HTTPException(resp.status_code, "Bad search params")
@@ -95,16 +224,137 @@ def resp_error_handling(resp: httpx.Response):
     except httpx.HTTPStatusError as e:
         logger.error(
             "Error from TMDB. Request: {}, Response: {}",
-            resp.request,
+            redact_request(resp.request),
             e.response,
         )
         raise HTTPException(504)
 
 
-async def tmdb_search(params, api_url) -> TMDBSearchResult:
-    async with sem:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(f"{api_url}/search/movie", params=params)
+def metrics_endpoint(url: str) -> str:
+    """The path of the url with ids replaced, e.g. /3/movie/{id}"""
+    return re.sub(r"(?<=[a-z])/\d+(?=/|$)", "/{id}", urlsplit(url).path)
+
+
+def record_request_metrics(url: str, status: str, start: float):
+    duration = time.perf_counter() - start
+    endpoint = metrics_endpoint(url)
+    metrics.tmdb_requests.inc(endpoint, status)
+    metrics.tmdb_request_duration.observe(duration, endpoint)
+    profiling.record_tmdb_request(duration)
+
+
+def collect_metrics():
+    """Read the stats of the current cache, rate limiter, etc. for /metrics"""
+    cache_stats = search_cache.stats()
+    metrics.cache_hits.set(cache_stats["hits"], "tmdb_search")
+    metrics.cache_misses.set(cache_stats["misses"], "tmdb_search")
+    metrics.cache_evictions.set(cache_stats["evictions"], "tmdb_search")
+    metrics.tmdb_coalesced_requests.set(single_flight.coalesced)
+    metrics.tmdb_retries.set(retry_policy.retries)
+    limiter_stats = rate_limiter.stats()
+    metrics.tmdb_rate_limit_rate.set(limiter_stats["rate"])
+    metrics.tmdb_rate_limit_tokens.set(limiter_stats["tokens"])
+    metrics.tmdb_rate_limit_waiting.set(limiter_stats["waiting"])
+    metrics.tmdb_rate_limit_throttled.set(limiter_stats["throttled"])
+    for state in ["closed", "open", "half_open"]:
+        metrics.tmdb_circuit_state.set(int(circuit_breaker.state == state), state)
+    metrics.tmdb_circuit_rejected.set(circuit_breaker.rejected)
+
+
+metrics.collectors.append(collect_metrics)
+
+
+async def tmdb_get(client: httpx.AsyncClient, url: str, **kwargs) -> httpx.Response:
+    """GET from tmdb through the circuit breaker and rate limiter, with retries
+
+    Transport errors and 5xx responses are retried with a jittered backoff, and 429
+    (Too Many Requests) responses once their Retry-After has passed, until the retry
+    policy's attempts or deadline run out. An attempt still running at the deadline is
+    cancelled.
+
+    Raises HTTPException(503) without making a request if tmdb is down (the circuit is
+    open), or HTTPException(504) if the request failed without a response, including
+    when the deadline passed waiting for the rate limiter
+    """
+    start = time.monotonic()
+    resp = None
+    for attempt in range(retry_policy.attempts):
+        try:
+            circuit_breaker.before_request()
+        except CircuitOpenError:
+            logger.warning("TMDB circuit is open, not requesting: {}", redact_url(url))
+            raise HTTPException(503, "TMDB is unavailable")
+
+        wait_start = time.perf_counter()
+        await rate_limiter.acquire()
+        request_start = time.perf_counter()
+        metrics.tmdb_rate_limit_wait.observe(request_start - wait_start)
+        remaining = retry_policy.deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            # waited out the deadline for the rate limiter, tmdb wasn't requested
+            logger.warning(
+                "TMDB retry deadline passed waiting to request: {}", redact_url(url)
+            )
+            break
+        try:
+            # the attempt is cut short at the deadline, rather than the client timeout
+            resp = await asyncio.wait_for(client.get(url, **kwargs), remaining)
+        except (httpx.TransportError, asyncio.TimeoutError) as exc:
+            record_request_metrics(url, "error", request_start)
+            # only failures of tmdb count, not waits for the deadline or the pool
+            if not isinstance(exc, (httpx.PoolTimeout, asyncio.TimeoutError)):
+                circuit_breaker.record_failure()
+            logger.warning(
+                "Error requesting TMDB: {!r}, Request: {}", exc, redact_url(url)
+            )
+            resp = None
+        else:
+            record_request_metrics(url, str(resp.status_code), request_start)
+            rate_limiter.on_response(resp.status_code, resp.headers.get("retry-after"))
+            if resp.status_code >= 500:
+                circuit_breaker.record_failure()
+            elif resp.status_code != 429:
+                circuit_breaker.record_success()
+            if resp.status_code not in RETRY_STATUS_CODES:
+                return resp
+            logger.warning(
+                "Error from TMDB. Request: {}, Response: {}",
+                redact_request(resp.request),
+                resp,
+            )
+
+        if resp is not None and resp.status_code == 429:
+            # the rate limiter waits for the Retry-After before the next attempt
+            delay = max(0.0, rate_limiter.blocked_until - time.monotonic())
+        else:
+            delay = retry_policy.backoff_delay(attempt)
+        if attempt + 1 == retry_policy.attempts or (
+            time.monotonic() - start + delay >= retry_policy.deadline
+        ):
+            break
+
+        retry_policy.retries += 1
+        if resp is None or resp.status_code != 429:
+            await asyncio.sleep(delay)
+
+    if resp is None:
+        raise HTTPException(504)
+    return resp
+
+
+async def tmdb_search(
+    params, api_url, client: httpx.AsyncClient
+) -> list[TMDBSearchResult]:
+    return await single_flight.do(
+        ("search", api_url, search_cache_key(params)),
+        lambda: _tmdb_search(params, api_url, client),
+    )
+
+
+async def _tmdb_search(
+    params, api_url, client: httpx.AsyncClient
+) -> list[TMDBSearchResult]:
+    resp = await tmdb_get(client, f"{api_url}/search/movie", params=params)
 
     resp_error_handling(resp)
 
@@ -125,33 +375,69 @@ def get_rating_from_release_dates(release_dates: ReleaseDates) -> str | None:
 
 
 async def get_movie_data(
-    tmdb_id: int, tmdb_api_url: str, tmdb_api_key: str
+    tmdb_id: int, tmdb_api_url: str, tmdb_api_key: str, client: httpx.AsyncClient
 ) -> tuple[TMDBMovieResult, str | None, list[str]]:
-    async with sem:
-        async with httpx.AsyncClient() as client:
-            resp = await client.get(
-                f"{tmdb_api_url}/movie/{tmdb_id}?api_key={tmdb_api_key}&append_to_response=release_dates"
-            )
+    resp = await fetch_movie(tmdb_id, tmdb_api_url, tmdb_api_key, client)
+    return parse_movie_data(resp.json())
+
+
+async def fetch_movie(
+    tmdb_id: int,
+    tmdb_api_url: str,
+    tmdb_api_key: str,
+    client: httpx.AsyncClient,
+    etag: str | None = None,
+) -> httpx.Response:
+    """Request the movie (with release_dates) from TMDB
+
+    If an etag is passed, the request is conditional and the response may be a
+    304 Not Modified without a body
+    """
+    return await single_flight.do(
+        ("movie", tmdb_api_url, tmdb_id, etag),
+        lambda: _fetch_movie(tmdb_id, tmdb_api_url, tmdb_api_key, client, etag),
+    )
+
+
+async def _fetch_movie(
+    tmdb_id: int,
+    tmdb_api_url: str,
+    tmdb_api_key: str,
+    client: httpx.AsyncClient,
+    etag: str | None,
+) -> httpx.Response:
+    headers = {"If-None-Match": etag} if etag else None
+    resp = await tmdb_get(
+        client,
+        f"{tmdb_api_url}/movie/{tmdb_id}",
+        params={"api_key": tmdb_api_key, "append_to_response": "release_dates"},
+        headers=headers,
+    )
+
+    if resp.status_code != 304:
+        resp_error_handling(resp)
+
+    return resp
+
+
+def parse_movie_data(tmdb_data: dict) -> tuple[TMDBMovieResult, str | None, list[str]]:
+    """Parse a TMDB movie response into our movie data, rating and genres"""
+    try:
+        movie_data = TMDBMovieResult(**tmdb_data)
+    except ValidationError:
+        logger.error("Error parsing tmdb movie data response for {}", tmdb_data)
+        raise HTTPException(500)
+    try:
+        release_dates = ReleaseDates(**tmdb_data.get("release_dates"))
+    except ValidationError:
+        logger.error(
+            "Error parsing tmdb release dates for {}",
+            tmdb_data.get("release_dates"),
+        )
+        raise HTTPException(500)
+    rating = get_rating_from_release_dates(release_dates)
+
+    genres_data = tmdb_data.get("genres")
+    genres = [g["name"] for g in genres_data]
 
-            resp_error_handling(resp)
-
-            tmdb_data = resp.json()
-            try:
-                movie_data = TMDBMovieResult(**tmdb_data)
-            except ValidationError:
-                logger.error("Error parsing tmdb movie data response for {}", tmdb_data)
-                raise HTTPException(500)
-            try:
-                release_dates = ReleaseDates(**tmdb_data.get("release_dates"))
-            except ValidationError:
-                logger.error(
-                    "Error parsing tmdb release dates for {}",
-                    tmdb_data.get("release_dates"),
-                )
-                raise HTTPException(500)
-            rating = get_rating_from_release_dates(release_dates)
-
-            genres_data = tmdb_data.get("genres")
-            genres = [g["name"] for g in genres_data]
-
-            return movie_data, rating, genres
+    return movie_data, rating, genres
@@ -0,0 +1,174 @@
+"""Local cache of TMDB movie responses, consulted before requesting TMDB"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import HTTPException
+from loguru import logger
+from sqlalchemy import inspect
+from sqlalchemy.future import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import db, metrics, tables
+from app.config import Settings
+from app.db_helpers import commit, insert
+from app.tmdb import fetch_movie
+
+
+def entry_age(entry: tables.TMDBCache) -> timedelta:
+    return datetime.utcnow() - entry.fetched_at
+
+
+async def get_entries(
+    session: AsyncSession, tmdb_ids: set[int]
+) -> dict[int, tables.TMDBCache]:
+    """Get the stored entries for the tmdb_ids, keyed by tmdb_id"""
+    if not tmdb_ids:
+        return {}
+
+    stmt = select(tables.TMDBCache).filter(tables.TMDBCache.tmdb_id.in_(tmdb_ids))
+    return {entry.tmdb_id: entry for entry in await session.scalars(stmt)}
+
+
+async def fetch_entry(
+    tmdb_id: int,
+    settings: Settings,
+    client: httpx.AsyncClient,
+    entry: tables.TMDBCache | None = None,
+) -> tables.TMDBCache:
+    """Request the movie from TMDB, returning a new or updated entry
+
+    If we already have an entry, the request is conditional on its etag, and when TMDB
+    reports the movie is not modified only the fetched_at time is updated.
+    If TMDB is down, the existing entry is returned unchanged (stale)
+    """
+    etag = entry.etag if entry else None
+    try:
+        resp = await fetch_movie(
+            tmdb_id, settings.tmdb_api_url, settings.tmdb_api_key, client, etag=etag
+        )
+    except HTTPException as exc:
+        if entry is None or exc.status_code < 500:
+            raise
+        logger.warning("Using stale tmdb_cache for {}, TMDB: {}", tmdb_id, exc.detail)
+        return entry
+
+    if entry is None:
+        entry = tables.TMDBCache(tmdb_id=tmdb_id, payload=resp.json())
+    elif resp.status_code != 304:
+        entry.payload = resp.json()
+
+    entry.fetched_at = datetime.utcnow()
+    entry.etag = resp.headers.get("etag", etag)
+    entry.last_modified = resp.headers.get("last-modified", entry.last_modified)
+    return entry
+
+
+async def store_entries(session: AsyncSession, entries: list[tables.TMDBCache]):
+    """Save the new and updated entries
+
+    New entries are upserted, as another request may have stored the same tmdb_id
+    since we looked for it
+    """
+    new = [entry for entry in entries if inspect(entry).transient]
+    session.add_all(entry for entry in entries if not inspect(entry).transient)
+    if new:
+        # the attributes, rather than entry.dict() which copies the payload
+        columns = ["tmdb_id", "payload", "fetched_at", "etag", "last_modified"]
+        stmt = insert(session, tables.TMDBCache).values(
+            [{column: getattr(entry, column) for column in columns} for entry in new]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["tmdb_id"],
+            set_={column: stmt.excluded[column] for column in columns[1:]},
+        )
+        await session.execute(stmt)
+    await commit(session)
+
+
+async def get_payloads(
+    session: AsyncSession,
+    tmdb_ids: set[int],
+    settings: Settings,
+    client: httpx.AsyncClient,
+) -> tuple[dict[int, dict], dict[int, HTTPException], set[int]]:
+    """Get the TMDB movie responses, from our database when we have them
+
+    Entries older than tmdb_cache_max_age (or missing) are requested from TMDB and
+    stored before returning.
+
+    Returns a dict of {tmdb_id: payload}, a dict of {tmdb_id: HTTPException} for the
+    tmdb_ids that couldn't be requested, and the set of tmdb_ids whose entries are
+    older than tmdb_cache_refresh_age, which should be refreshed in the background
+    """
+    max_age = timedelta(seconds=settings.tmdb_cache_max_age)
+    refresh_age = timedelta(seconds=settings.tmdb_cache_refresh_age)
+
+    entries = await get_entries(session, tmdb_ids)
+
+    to_fetch = [
+        tmdb_id
+        for tmdb_id in tmdb_ids
+        if tmdb_id not in entries or entry_age(entries[tmdb_id]) > max_age
+    ]
+    metrics.cache_hits.inc("tmdb_movie", amount=len(tmdb_ids) - len(to_fetch))
+    metrics.cache_misses.inc("tmdb_movie", amount=len(to_fetch))
+    results = await asyncio.gather(
+        *[
+            fetch_entry(tmdb_id, settings, client, entries.get(tmdb_id))
+            for tmdb_id in to_fetch
+        ],
+        return_exceptions=True,
+    )
+
+    # a failed request doesn't throw away the others
+    fetched = []
+    errors = {}
+    for tmdb_id, result in zip(to_fetch, results):
+        if isinstance(result, HTTPException):
+            errors[tmdb_id] = result
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            fetched.append(result)
+
+    if fetched:
+        await store_entries(session, fetched)
+        entries |= {entry.tmdb_id: entry for entry in fetched}
+
+    to_refresh = {
+        tmdb_id for tmdb_id, entry in entries.items() if entry_age(entry) > refresh_age
+    }
+
+    payloads = {
+        tmdb_id: entry.payload
+        for tmdb_id, entry in entries.items()
+        if tmdb_id not in errors
+    }
+    return payloads, errors, to_refresh
+
+
+async def refresh_entries(
+    tmdb_ids: set[int], settings: Settings, client: httpx.AsyncClient
+):
+    """Request the entries from TMDB again, run as a background task
+
+    Uses its own session, as the request's session is closed by the time this runs
+    """
+    async with db.async_session_factory() as session:
+        entries = await get_entries(session, tmdb_ids)
+        results = await asyncio.gather(
+            *[
+                fetch_entry(tmdb_id, settings, client, entry)
+                for tmdb_id, entry in entries.items()
+            ],
+            return_exceptions=True,
+        )
+        refreshed = []
+        for tmdb_id, result in zip(entries, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not refresh tmdb_cache for {}", tmdb_id)
+            else:
+                refreshed.append(result)
+        await store_entries(session, refreshed)
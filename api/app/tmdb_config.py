@@ -0,0 +1,133 @@
+"""The TMDB configuration (e.g. the base url and sizes of poster images)
+
+Requested without blocking startup or requests: the last configuration is stored in the
+tmdb_config table and loaded on startup, so the app starts (and serves it) even when TMDB
+is down, and a background task requests it again once it is older than
+tmdb_config_max_age. If there isn't one yet, the first request that needs it fetches it.
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+from fastapi import APIRouter, Depends
+from loguru import logger
+
+from app import db, tables, tmdb
+from app.config import Settings, get_settings
+from app.db_helpers import commit
+from app.tmdb import get_client, resp_error_handling, tmdb_get
+
+router = APIRouter()
+
+# the last configuration, and when it was fetched from TMDB
+configuration: dict | None = None
+fetched_at: datetime | None = None
+# created on app startup
+refresh_task: asyncio.Task | None = None
+
+
+async def fetch_configuration(settings: Settings, client: httpx.AsyncClient) -> dict:
+    """Request the configuration from TMDB
+
+    https://developers.themoviedb.org/3/configuration/get-api-configuration
+    """
+    resp = await tmdb_get(
+        client,
+        f"{settings.tmdb_api_url}/configuration",
+        params={"api_key": settings.tmdb_api_key},
+    )
+    resp_error_handling(resp)
+    return resp.json()
+
+
+async def refresh(settings: Settings, client: httpx.AsyncClient) -> dict:
+    """Request the configuration from TMDB, and store it"""
+    global configuration, fetched_at
+    payload = await fetch_configuration(settings, client)
+
+    async with db.async_session_factory() as session:
+        entry = await session.get(tables.TMDBConfig, 1)
+        if entry is None:
+            entry = tables.TMDBConfig(id=1, payload=payload)
+        else:
+            entry.payload = payload
+            entry.fetched_at = datetime.utcnow()
+        session.add(entry)
+        await commit(session)
+
+    configuration, fetched_at = entry.payload, entry.fetched_at
+    return configuration
+
+
+def age() -> timedelta | None:
+    if fetched_at is None:
+        return None
+    return datetime.utcnow() - fetched_at
+
+
+async def refresh_loop(settings: Settings, client: httpx.AsyncClient):
+    """Refresh the configuration whenever it is older than tmdb_config_max_age"""
+    max_age = timedelta(seconds=settings.tmdb_config_max_age)
+    while True:
+        current_age = age()
+        if current_age is not None and current_age < max_age:
+            await asyncio.sleep((max_age - current_age).total_seconds())
+            continue
+
+        try:
+            await tmdb.single_flight.do(
+                ("configuration",), lambda: refresh(settings, client)
+            )
+        except Exception as exc:
+            logger.warning(
+                "Couldn't refresh the TMDB configuration, retrying in {}s: {!r}",
+                settings.tmdb_config_retry_interval,
+                exc,
+            )
+            await asyncio.sleep(settings.tmdb_config_retry_interval)
+
+
+async def start(settings: Settings, client: httpx.AsyncClient):
+    """Load the stored configuration, and start refreshing it in the background"""
+    global configuration, fetched_at, refresh_task
+    if configuration is None:
+        async with db.async_session_factory() as session:
+            entry = await session.get(tables.TMDBConfig, 1)
+        if entry is not None:
+            configuration, fetched_at = entry.payload, entry.fetched_at
+
+    refresh_task = asyncio.create_task(refresh_loop(settings, client))
+
+
+async def stop():
+    global refresh_task
+    if refresh_task is not None:
+        refresh_task.cancel()
+        await asyncio.gather(refresh_task, return_exceptions=True)
+        refresh_task = None
+
+
+async def get_configuration(
+    settings: Settings = Depends(get_settings),
+    client: httpx.AsyncClient = Depends(get_client),
+) -> dict:
+    """dependency for returning the TMDB configuration
+
+    Requested from TMDB if we don't have one yet (concurrent requests share the call)
+    """
+    if configuration is not None:
+        return configuration
+
+    return await tmdb.single_flight.do(
+        ("configuration",), lambda: refresh(settings, client)
+    )
+
+
+@router.get("/tmdb/configuration")
+async def read_tmdb_configuration(
+    tmdb_configuration: dict = Depends(get_configuration),
+):
+    """The TMDB configuration, e.g. images.secure_base_url and images.poster_sizes for
+    building the urls of posters, without the client needing a TMDB api key"""
+    return tmdb_configuration
@@ -0,0 +1,143 @@
+"""Versions of movies and of the catalog, for conditional GETs
+
+A movie's version is its created_at and updated_at. The catalog's version is a counter,
+incremented by triggers on every change to the movie and genremovielink tables, so that
+a list of movies can be revalidated without querying it.
+
+The counter is the catalog_version row, updated in the writing transaction, so that the
+catalog isn't read at a new version before its changes are visible. On postgres the
+update would lock the row until the transaction commits, making concurrent writes wait
+on each other, so the triggers are deferred: the row is updated once per transaction,
+as it commits, and only locked while it does.
+
+modified_at is naive UTC, as the other timestamps (see as_utc).
+"""
+
+import zlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.future import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import tables
+
+# tables whose changes change the catalog
+VERSIONED_TABLES = ["movie", "genremovielink"]
+
+CATALOG_VERSION_INSERT = """
+    INSERT INTO catalog_version (id, version, modified_at)
+    VALUES (1, 0, :modified_at)
+    ON CONFLICT (id) DO NOTHING
+"""
+
+# sqlite only has triggers for each row. CURRENT_TIMESTAMP is to the second, %f is to
+# the millisecond, padded to the microseconds sqlalchemy expects
+SQLITE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS catalog_version_{table}_{event} AFTER {event} ON {table}
+    BEGIN
+        UPDATE catalog_version
+        SET version = version + 1,
+            modified_at = strftime('%Y-%m-%d %H:%M:%f000', 'now')
+        WHERE id = 1;
+    END
+"""
+
+POSTGRES_FUNCTION = """
+    CREATE OR REPLACE FUNCTION increment_catalog_version() RETURNS trigger AS $$
+    BEGIN
+        IF current_setting('catalog_version.incremented', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        PERFORM set_config('catalog_version.incremented', 'on', true);
+        UPDATE catalog_version
+        SET version = version + 1,
+            modified_at = clock_timestamp() AT TIME ZONE 'UTC'
+        WHERE id = 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+# constraint triggers, which can be deferred, are only for each row, the function
+# increments the version for the first row of the transaction
+POSTGRES_TRIGGER = """
+    CREATE CONSTRAINT TRIGGER catalog_version_{table}
+    AFTER INSERT OR UPDATE OR DELETE ON {table}
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION increment_catalog_version()
+"""
+
+
+def create_version_triggers(conn: Connection):
+    """Create the catalog_version row, and the triggers that increment it"""
+    conn.execute(text(CATALOG_VERSION_INSERT), {"modified_at": datetime.utcnow()})
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(POSTGRES_FUNCTION))
+        for table in VERSIONED_TABLES:
+            conn.execute(
+                text(f"DROP TRIGGER IF EXISTS catalog_version_{table} ON {table}")
+            )
+            conn.execute(text(POSTGRES_TRIGGER.format(table=table)))
+        return
+
+    for table in VERSIONED_TABLES:
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            conn.execute(text(SQLITE_TRIGGER.format(table=table, event=event)))
+
+
+def as_utc(value: datetime) -> datetime:
+    """sqlite returns naive datetimes, which are in UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def movie_etag(movie_id: int, created_at: datetime, updated_at: datetime | None) -> str:
+    modified_at = as_utc(updated_at or created_at)
+    return f'"movie-{movie_id}-{int(modified_at.timestamp() * 1_000_000)}"'
+
+
+async def get_catalog_version(session: AsyncSession) -> tables.CatalogVersion:
+    return (await session.scalars(select(tables.CatalogVersion))).one()
+
+
+def catalog_etag(catalog_version: tables.CatalogVersion, query: str) -> str:
+    """The query string is included, as each page or filter is a different list"""
+    return f'"catalog-{catalog_version.version}-{zlib.crc32(query.encode()):x}"'
+
+
+def cache_headers(etag: str, last_modified: datetime) -> dict[str, str]:
+    return {
+        "ETag": etag,
+        "Last-Modified": format_datetime(as_utc(last_modified), usegmt=True),
+        # clients can store the response, but have to revalidate it before using it
+        "Cache-Control": "no-cache",
+    }
+
+
+def not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Whether the client's copy is current, from the conditional request headers
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 9110
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+        return "*" in etags or etag in etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            return False
+        # http dates are to the second
+        return as_utc(last_modified).replace(microsecond=0) <= since
+
+    return False
@@ -0,0 +1,109 @@
+"""A local stand-in for TMDB, serving the tests/test_data movies, for benchmarks
+
+Every tmdb id is a movie: one of the test data movies with that id and a unique title.
+Searches return a page of results made from the same movies. Responses are delayed by
+--latency seconds (+/- --jitter), and a fraction (--error-rate) are 503 errors.
+
+Run from the api directory: python -m benchmarks.fake_tmdb --port 8001
+and point the app at it with TMDB_API_URL=http://127.0.0.1:8001/3
+"""
+
+import argparse
+import asyncio
+import json
+import pathlib
+import random
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+TEST_DATA = pathlib.Path(__file__).parent.parent / "tests" / "test_data"
+SEARCH_PAGE_SIZE = 20
+
+CONFIGURATION = {
+    "images": {
+        "base_url": "http://image.tmdb.org/t/p/",
+        "secure_base_url": "https://image.tmdb.org/t/p/",
+        "poster_sizes": ["w92", "w154", "w185", "w342", "w500", "w780", "original"],
+    }
+}
+
+
+def load_movies() -> list[dict]:
+    return [
+        json.loads(path.read_text()) for path in sorted(TEST_DATA.glob("[0-9]*.json"))
+    ]
+
+
+def create_app(latency: float, jitter: float, error_rate: float) -> Starlette:
+    movies = load_movies()
+
+    async def upstream():
+        """Wait like TMDB would, returning an error response if one is injected"""
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+        if random.random() < error_rate:
+            return JSONResponse(
+                {"success": False, "status_message": "Injected error"}, status_code=503
+            )
+        return None
+
+    async def configuration(request: Request):
+        return await upstream() or JSONResponse(CONFIGURATION)
+
+    async def movie(request: Request):
+        tmdb_id = request.path_params["tmdb_id"]
+        data = movies[tmdb_id % len(movies)] | {
+            "id": tmdb_id,
+            "title": f"Movie {tmdb_id}",
+        }
+        return await upstream() or JSONResponse(data)
+
+    async def search(request: Request):
+        query = request.query_params.get("query", "")
+        page = int(request.query_params.get("page", 1))
+        results = [
+            {
+                "id": page * SEARCH_PAGE_SIZE + i,
+                "title": f"{query} {i}",
+                "overview": data["overview"],
+                "release_date": data["release_date"],
+                "poster_path": data["poster_path"],
+                "genre_ids": [genre["id"] for genre in data["genres"]],
+            }
+            for i, data in enumerate(
+                movies[i % len(movies)] for i in range(SEARCH_PAGE_SIZE)
+            )
+        ]
+        return await upstream() or JSONResponse(
+            {"page": page, "results": results, "total_pages": 10}
+        )
+
+    return Starlette(
+        routes=[
+            Route("/3/configuration", configuration),
+            Route("/3/movie/{tmdb_id:int}", movie),
+            Route("/3/search/movie", search),
+        ]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="seconds")
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="fraction of 503 responses"
+    )
+    args = parser.parse_args()
+
+    app = create_app(args.latency, args.jitter, args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
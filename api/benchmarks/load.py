@@ -0,0 +1,292 @@
+"""Latency percentiles and throughput of the main workloads, against a local fake TMDB
+
+Boots the app with uvicorn, on a synthetic catalog of each --sizes, with TMDB replaced by
+benchmarks.fake_tmdb (with --tmdb-latency and --tmdb-error-rate), then sends each
+workload from --concurrency clients for --duration seconds:
+
+- search: GET /search_movies/, from a vocabulary of --search-queries queries
+- import: POST /tmdb_movie/ with --import-batch new tmdb_ids
+- list: GET /movies/
+- read: GET /movie/{id}
+- random: GET /movies/random
+
+Results can be saved as a baseline, and later runs compared with it, flagging the
+workloads whose p95 latency rose, or throughput fell, by more than --threshold:
+
+    python -m benchmarks.load --save-baseline baseline.json
+    python -m benchmarks.load --compare baseline.json
+
+Baselines are only comparable when run on the same machine, with the same arguments.
+
+Run from the api directory: python -m benchmarks.load
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+
+import httpx
+from loguru import logger
+
+from app import db
+from app.config import DatabaseSettings
+from benchmarks.random_draw import percentile, seed_catalog
+
+API_DIR = pathlib.Path(__file__).parent.parent
+WORKLOADS = ["search", "import", "list", "read", "random"]
+
+# method, url and keyword arguments for httpx
+Request = tuple[str, str, dict]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(args: list[str], env: dict[str, str], log_path: pathlib.Path):
+    with open(log_path, "wb") as log:
+        return subprocess.Popen(
+            [sys.executable, "-m", *args],
+            cwd=API_DIR,
+            env=os.environ | env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+
+
+async def wait_until_up(url: str, process: subprocess.Popen, log_path: pathlib.Path):
+    async with httpx.AsyncClient() as client:
+        for _ in range(600):
+            if process.poll() is not None:
+                sys.exit(f"{url} exited, see {log_path}:\n{log_path.read_text()}")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    sys.exit(f"{url} didn't start, see {log_path}")
+
+
+async def create_catalog(database_url: str, size: int):
+    db.engine = db.create_engine(DatabaseSettings(database_url=database_url))
+    await db.create_db_and_tables()
+    await seed_catalog(size)
+    await db.engine.dispose()
+
+
+def workload_requests(args, size: int) -> dict[str, Callable[[], Request]]:
+    queries = [f"query {i}" for i in range(args.search_queries)]
+    tmdb_ids = itertools.count(1)
+    return {
+        "search": lambda: (
+            "GET",
+            "/search_movies/",
+            {"params": {"query": random.choice(queries)}},
+        ),
+        "import": lambda: (
+            "POST",
+            "/tmdb_movie/",
+            {"json": {"tmdb_ids": [next(tmdb_ids) for _ in range(args.import_batch)]}},
+        ),
+        "list": lambda: ("GET", "/movies/", {"params": {"limit": args.list_limit}}),
+        "read": lambda: ("GET", f"/movie/{random.randint(1, size)}", {}),
+        "random": lambda: ("GET", "/movies/random", {"params": {"n": 5}}),
+    }
+
+
+async def run_workload(
+    client: httpx.AsyncClient,
+    next_request: Callable[[], Request],
+    duration: float,
+    concurrency: int,
+) -> dict:
+    timings = []
+    errors = 0
+
+    async def send(end: float):
+        nonlocal errors
+        while time.perf_counter() < end:
+            method, url, kwargs = next_request()
+            start = time.perf_counter()
+            resp = await client.request(method, url, **kwargs)
+            timings.append(time.perf_counter() - start)
+            if not resp.is_success:
+                errors += 1
+
+    # warm up (connections, caches) before measuring
+    await asyncio.gather(*[send(time.perf_counter() + 1) for _ in range(concurrency)])
+    timings.clear()
+    errors = 0
+
+    start = time.perf_counter()
+    await asyncio.gather(*[send(start + duration) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(timings),
+        "errors": errors,
+        "rps": len(timings) / elapsed,
+        "p50": percentile(timings, 50),
+        "p95": percentile(timings, 95),
+        "p99": percentile(timings, 99),
+    }
+
+
+async def run(args, size: int) -> dict[str, dict]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+        database_url = f"sqlite+aiosqlite:///{tmp_path}/database.sqlite"
+        await create_catalog(database_url, size)
+
+        tmdb_port, app_port = free_port(), free_port()
+        fake_tmdb = start_process(
+            [
+                "benchmarks.fake_tmdb",
+                f"--port={tmdb_port}",
+                f"--latency={args.tmdb_latency}",
+                f"--error-rate={args.tmdb_error_rate}",
+            ],
+            {},
+            tmp_path / "fake_tmdb.log",
+        )
+        env = {
+            "DATABASE_URL": database_url,
+            "TMDB_API_URL": f"http://127.0.0.1:{tmdb_port}/3",
+            "TMDB_API_TOKEN": "BENCHMARK",
+            # the fake TMDB doesn't limit us, measure the app instead
+            "TMDB_RATE_LIMIT": "100000",
+            "TMDB_RATE_LIMIT_BURST": "100000",
+        } | dict(setting.split("=", 1) for setting in args.app_env)
+        app = start_process(
+            [
+                "uvicorn",
+                "app.api:app",
+                f"--port={app_port}",
+                "--log-level=warning",
+                "--no-access-log",
+            ],
+            env,
+            tmp_path / "app.log",
+        )
+        try:
+            await wait_until_up(
+                f"http://127.0.0.1:{tmdb_port}/", fake_tmdb, tmp_path / "fake_tmdb.log"
+            )
+            await wait_until_up(
+                f"http://127.0.0.1:{app_port}/", app, tmp_path / "app.log"
+            )
+
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{app_port}", limits=limits, timeout=None
+            ) as client:
+                requests = workload_requests(args, size)
+                return {
+                    name: await run_workload(
+                        client, requests[name], args.duration, args.concurrency
+                    )
+                    for name in args.workloads
+                }
+        finally:
+            for process in [app, fake_tmdb]:
+                process.terminate()
+                process.wait()
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """The workloads which regressed compared with the baseline"""
+    regressions = []
+    for size, workloads in results.items():
+        for name, result in workloads.items():
+            base = baseline.get(size, {}).get(name)
+            if base is None:
+                continue
+            p95_change = result["p95"] / base["p95"] - 1
+            rps_change = result["rps"] / base["rps"] - 1
+            flagged = p95_change > threshold or rps_change < -threshold
+            print(
+                f"{size:>10} {name:>8}: p95 {p95_change:+7.1%} rps {rps_change:+7.1%}"
+                + ("  REGRESSION" if flagged else "")
+            )
+            if flagged:
+                regressions.append(f"{size} {name}")
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 100_000],
+        help="numbers of movies in the catalog, e.g. up to 1000000",
+    )
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument("--duration", type=float, default=10, help="seconds each")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--tmdb-latency", type=float, default=0.05, help="seconds")
+    parser.add_argument(
+        "--tmdb-error-rate", type=float, default=0, help="fraction of 503 responses"
+    )
+    parser.add_argument("--search-queries", type=int, default=200)
+    parser.add_argument("--import-batch", type=int, default=10)
+    parser.add_argument("--list-limit", type=int, default=50)
+    parser.add_argument(
+        "--app-env",
+        nargs="*",
+        default=[],
+        metavar="NAME=VALUE",
+        help="settings for the app, e.g. API_ORJSON=true",
+    )
+    parser.add_argument("--save-baseline", type=pathlib.Path)
+    parser.add_argument("--compare", type=pathlib.Path, help="a saved baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=0.1, help="regression, e.g. 0.1 is 10%%"
+    )
+    args = parser.parse_args()
+
+    logger.remove()
+
+    print(
+        f"{'movies':>10} {'workload':>8} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9}"
+        f" {'p99 ms':>9} {'errors':>7}"
+    )
+    results = {}
+    for size in args.sizes:
+        results[str(size)] = await run(args, size)
+        for name, result in results[str(size)].items():
+            print(
+                f"{size:>10} {name:>8} {result['rps']:9.1f} {result['p50']:9.2f}"
+                f" {result['p95']:9.2f} {result['p99']:9.2f} {result['errors']:7}"
+            )
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(results, indent=2))
+        print(f"saved the baseline to {args.save_baseline}")
+
+    if args.compare:
+        print(f"compared with {args.compare}:")
+        regressions = compare(
+            results, json.loads(args.compare.read_text()), args.threshold
+        )
+        if regressions:
+            sys.exit(f"regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
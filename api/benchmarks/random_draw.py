@@ -0,0 +1,130 @@
+"""Latency of drawing movies from /movies/random as the catalog grows
+
+Compares the endpoint, which seeks to random ids, with ORDER BY random(), which reads
+every movie. The draw latency should stay flat from thousands to millions of movies.
+
+Run from the api directory: python -m benchmarks.random_draw
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+import httpx
+from loguru import logger
+from sqlalchemy import func, insert
+from sqlalchemy.future import select
+
+from app import api, db, tables
+from app.config import DatabaseSettings
+
+INSERT_BATCH_SIZE = 50_000
+GENRES = ["Comedy", "Drama", "Horror"]
+
+
+async def seed_catalog(size: int):
+    """size movies, each with one of the GENRES"""
+    start = date(1900, 1, 1)
+    async with db.engine.begin() as conn:
+        await conn.execute(insert(tables.Genre), [{"name": name} for name in GENRES])
+        for offset in range(0, size, INSERT_BATCH_SIZE):
+            ids = range(offset + 1, min(size, offset + INSERT_BATCH_SIZE) + 1)
+            await conn.execute(
+                insert(tables.Movie),
+                [
+                    {
+                        "id": i,
+                        "title": f"Movie {i}",
+                        "release_date": start + timedelta(days=i % 40_000),
+                        "runtime": 60 + i % 120,
+                        "rating": "PG" if i % 2 else "R",
+                    }
+                    for i in ids
+                ],
+            )
+            await conn.execute(
+                insert(tables.GenreMovieLink),
+                [{"movie_id": i, "genre_id": i % len(GENRES) + 1} for i in ids],
+            )
+
+
+def percentile(timings: list[float], q: int) -> float:
+    return statistics.quantiles(timings, n=100)[q - 1] * 1000
+
+
+async def run(size: int, draws: int, n: int, baseline_draws: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings = DatabaseSettings(
+            database_url=f"sqlite+aiosqlite:///{tmp_dir}/database.sqlite"
+        )
+        db.engine = db.create_engine(settings)
+        db.async_session_factory.configure(bind=db.engine)
+        await api.on_startup()
+        await seed_catalog(size)
+
+        timings: dict[str, list[float]] = {"random": [], "filtered": [], "baseline": []}
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=None
+        ) as client:
+            queries = {
+                "random": {"n": n},
+                "filtered": {"n": n, "genre": "Drama", "rating": "R"},
+            }
+            for name, params in queries.items():
+                for _ in range(draws):
+                    start = time.perf_counter()
+                    resp = await client.get("/movies/random", params=params)
+                    timings[name].append(time.perf_counter() - start)
+                    assert len(resp.json()) == n, resp.json()
+
+        async with db.async_session_factory() as session:
+            stmt = select(tables.Movie).order_by(func.random()).limit(n)
+            for _ in range(baseline_draws):
+                start = time.perf_counter()
+                (await session.scalars(stmt)).all()
+                timings["baseline"].append(time.perf_counter() - start)
+
+        await api.on_shutdown()
+        await db.engine.dispose()
+
+    return {
+        name: (percentile(values, 50), percentile(values, 95))
+        for name, values in timings.items()
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1_000, 10_000, 100_000, 1_000_000],
+        help="numbers of movies in the catalog",
+    )
+    parser.add_argument("--draws", type=int, default=200, help="draws per size")
+    parser.add_argument("-n", type=int, default=5, help="movies per draw")
+    parser.add_argument(
+        "--baseline-draws", type=int, default=10, help="ORDER BY random() draws"
+    )
+    args = parser.parse_args()
+
+    os.environ.setdefault("TMDB_API_TOKEN", "BENCHMARK")
+    logger.remove()
+
+    print(f"{'movies':>10} {'draw p50/p95 ms':>18} {'filtered':>18} {'baseline':>18}")
+    for size in args.sizes:
+        result = await run(size, args.draws, args.n, args.baseline_draws)
+        print(
+            f"{size:>10}",
+            *(f"{p50:8.2f} / {p95:7.2f}" for p50, p95 in result.values()),
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
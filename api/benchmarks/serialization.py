@@ -0,0 +1,97 @@
+"""Cost per movie of serializing a page of /movies/
+
+Compares FastAPI's default path (validating the ORM objects through the response
+model, then encoding with the standard library json) with API_ORJSON (building the
+dicts directly, see app/serializers.py, and encoding with orjson).
+
+Run from the api directory: python -m benchmarks.serialization
+"""
+
+import argparse
+import asyncio
+import os
+import timeit
+from datetime import date, datetime, timedelta
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import APIRoute, serialize_response
+from loguru import logger
+
+from app import api, serializers, tables
+
+
+def make_movies(count: int, genres_per_movie: int) -> list[tables.Movie]:
+    genres = [
+        tables.Genre(id=i, name=f"Genre {i}") for i in range(1, genres_per_movie + 1)
+    ]
+    return [
+        tables.Movie(
+            id=i,
+            title=f"Movie {i}",
+            release_date=date(2000, 1, 1) + timedelta(days=i),
+            runtime=90 + i % 60,
+            tmdb_id=i,
+            imdb_id=f"tt{i:07d}",
+            poster=f"/{i}.jpg",
+            overview="A movie about something, and then something else happens. " * 3,
+            rating="PG-13",
+            created_at=datetime(2023, 1, 1, 12, 0, 0),
+            updated_at=datetime(2023, 6, 1, 12, 0, 0, 123456),
+            genres=genres,
+        )
+        for i in range(count)
+    ]
+
+
+def list_movies_route() -> APIRoute:
+    return next(
+        route
+        for route in api.app.routes
+        if isinstance(route, APIRoute) and route.name == "list_movies"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--movies", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--genres", type=int, default=3, help="genres per movie")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ.setdefault("TMDB_API_TOKEN", "BENCHMARK")
+    logger.remove()
+    field = list_movies_route().response_field
+    loop = asyncio.new_event_loop()
+
+    for count in args.movies:
+        movies = make_movies(count, args.genres)
+        content = {"movies": movies, "next_cursor": None}
+
+        def default():
+            value = loop.run_until_complete(
+                serialize_response(field=field, response_content=content)
+            )
+            return JSONResponse(value).body
+
+        def fast():
+            return ORJSONResponse(
+                {
+                    "movies": [serializers.movie_dict(movie) for movie in movies],
+                    "next_cursor": None,
+                }
+            ).body
+
+        results = {}
+        for name, fn in [("default", default), ("orjson", fast)]:
+            seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            results[name] = seconds / count * 1_000_000
+        print(
+            f"{count:>5} movies: default {results['default']:7.2f} us/movie, "
+            f"orjson {results['orjson']:6.2f} us/movie "
+            f"({results['default'] / results['orjson']:.1f}x)"
+        )
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
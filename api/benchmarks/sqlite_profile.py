@@ -0,0 +1,134 @@
+"""Read throughput of /movies/ while /tmdb_movie/ imports are running
+
+Compares the default sqlite settings with the performance profile
+(DATABASE_SQLITE_PERFORMANCE), with TMDB mocked so that only the database is measured.
+
+Run from the api directory: python -m benchmarks.sqlite_profile
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+import httpx
+import respx
+from loguru import logger
+from respx.patterns import M
+
+from app import api, config, db
+from app.config import DatabaseSettings
+
+TEST_DATA = pathlib.Path(__file__).parent.parent / "tests" / "test_data"
+
+
+def mock_tmdb(respx_mock: respx.MockRouter):
+    """Every tmdb id is a copy of the fight club data, with a unique title"""
+    movie_data = json.loads((TEST_DATA / "550.json").read_text())
+
+    def movie(request, tmdb_id):
+        data = movie_data | {"id": int(tmdb_id), "title": f"Movie {tmdb_id}"}
+        return httpx.Response(200, json=data)
+
+    respx_mock.get(f"{config.TMDB_API_URL}/configuration").mock(
+        return_value=httpx.Response(
+            200, json={"images": {"secure_base_url": "https://image.tmdb.org/t/p/"}}
+        )
+    )
+    respx_mock.route(
+        M(url__regex=rf"{config.TMDB_API_URL}/movie/(?P<tmdb_id>\d+)")
+    ).mock(side_effect=movie)
+
+
+async def run(
+    performance: bool,
+    duration: float,
+    readers: int,
+    writers: int,
+    seed: int,
+    limit: int,
+) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        settings = DatabaseSettings(
+            database_url=f"sqlite+aiosqlite:///{tmp_dir}/database.sqlite",
+            database_sqlite_performance=performance,
+        )
+        db.engine = db.create_engine(settings)
+        db.async_session_factory.configure(bind=db.engine)
+        await api.on_startup()
+
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test", timeout=None
+        ) as client:
+            # seed the catalog
+            lines = "\n".join(
+                json.dumps({"title": f"Seed {i}", "release_date": "2000-01-01"})
+                for i in range(seed)
+            )
+            await client.post("/movies/import", content=lines)
+
+            tmdb_ids = itertools.count(1)
+            counts = {"reads": 0, "writes": 0, "errors": 0}
+            end = time.perf_counter() + duration
+
+            async def read():
+                while time.perf_counter() < end:
+                    resp = await client.get("/movies/", params={"limit": limit})
+                    counts["reads" if resp.is_success else "errors"] += 1
+
+            async def write():
+                while time.perf_counter() < end:
+                    ids = [next(tmdb_ids) for _ in range(20)]
+                    resp = await client.post("/tmdb_movie/", json={"tmdb_ids": ids})
+                    counts["writes" if resp.is_success else "errors"] += 1
+
+            await asyncio.gather(
+                *[read() for _ in range(readers)], *[write() for _ in range(writers)]
+            )
+
+        await api.on_shutdown()
+        await db.engine.dispose()
+
+    return {key: value / duration for key, value in counts.items()}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--duration", type=float, default=10, help="seconds per run")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1000, help="movies to start with")
+    parser.add_argument("--limit", type=int, default=10, help="movies per read")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TMDB_API_TOKEN", "BENCHMARK")
+    # TMDB is mocked, don't let the rate limiter cap the writes
+    os.environ["TMDB_RATE_LIMIT"] = "100000"
+    os.environ["TMDB_RATE_LIMIT_BURST"] = "100000"
+    logger.remove()
+
+    with respx.mock(assert_all_called=False) as respx_mock:
+        mock_tmdb(respx_mock)
+        for performance in [False, True]:
+            result = await run(
+                performance,
+                args.duration,
+                args.readers,
+                args.writers,
+                args.seed,
+                args.limit,
+            )
+            print(
+                f"performance profile {'on ' if performance else 'off'}: "
+                f"{result['reads']:8.1f} reads/s {result['writes']:8.1f} writes/s "
+                f"{result['errors']:6.1f} errors/s"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,20 @@
-from datetime import date, datetime
+import csv
+import io
+import json
+import pathlib
+from datetime import date, datetime, timedelta
 
 import httpx
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy.future import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app import config
-from app.movies import TMDBSearchResult
-from app.tables import Genre, Movie, MovieRead
+from app import movies as movies_module
+from app import tmdb, versioning
+from app.movies import TMDBMovieResult, TMDBSearchResult
+from app.tables import Genre, ImportSummary, Movie, MovieRead, TMDBMovieStatus
 
 DUDE_DATA = {
     "title": "The Big Lebowski",
@@ -35,6 +42,32 @@ async def dude_movie(session: AsyncSession):
     yield movie
 
 
+@pytest.fixture
+async def movies(session: AsyncSession):
+    """Movies with some sharing a release date, and some sharing a title"""
+    comedy, drama = Genre(name="Comedy"), Genre(name="Drama")
+    movies_data = [
+        ("Alpha", date(2001, 5, 1), 90, "PG", [comedy]),
+        ("Bravo", date(2001, 5, 1), 120, "R", [drama]),
+        ("Charlie", date(1999, 1, 1), 100, "R", [comedy, drama]),
+        ("Alpha", date(2010, 2, 3), 140, "PG-13", []),
+        ("Delta", date(2001, 12, 31), 80, "R", [comedy]),
+    ]
+    movies = [
+        Movie(
+            title=title,
+            release_date=release_date,
+            runtime=runtime,
+            rating=rating,
+            genres=genres,
+        )
+        for title, release_date, runtime, rating, genres in movies_data
+    ]
+    session.add_all(movies)
+    await session.commit()
+    yield movies
+
+
 def test_create_movie(client: TestClient):
     # takes FORM data
     resp = client.post("/movie/", json={"movie": DUDE_DATA})
@@ -139,6 +172,80 @@ async def test_read_movie(client: TestClient, dude_movie: Movie):
     assert data["updated_at"] is None
 
 
+async def test_read_movie_not_modified(
+    client: TestClient, dude_movie: Movie, statements: list[str]
+):
+    resp = client.get(f"/movie/{dude_movie.id}")
+    assert resp.status_code == 200
+    etag = resp.headers["etag"]
+    last_modified = resp.headers["last-modified"]
+
+    statements.clear()
+    resp = client.get(f"/movie/{dude_movie.id}", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["etag"] == etag
+    assert resp.content == b""
+    # only the movie's version is queried
+    assert len(statements) == 1
+
+    resp = client.get(
+        f"/movie/{dude_movie.id}", headers={"If-Modified-Since": last_modified}
+    )
+    assert resp.status_code == 304
+
+    resp = client.get(f"/movie/{dude_movie.id}", headers={"If-None-Match": '"other"'})
+    assert resp.status_code == 200
+    assert resp.json()["title"] == DUDE_DATA["title"]
+
+    resp = client.get(
+        f"/movie/{dude_movie.id}",
+        headers={"If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT"},
+    )
+    assert resp.status_code == 200
+
+
+async def test_read_movie_etag_changes(client: TestClient, dude_movie: Movie):
+    etags = [client.get(f"/movie/{dude_movie.id}").headers["etag"]]
+
+    resp = client.patch(
+        f"/movie/{dude_movie.id}", json={"movie": {"title": "The Dude"}}
+    )
+    assert resp.status_code == 200, resp.json()
+    etags.append(client.get(f"/movie/{dude_movie.id}").headers["etag"])
+
+    # changing only the genres changes the version too
+    resp = client.patch(f"/movie/{dude_movie.id}", json={"genres": ["90s"]})
+    assert resp.status_code == 200, resp.json()
+    resp = client.get(f"/movie/{dude_movie.id}", headers={"If-None-Match": etags[-1]})
+    assert resp.status_code == 200
+    etags.append(resp.headers["etag"])
+
+    assert len(set(etags)) == 3
+
+
+async def test_catalog_version_modified_at(
+    client: TestClient, session: AsyncSession, dude_movie: Movie
+):
+    """Writes within the same second are ordered by modified_at"""
+    before = (await versioning.get_catalog_version(session)).copy()
+    resp = client.patch(
+        f"/movie/{dude_movie.id}", json={"movie": {"title": "The Dude"}}
+    )
+    assert resp.status_code == 200, resp.json()
+    # a new transaction, to see the write
+    await session.rollback()
+    after = await versioning.get_catalog_version(session)
+
+    assert after.version > before.version
+    assert after.modified_at > before.modified_at
+    assert after.modified_at - before.modified_at < timedelta(seconds=1)
+
+
+def test_read_movie_not_found(client: TestClient):
+    resp = client.get("/movie/1", headers={"If-None-Match": "*"})
+    assert resp.status_code == 404
+
+
 async def test_update_movie(client: TestClient, dude_movie: Movie):
     resp = client.patch(
         f"/movie/{dude_movie.id}", json={"movie": {"title": "The Dude"}}
@@ -195,16 +302,30 @@ async def test_delete_movie(
     assert movie_in_db is None
 
 
-def test_search_movies(client: TestClient, mocked_TMDB, mocked_TMDB_config_req):
+def test_search_movies(client: TestClient, mocked_TMDB):
     resp = client.get("/search_movies/", params={"query": "big"})
     assert resp.status_code == 200, resp.json()
     for result_dict in resp.json():
         TMDBSearchResult.parse_obj(result_dict)
 
 
-def test_search_movies_not_found(
-    client: TestClient, respx_mock, mocked_TMDB_config_req
-):
+def test_search_movies_cached(client: TestClient, mocked_TMDB):
+    resp = client.get("/search_movies/", params={"query": "big"})
+    assert resp.status_code == 200, resp.json()
+
+    # the same search, normalized, doesn't call TMDB again
+    resp_cached = client.get("/search_movies/", params={"query": " BIG "})
+    assert resp_cached.status_code == 200, resp_cached.json()
+    assert resp_cached.json() == resp.json()
+    assert mocked_TMDB["search_tmdb_movies"].call_count == 1
+
+    # a different page is a different search
+    resp = client.get("/search_movies/", params={"query": "big", "page": 2})
+    assert resp.status_code == 200, resp.json()
+    assert mocked_TMDB["search_tmdb_movies"].call_count == 2
+
+
+def test_search_movies_not_found(client: TestClient, respx_mock):
     tmdb_route = respx_mock.get(
         f"{config.TMDB_API_URL}/search/movie", name="search_tmdb_movies"
     )
@@ -214,9 +335,7 @@ def test_search_movies_not_found(
     assert resp.json() == {"detail": "Bad search params"}
 
 
-def test_search_movies_tmdb_down(
-    client: TestClient, respx_mock, mocked_TMDB_config_req
-):
+def test_search_movies_tmdb_down(client: TestClient, respx_mock):
     tmdb_route = respx_mock.get(
         f"{config.TMDB_API_URL}/search/movie", name="search_tmdb_movies"
     )
@@ -226,21 +345,38 @@ def test_search_movies_tmdb_down(
     assert resp.json() == {"detail": "Gateway Timeout"}
 
 
-def test_create_from_tmdb(
-    client: TestClient, mocked_TMDB_movie_results, mocked_TMDB_config_req
-):
+def test_search_movies_tmdb_down_stale(client: TestClient, respx_mock, monkeypatch):
+    tmdb_route = respx_mock.get(
+        f"{config.TMDB_API_URL}/search/movie", name="search_tmdb_movies"
+    )
+    # results expire as soon as they are cached
+    monkeypatch.setattr(tmdb.search_cache, "ttl", 0)
+    tmdb_route.return_value = httpx.Response(200, json={"results": []})
+    resp = client.get("/search_movies/", params={"query": "big"})
+    assert resp.status_code == 200, resp.json()
+
+    # the expired results are served while TMDB is down
+    tmdb_route.return_value = httpx.Response(500)
+    resp = client.get("/search_movies/", params={"query": "big"})
+    assert resp.status_code == 200, resp.json()
+    assert resp.json() == []
+    # the second search is a single miss, not also a hit of the stale results
+    assert tmdb.search_cache.stats() == {"hits": 0, "misses": 2, "evictions": 0}
+
+
+def test_create_from_tmdb(client: TestClient, mocked_TMDB_movie_results):
     resp = client.post("/tmdb_movie", json={"tmdb_ids": [DUDE_DATA["tmdb_id"]]})
     assert resp.status_code == 200, resp.json()
-    created_movie = resp.json()[str(DUDE_DATA["tmdb_id"])]
+    outcome = resp.json()[str(DUDE_DATA["tmdb_id"])]
+    assert outcome["status"] == "created"
+    created_movie = outcome["movie"]
     assert created_movie["title"] == DUDE_DATA["title"]
     assert created_movie["runtime"] == DUDE_DATA["runtime"]
     assert created_movie["updated_at"] is None
     assert [g["name"] for g in created_movie["genres"]] == DUDE_GENRES_DATA
 
 
-def test_create_mult_from_tmdb(
-    client: TestClient, mocked_TMDB_movie_results, mocked_TMDB_config_req
-):
+def test_create_mult_from_tmdb(client: TestClient, mocked_TMDB_movie_results):
     resp = client.post("/tmdb_movie", json={"tmdb_ids": [115, 550]})
     assert resp.status_code == 200, resp.json()
 
@@ -248,30 +384,483 @@ def test_create_mult_from_tmdb(
     assert len(resp_data) == 2
 
 
-def test_create_mult_from_tmdb_order(
-    client: TestClient, mocked_TMDB_movie_results, mocked_TMDB_config_req
-):
+def test_create_mult_from_tmdb_order(client: TestClient, mocked_TMDB_movie_results):
     ids_sent = [115, 550]
     resp = client.post("/tmdb_movie", json={"tmdb_ids": ids_sent})
     assert resp.status_code == 200, resp.json()
-    ids_returned = [m["tmdb_id"] for _, m in resp.json().items()]
+    ids_returned = [o["movie"]["tmdb_id"] for o in resp.json().values()]
     assert ids_returned == ids_sent
 
     ids_sent = [550, 6978, 115]
     resp = client.post("/tmdb_movie", json={"tmdb_ids": ids_sent})
     assert resp.status_code == 200, resp.json()
-    ids_returned = [m["tmdb_id"] for _, m in resp.json().items()]
+    ids_returned = [o["movie"]["tmdb_id"] for o in resp.json().values()]
     assert ids_returned == ids_sent
 
 
-def test_create_from_tmdb_empty(client: TestClient, mocked_TMDB_config_req):
+def test_create_mult_from_tmdb_statement_count(
+    client: TestClient,
+    mocked_TMDB_movie_results,
+    statements: list[str],
+):
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115]})
+    assert resp.status_code == 200, resp.json()
+    single_count = len(statements)
+
+    statements.clear()
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [550, 6978]})
+    assert resp.status_code == 200, resp.json()
+    assert len(statements) == single_count
+
+
+async def test_create_mult_from_tmdb_conflict(
+    client: TestClient,
+    mocked_TMDB_movie_results,
+    session: AsyncSession,
+):
+    """A movie with the same title and release date, but without a tmdb id"""
+    session.add(Movie(**DUDE_DATA | {"tmdb_id": None}))
+    await session.commit()
+
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115, 550]})
+    assert resp.status_code == 200, resp.json()
+    # the movie without the conflict is still created
+    assert resp.json()["115"]["status"] == "conflict"
+    assert resp.json()["115"]["movie"] is None
+    assert resp.json()["550"]["status"] == "created"
+
+
+async def test_create_movies_from_tmdb_errors(
+    client: TestClient, session: AsyncSession, dude_movie: Movie
+):
+    """Only movies that already exist are reported as conflicts"""
+    results = {
+        115: (
+            TMDBMovieResult(
+                id=115,
+                title=DUDE_DATA["title"],
+                release_date=DUDE_DATA["release_date"],
+                runtime=117,
+            ),
+            "R",
+            [],
+        ),
+        # fails the release_date check constraint
+        1: (
+            TMDBMovieResult(
+                id=1, title="Too old", release_date="1870-01-01", runtime=1
+            ),
+            None,
+            [],
+        ),
+        550: (
+            TMDBMovieResult(
+                id=550, title="Fight Club", release_date="1999-10-15", runtime=139
+            ),
+            "R",
+            ["Drama"],
+        ),
+    }
+
+    failed = await movies_module.create_movies_from_tmdb(results, session)
+
+    assert failed[115].status == TMDBMovieStatus.conflict
+    assert failed[1].status == TMDBMovieStatus.error
+    assert "Database error" in failed[1].detail
+    assert 550 not in failed
+    titles = {movie.title for movie in await session.scalars(select(Movie))}
+    assert titles == {DUDE_DATA["title"], "Fight Club"}
+
+
+def test_create_from_tmdb_empty(client: TestClient):
     resp = client.post("/tmdb_movie", json={"tmdb_ids": []})
     assert resp.status_code == 200, resp.json()
     assert resp.json() == {}
 
 
-def test_create_from_tmdb_not_found(
-    client: TestClient, mocked_TMDB_movie_results, mocked_TMDB_config_req
-):
+def test_create_from_tmdb_not_found(client: TestClient, mocked_TMDB_movie_results):
     resp = client.post("/tmdb_movie", json={"tmdb_ids": [0]})
-    assert resp.status_code == 404, resp.json()
+    assert resp.status_code == 200, resp.json()
+    assert resp.json() == {
+        "0": {"status": "not_found", "movie": None, "detail": "Movie not found on TMDB"}
+    }
+
+
+def test_create_from_tmdb_partial(client: TestClient, mocked_TMDB_movie_results):
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115]})
+    assert resp.status_code == 200, resp.json()
+
+    mocked_TMDB_movie_results.get(f"{config.TMDB_API_URL}/movie/6978").mock(
+        return_value=httpx.Response(500)
+    )
+    mocked_TMDB_movie_results.get(f"{config.TMDB_API_URL}/movie/550").mock(
+        return_value=httpx.Response(200, json={"id": 550})
+    )
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115, 0, 6978, 550]})
+    assert resp.status_code == 200, resp.json()
+    statuses = {tmdb_id: o["status"] for tmdb_id, o in resp.json().items()}
+    assert statuses == {
+        "115": "existing",
+        "0": "not_found",
+        "6978": "upstream_error",
+        "550": "upstream_error",
+    }
+    assert resp.json()["115"]["movie"]["title"] == DUDE_DATA["title"]
+
+
+def test_create_from_tmdb_retry_failed(client: TestClient, mocked_TMDB_movie_results):
+    """The movies that succeeded are committed, only the failures need to be resent"""
+    # tmdb fails every attempt of the first request for 550
+    fight_club = json.load(open(pathlib.Path(__file__).parent / "test_data/550.json"))
+    mocked_TMDB_movie_results.get(f"{config.TMDB_API_URL}/movie/550").mock(
+        side_effect=[httpx.Response(500)] * 3 + [httpx.Response(200, json=fight_club)]
+    )
+
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115, 550]})
+    assert resp.json()["115"]["status"] == "created"
+    assert resp.json()["550"]["status"] == "upstream_error"
+
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [550]})
+    assert resp.json()["550"]["status"] == "created"
+    resp = client.get("/movies/")
+    assert len(resp.json()["movies"]) == 2
+
+
+def list_all_movies(client: TestClient, params: dict) -> list[dict]:
+    """Follow next_cursor through all the pages of /movies/"""
+    movies = []
+    page_params = params
+    while True:
+        resp = client.get("/movies/", params=page_params)
+        assert resp.status_code == 200, resp.json()
+        movies.extend(resp.json()["movies"])
+        cursor = resp.json()["next_cursor"]
+        if cursor is None:
+            return movies
+        page_params = params | {"cursor": cursor}
+
+
+async def test_list_movies(client: TestClient, movies: list[Movie]):
+    resp = client.get("/movies/")
+    assert resp.status_code == 200, resp.json()
+    data = resp.json()
+    assert data["next_cursor"] is None
+    assert [m["id"] for m in data["movies"]] == [
+        m.id for m in sorted(movies, key=lambda m: (m.release_date, m.id))
+    ]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 5])
+async def test_list_movies_pages(client: TestClient, movies: list[Movie], limit):
+    resp = client.get("/movies/", params={"limit": limit})
+    assert len(resp.json()["movies"]) == limit
+
+    listed = list_all_movies(client, {"limit": limit})
+    assert [m["id"] for m in listed] == [
+        m.id for m in sorted(movies, key=lambda m: (m.release_date, m.id))
+    ]
+
+
+async def test_list_movies_sort_title_desc(client: TestClient, movies: list[Movie]):
+    listed = list_all_movies(client, {"limit": 2, "sort": "title", "desc": True})
+    assert [m["id"] for m in listed] == [
+        m.id for m in sorted(movies, key=lambda m: (m.title, m.id), reverse=True)
+    ]
+
+
+@pytest.mark.parametrize(
+    "params,titles",
+    [
+        ({"genre": "Comedy"}, ["Charlie", "Alpha", "Delta"]),
+        ({"rating": "R"}, ["Charlie", "Bravo", "Delta"]),
+        ({"min_runtime": 100, "max_runtime": 120}, ["Charlie", "Bravo"]),
+        ({"year": 2001}, ["Alpha", "Bravo", "Delta"]),
+        ({"year": 2001, "genre": "Drama"}, ["Bravo"]),
+        ({"genre": "Horror"}, []),
+    ],
+)
+async def test_list_movies_filters(
+    client: TestClient, movies: list[Movie], params, titles
+):
+    listed = list_all_movies(client, params | {"limit": 1})
+    assert [m["title"] for m in listed] == titles
+
+
+async def test_list_movies_invalid(client: TestClient, movies: list[Movie]):
+    resp = client.get("/movies/", params={"limit": 1000})
+    assert resp.status_code == 422
+
+    for year in [0, 9999]:
+        resp = client.get("/movies/", params={"year": year})
+        assert resp.status_code == 422
+
+    resp = client.get("/movies/", params={"cursor": "not a cursor"})
+    assert resp.status_code == 400
+
+    # cursor from a different sort
+    cursor = client.get("/movies/", params={"limit": 1}).json()["next_cursor"]
+    resp = client.get("/movies/", params={"cursor": cursor, "sort": "title"})
+    assert resp.status_code == 400
+
+
+async def add_movies(session: AsyncSession, count: int, genres: list[Genre]):
+    start = date(2000, 1, 1)
+    session.add_all(
+        [
+            Movie(title=f"Movie {i}", release_date=start + timedelta(i), genres=genres)
+            for i in range(count)
+        ]
+    )
+    await session.commit()
+
+
+@pytest.mark.parametrize("count", [10, 100])
+async def test_list_movies_query_count(
+    client: TestClient, session: AsyncSession, statements: list[str], count: int
+):
+    """Movies and their genres are loaded with the same number of queries, no matter
+    how many movies (or genres) there are"""
+    genres = [Genre(name=f"Genre {i}") for i in range(5)]
+    await add_movies(session, count, genres)
+
+    statements.clear()
+    resp = client.get("/movies/", params={"limit": count})
+    assert resp.status_code == 200, resp.json()
+    assert len(resp.json()["movies"]) == count
+    assert all(len(m["genres"]) == len(genres) for m in resp.json()["movies"])
+
+    # one query for the catalog version, one for the movies and one for all of their
+    # genres
+    assert len(statements) == 3
+
+
+async def test_list_movies_not_modified(
+    client: TestClient, movies: list[Movie], statements: list[str]
+):
+    resp = client.get("/movies/")
+    assert resp.status_code == 200
+    etag = resp.headers["etag"]
+
+    statements.clear()
+    resp = client.get("/movies/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    # only the catalog version is queried
+    assert len(statements) == 1
+
+    # each page and filter has its own etag
+    resp = client.get("/movies/", params={"genre": "Comedy"})
+    assert resp.headers["etag"] != etag
+
+    # any change to the catalog changes the etag
+    resp = client.patch(f"/movie/{movies[0].id}", json={"genres": ["Horror"]})
+    assert resp.status_code == 200, resp.json()
+    resp = client.get("/movies/", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["etag"] != etag
+    etag = resp.headers["etag"]
+
+    resp = client.delete(f"/movie/{movies[0].id}")
+    assert resp.status_code == 200
+    resp = client.get("/movies/", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+
+
+def draw_movies(client: TestClient, **params) -> list[dict]:
+    resp = client.get("/movies/random", params=params)
+    assert resp.status_code == 200, resp.json()
+    return resp.json()
+
+
+async def test_draw_movies(client: TestClient, movies: list[Movie]):
+    drawn = draw_movies(client)
+    assert len(drawn) == 1
+    assert drawn[0]["id"] in {m.id for m in movies}
+
+    # picks are distinct, and there are only as many as there are movies
+    drawn = draw_movies(client, n=len(movies) + 1)
+    assert sorted(m["id"] for m in drawn) == sorted(m.id for m in movies)
+
+
+async def test_draw_movies_filters(client: TestClient, movies: list[Movie]):
+    drawn = draw_movies(client, n=20, genre="Comedy")
+    assert {m["title"] for m in drawn} == {"Alpha", "Charlie", "Delta"}
+
+    drawn = draw_movies(client, n=20, rating="R", max_runtime=100)
+    assert {m["title"] for m in drawn} == {"Charlie", "Delta"}
+
+    exclude = [m.id for m in movies[1:]]
+    drawn = draw_movies(client, n=20, exclude=exclude)
+    assert [m["id"] for m in drawn] == [movies[0].id]
+
+    assert draw_movies(client, genre="Horror") == []
+
+
+def test_draw_movies_empty(client: TestClient):
+    assert draw_movies(client, n=3) == []
+
+
+def test_draw_movies_invalid(client: TestClient):
+    resp = client.get("/movies/random", params={"n": 0})
+    assert resp.status_code == 422
+    resp = client.get("/movies/random", params={"n": 1000})
+    assert resp.status_code == 422
+    for year in [0, 9999]:
+        resp = client.get("/movies/random", params={"year": year})
+        assert resp.status_code == 422
+
+
+async def test_draw_movies_uniform(client: TestClient, movies: list[Movie]):
+    """Every movie is drawn, with ids that are evenly spread"""
+    drawn = {draw_movies(client)[0]["id"] for _ in range(100)}
+    assert drawn == {m.id for m in movies}
+
+
+async def test_draw_movies_statements(
+    client: TestClient, session: AsyncSession, statements: list[str]
+):
+    """Movies are found with index seeks rather than sorting the table randomly"""
+    await add_movies(session, 100, [])
+
+    statements.clear()
+    assert len(draw_movies(client, n=3)) == 3
+    assert not any("random" in statement.lower() for statement in statements)
+    # the id range, at most two seeks per pick, and loading the movies and genres
+    assert len(statements) <= 1 + 2 * 3 + 2
+
+
+async def test_export_movies(client: TestClient, movies: list[Movie]):
+    resp = client.get("/movies/export")
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/x-ndjson"
+
+    exported = [MovieRead.parse_raw(line) for line in resp.text.splitlines()]
+    assert [m.id for m in exported] == sorted(m.id for m in movies)
+    charlie = next(m for m in exported if m.title == "Charlie")
+    assert [g.name for g in charlie.genres] == ["Comedy", "Drama"]
+
+
+async def test_export_movies_batches(
+    client: TestClient, session: AsyncSession, monkeypatch
+):
+    monkeypatch.setattr(movies_module, "EXPORT_BATCH_SIZE", 3)
+    await add_movies(session, 10, [Genre(name="Comedy")])
+
+    resp = client.get("/movies/export")
+    assert resp.status_code == 200
+    exported = [MovieRead.parse_raw(line) for line in resp.text.splitlines()]
+    assert [m.title for m in exported] == [f"Movie {i}" for i in range(10)]
+    assert all([g.name for g in m.genres] == ["Comedy"] for m in exported)
+
+
+async def test_export_movies_csv(client: TestClient, movies: list[Movie]):
+    resp = client.get("/movies/export", params={"format": "csv"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/csv")
+
+    rows = list(csv.DictReader(io.StringIO(resp.text)))
+    assert [int(row["id"]) for row in rows] == sorted(m.id for m in movies)
+    charlie = next(row for row in rows if row["title"] == "Charlie")
+    assert charlie["genres"] == "Comedy|Drama"
+    assert charlie["release_date"] == "1999-01-01"
+
+
+def test_export_movies_empty(client: TestClient):
+    resp = client.get("/movies/export")
+    assert resp.status_code == 200
+    assert resp.text == ""
+
+    resp = client.get("/movies/export", params={"format": "csv"})
+    assert resp.status_code == 200
+    assert resp.text.startswith("title,")
+    assert len(resp.text.splitlines()) == 1
+
+
+def test_import_movies(client: TestClient):
+    lines = [
+        json.dumps(DUDE_DATA | {"genres": DUDE_GENRES_DATA}),
+        json.dumps({"title": "No release date"}),
+        "not json",
+        "",
+        json.dumps({"title": "Other", "release_date": DIFF_DATE, "genres": ["Crime"]}),
+        # duplicate of the first line
+        json.dumps(DUDE_DATA),
+    ]
+    resp = client.post(
+        "/movies/import", params={"batch_size": 2}, content="\n".join(lines)
+    )
+    assert resp.status_code == 200, resp.json()
+    summary = ImportSummary(**resp.json())
+    assert summary.inserted == 2
+    assert summary.duplicates == 1
+    assert summary.skipped == 2
+    assert [e.line for e in summary.errors] == [2, 3]
+
+    listed = client.get("/movies/", params={"sort": "title"}).json()["movies"]
+    assert [m["title"] for m in listed] == ["Other", DUDE_DATA["title"]]
+    assert [g["name"] for g in listed[0]["genres"]] == ["Crime"]
+    assert [g["name"] for g in listed[1]["genres"]] == DUDE_GENRES_DATA
+
+
+async def test_import_exported_movies(
+    client: TestClient, session: AsyncSession, movies: list[Movie]
+):
+    """Movies exported (as ndjson or csv) import into an empty catalog"""
+    exported = {
+        format: client.get("/movies/export", params={"format": format}).content
+        for format in ["ndjson", "csv"]
+    }
+
+    for format, content in exported.items():
+        for movie in await session.scalars(select(Movie)):
+            await session.delete(movie)
+        await session.commit()
+
+        resp = client.post("/movies/import", params={"format": format}, content=content)
+        assert resp.status_code == 200, resp.json()
+        assert resp.json()["inserted"] == len(movies), resp.json()
+
+        resp = client.get("/movies/export")
+        reimported = [MovieRead.parse_raw(line) for line in resp.text.splitlines()]
+        assert sorted((m.title, m.release_date, m.runtime) for m in reimported) == (
+            sorted((m.title, m.release_date, m.runtime) for m in movies)
+        )
+        charlie = next(m for m in reimported if m.title == "Charlie")
+        assert [g.name for g in charlie.genres] == ["Comedy", "Drama"]
+
+        # importing again only finds duplicates
+        resp = client.post("/movies/import", params={"format": format}, content=content)
+        assert resp.json()["duplicates"] == len(movies), resp.json()
+
+
+def test_import_movies_invalid_utf8(client: TestClient):
+    """A line that isn't utf-8 is skipped"""
+    content = b"\n".join(
+        [
+            json.dumps(
+                {"title": "Caf\xe9", "release_date": "2000-01-01"}, ensure_ascii=False
+            ).encode(),
+            json.dumps(
+                {"title": "Caf\xe9", "release_date": DIFF_DATE}, ensure_ascii=False
+            ).encode("latin-1"),
+        ]
+    )
+
+    resp = client.post("/movies/import", content=content)
+    assert resp.status_code == 200, resp.json()
+    summary = ImportSummary(**resp.json())
+    assert summary.inserted == 1
+    assert summary.skipped == 1
+    assert [e.line for e in summary.errors] == [2]
+
+
+def test_import_movies_chunked(client: TestClient):
+    """Lines split across chunks of the request body"""
+    content = "\n".join(
+        json.dumps({"title": f"Movie {i}", "release_date": "2000-01-01"})
+        for i in range(10)
+    ).encode()
+    chunks = (content[i : i + 7] for i in range(0, len(content), 7))
+
+    resp = client.post("/movies/import", params={"batch_size": 3}, content=chunks)
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["inserted"] == 10
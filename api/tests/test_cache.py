@@ -0,0 +1,76 @@
+import pytest
+
+from app import cache
+from app.cache import TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the cache"""
+
+    def monotonic():
+        return monotonic.now
+
+    monotonic.now = 0.0
+    monkeypatch.setattr(cache.time, "monotonic", monotonic)
+    return monotonic
+
+
+async def test_get_set(clock):
+    ttl_cache = TTLCache(maxsize=2, ttl=10)
+    assert await ttl_cache.get("key") is None
+
+    await ttl_cache.set("key", ["value"])
+    assert await ttl_cache.get("key") == ["value"]
+    assert ttl_cache.stats() == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+async def test_ttl_expiry(clock):
+    ttl_cache = TTLCache(maxsize=2, ttl=10)
+    await ttl_cache.set("key", "value")
+
+    clock.now = 9.9
+    assert await ttl_cache.get("key") == "value"
+
+    clock.now = 10
+    assert await ttl_cache.get("key") is None
+    assert ttl_cache.misses == 1
+
+    # expired entries are kept, to be served stale
+    assert len(ttl_cache) == 1
+    assert await ttl_cache.get("key", stale=True) == "value"
+    assert ttl_cache.stats() == {"hits": 2, "misses": 1, "evictions": 0}
+
+    # lookups that aren't counted
+    assert await ttl_cache.get("key", stale=True, count=False) == "value"
+    assert await ttl_cache.get("other", count=False) is None
+    assert ttl_cache.stats() == {"hits": 2, "misses": 1, "evictions": 0}
+
+
+async def test_lru_eviction(clock):
+    ttl_cache = TTLCache(maxsize=2, ttl=10)
+    await ttl_cache.set("a", 1)
+    await ttl_cache.set("b", 2)
+
+    # "a" becomes the most recently used, so "b" is evicted
+    assert await ttl_cache.get("a") == 1
+    await ttl_cache.set("c", 3)
+
+    assert await ttl_cache.get("b") is None
+    assert await ttl_cache.get("a") == 1
+    assert await ttl_cache.get("c") == 3
+    assert ttl_cache.evictions == 1
+    assert len(ttl_cache) == 2
+
+
+async def test_disabled(clock):
+    ttl_cache = TTLCache(maxsize=0)
+    await ttl_cache.set("key", "value")
+    assert await ttl_cache.get("key") is None
+
+
+async def test_clear(clock):
+    ttl_cache = TTLCache()
+    await ttl_cache.set("key", "value")
+    await ttl_cache.clear()
+    assert await ttl_cache.get("key") is None
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import pathlib
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.future import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import config, jobs, tmdb
+from app.config import JobSettings, Settings
+from app.retry import CircuitBreaker
+from app.tables import ImportJob, ImportJobStatus, Movie
+
+
+def wait_for_job(client: TestClient, job_id: int, timeout: float = 5) -> dict:
+    """Poll the job until it's finished"""
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        resp = client.get(f"/jobs/{job_id}")
+        assert resp.status_code == 200, resp.json()
+        if resp.json()["status"] in ("done", "failed"):
+            return resp.json()
+        time.sleep(0.01)
+    raise TimeoutError(f"job {job_id} didn't finish")
+
+
+def test_import_job(client: TestClient, mocked_TMDB_movie_results):
+    resp = client.post("/jobs/tmdb_movie/", json={"tmdb_ids": [115, 550, 0, 6978]})
+    assert resp.status_code == 202, resp.json()
+    assert resp.json()["total"] == 4
+    assert resp.json()["status"] == "pending"
+
+    job = wait_for_job(client, resp.json()["id"])
+    assert job["status"] == "done"
+    assert job["processed"] == 4
+    assert job["progress"] == 1
+    assert job["created"] == 3
+    assert job["failed"] == 1
+    assert job["errors"] == [
+        {"tmdb_id": 0, "status": "not_found", "detail": "Movie not found on TMDB"}
+    ]
+    assert job["throughput"] > 0
+
+    resp = client.get("/movies/")
+    assert len(resp.json()["movies"]) == 3
+
+
+def test_import_job_existing(client: TestClient, mocked_TMDB_movie_results):
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115]})
+    assert resp.status_code == 200, resp.json()
+
+    resp = client.post("/jobs/tmdb_movie/", json={"tmdb_ids": [115, 550]})
+    job = wait_for_job(client, resp.json()["id"])
+    assert job["existing"] == 1
+    assert job["created"] == 1
+
+
+def test_import_job_empty(client: TestClient):
+    resp = client.post("/jobs/tmdb_movie/", json={"tmdb_ids": []})
+    assert resp.status_code == 422
+
+
+def test_import_job_not_found(client: TestClient):
+    resp = client.get("/jobs/1")
+    assert resp.status_code == 404
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 10])
+async def test_run_job_resumes(
+    client: TestClient,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+    batch_size: int,
+):
+    """A job interrupted after its first tmdb_id continues from the second"""
+    job = ImportJob(
+        tmdb_ids=[115, 550, 6978],
+        status=ImportJobStatus.running,
+        processed=1,
+        created=1,
+    )
+    session.add(job)
+    await session.commit()
+
+    await jobs.run_job(
+        job.id, settings, tmdb_client, JobSettings(import_job_batch_size=batch_size)
+    )
+
+    await session.refresh(job)
+    assert job.status == ImportJobStatus.done
+    assert job.processed == 3
+    assert job.created == 3
+    # 115 isn't requested again
+    requested = [call.request.url.path for call in mocked_TMDB_movie_results.calls]
+    assert sorted(requested) == ["/3/movie/550", "/3/movie/6978"]
+    movies = await session.scalars(select(Movie))
+    assert {m.tmdb_id for m in movies} == {550, 6978}
+
+
+async def test_run_job_progress(
+    client: TestClient,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    respx_mock,
+):
+    """Progress is saved after each batch, even if the job fails later"""
+    respx_mock.get(f"{config.TMDB_API_URL}/movie/0").mock(
+        return_value=httpx.Response(404)
+    )
+    respx_mock.get(f"{config.TMDB_API_URL}/movie/1").mock(
+        side_effect=RuntimeError("boom")
+    )
+    job = ImportJob(tmdb_ids=[0, 1])
+    session.add(job)
+    await session.commit()
+
+    with pytest.raises(RuntimeError):
+        await jobs.run_job(
+            job.id, settings, tmdb_client, JobSettings(import_job_batch_size=1)
+        )
+
+    await session.refresh(job)
+    assert job.status == ImportJobStatus.running
+    assert job.processed == 1
+    assert job.errors == {
+        "0": {"status": "not_found", "detail": "Movie not found on TMDB"}
+    }
+
+
+async def test_claim_job(client: TestClient, session: AsyncSession, monkeypatch):
+    """A job is claimed by one process, until its lease expires"""
+    job = ImportJob(tmdb_ids=[115])
+    session.add(job)
+    await session.commit()
+
+    assert await jobs.claim_job(session, job.id, lease=60)
+    monkeypatch.setattr(jobs, "OWNER", "other:1")
+    assert not await jobs.claim_job(session, job.id, lease=60)
+
+    # the process holding the job stopped renewing its lease
+    job.lease_expires_at = datetime.utcnow() - timedelta(seconds=1)
+    await session.commit()
+    assert await jobs.claim_job(session, job.id, lease=60)
+    await session.refresh(job)
+    assert job.owner == "other:1"
+    assert job.status == ImportJobStatus.running
+
+
+async def test_run_job_claimed(
+    client: TestClient,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+):
+    """A job running in another process isn't run again"""
+    job = ImportJob(
+        tmdb_ids=[115, 550],
+        status=ImportJobStatus.running,
+        owner="other:1",
+        lease_expires_at=datetime.utcnow() + timedelta(seconds=60),
+    )
+    session.add(job)
+    await session.commit()
+
+    await jobs.run_job(job.id, settings, tmdb_client, JobSettings())
+
+    await session.refresh(job)
+    assert job.owner == "other:1"
+    assert job.processed == 0
+    assert not mocked_TMDB_movie_results.calls
+    assert not await jobs.renew_lease(job.id, lease=60)
+
+
+async def test_run_job_waits_for_tmdb(
+    client: TestClient,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+    monkeypatch,
+):
+    """TMDB goes down during a batch, the job waits for it rather than failing"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.2)
+    monkeypatch.setattr(tmdb, "circuit_breaker", breaker)
+    fight_club = json.loads(
+        (pathlib.Path(__file__).parent / "test_data" / "550.json").read_text()
+    )
+    route = mocked_TMDB_movie_results.get(f"{config.TMDB_API_URL}/movie/550")
+    route.side_effect = [httpx.Response(503), httpx.Response(200, json=fight_club)]
+    job = ImportJob(tmdb_ids=[115, 550, 6978])
+    session.add(job)
+    await session.commit()
+
+    start = time.monotonic()
+    await jobs.run_job(job.id, settings, tmdb_client, JobSettings())
+
+    await session.refresh(job)
+    assert job.status == ImportJobStatus.done
+    assert job.errors == {}
+    assert job.created + job.existing == 3
+    assert time.monotonic() - start >= 0.2
+    assert breaker.state == "closed"
+
+
+async def test_worker_survives(client: TestClient, monkeypatch):
+    """A job that fails, and can't be marked failed, doesn't stop the worker"""
+    ran = []
+
+    async def run_job(job_id, *args):
+        ran.append(job_id)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(jobs, "run_job", run_job)
+    monkeypatch.setattr(jobs, "queue", asyncio.Queue())
+    task = asyncio.create_task(jobs.worker(JobSettings()))
+    try:
+        # jobs that don't exist
+        for job_id in [1000, 1001]:
+            jobs.queue.put_nowait(job_id)
+        await asyncio.wait_for(jobs.queue.join(), 5)
+    finally:
+        task.cancel()
+
+    assert ran == [1000, 1001]
@@ -0,0 +1,115 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from loguru import logger
+
+from app import log
+from app.config import LogSettings
+
+
+@pytest.fixture
+def records():
+    """Records logged with our handler for the settings, written to a list"""
+    written = []
+
+    class Sink:
+        def write(self, message):
+            written.append(message)
+
+        def flush(self):
+            pass
+
+    handler_ids = []
+
+    def add(**settings):
+        config = log.handler(LogSettings(**settings), sink=Sink())
+        handler_ids.append(logger.add(**config))
+        return written
+
+    yield add
+
+    for handler_id in handler_ids:
+        logger.remove(handler_id)
+
+
+def test_redact_url():
+    url = "https://api.themoviedb.org/3/search/movie?api_key=SECRET&query=big"
+
+    assert log.redact_url(url) == (
+        "https://api.themoviedb.org/3/search/movie?api_key=xxxxxx&query=big"
+    )
+    assert log.redact_url("https://api.themoviedb.org/3/configuration") == (
+        "https://api.themoviedb.org/3/configuration"
+    )
+
+
+async def test_json(records):
+    written = records(log_json=True, log_enqueue=True)
+
+    with logger.contextualize(request_id="abc"):
+        logger.info("Created movie: {}", "The Big Lebowski")
+    await logger.complete()
+
+    (line,) = written
+    record = json.loads(line)["record"]
+    assert record["message"] == "Created movie: The Big Lebowski"
+    assert record["extra"]["request_id"] == "abc"
+    assert record["level"]["name"] == "INFO"
+
+
+def test_sampling(records):
+    written = records(log_enqueue=False, log_info_sample_rate=0)
+
+    logger.info("dropped")
+    logger.warning("kept")
+
+    (line,) = written
+    assert "kept" in line
+
+
+def test_exception_variables(records):
+    """Exceptions are logged without the values of the variables in the traceback"""
+    written = records(log_enqueue=False)
+
+    def fetch(api_key: str):
+        raise RuntimeError("boom")
+
+    # not in the source, which is shown in the traceback
+    secret = "".join(["SEC", "RET"])
+    try:
+        fetch(api_key=secret)
+    except RuntimeError:
+        logger.exception("Import job {} failed", 1)
+
+    output = "".join(written)
+    assert "RuntimeError: boom" in output
+    assert "SECRET" not in output
+
+
+def test_lazy_arguments(records):
+    written = records(log_enqueue=False, log_level="INFO")
+    calls = []
+
+    # no handler logs DEBUG
+    logger.opt(lazy=True).debug("Created movie: {}", lambda: calls.append(1))
+
+    assert written == []
+    assert calls == []
+
+
+@pytest.mark.parametrize(
+    "header, same", [("proxy-id.123", True), ("bad id\nINJECTED", False)]
+)
+def test_request_id(client: TestClient, records, header: str, same: bool):
+    written = records(log_enqueue=False)
+
+    # logs the invalid cursor
+    resp = client.get(
+        "/movies/", params={"cursor": "invalid"}, headers={"X-Request-ID": header}
+    )
+
+    assert resp.status_code == 400
+    request_id = resp.headers["x-request-id"]
+    assert (request_id == header) == same
+    assert any(f"| {request_id} |" in line for line in written)
@@ -0,0 +1,98 @@
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import metrics
+from app.tables import Movie
+
+
+@pytest.fixture
+async def movie(session: AsyncSession):
+    movie = Movie(title="The Big Lebowski", release_date=date(1998, 3, 6))
+    session.add(movie)
+    await session.commit()
+    await session.refresh(movie)
+    return movie
+
+
+def test_render(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", [])
+    requests = metrics.Counter("requests_total", "Requests", ("route",))
+    latency = metrics.Histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+
+    requests.inc("read_movie")
+    requests.inc("read_movie")
+    requests.inc('say "hi"')
+    latency.observe(0.1)
+    latency.observe(0.5)
+    latency.observe(3)
+
+    assert metrics.render() == "\n".join(
+        [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="read_movie"} 2.0',
+            'requests_total{route="say \\"hi\\""} 1.0',
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 1.0',
+            'latency_seconds_bucket{le="1.0"} 2.0',
+            'latency_seconds_bucket{le="+Inf"} 3.0',
+            "latency_seconds_sum 3.6",
+            "latency_seconds_count 3.0",
+            "",
+        ]
+    )
+
+
+def test_request_metrics(client: TestClient, movie: Movie):
+    labels = ("read_movie", "GET", "200")
+    before = metrics.http_requests.values.get(labels, 0)
+    queries_before = metrics.http_request_db_queries.observations.get(
+        ("read_movie",), [0]
+    )[-1]
+
+    resp = client.get(f"/movie/{movie.id}")
+    assert resp.status_code == 200, resp.json()
+
+    assert metrics.http_requests.values[labels] == before + 1
+    # the sum of the queries counted for the route increased
+    assert metrics.http_request_db_queries.observations[("read_movie",)][-1] > (
+        queries_before
+    )
+
+    # ids aren't part of the route name
+    resp = client.get("/movie/123456")
+    assert resp.status_code == 404
+    assert metrics.http_requests.values[("read_movie", "GET", "404")] >= 1
+
+
+def test_read_metrics(client: TestClient, mocked_TMDB):
+    resp = client.get("/search_movies/", params={"query": "big"})
+    assert resp.status_code == 200, resp.json()
+    resp = client.get("/search_movies/", params={"query": "big"})
+    assert resp.status_code == 200, resp.json()
+
+    resp = client.get("/metrics")
+
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    lines = resp.text.splitlines()
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert any(
+        line.startswith(
+            'http_requests_total{route="search_movies",method="GET",status="200"}'
+        )
+        for line in lines
+    )
+    assert any(
+        line.startswith('tmdb_requests_total{endpoint="/3/search/movie",status="200"}')
+        for line in lines
+    )
+    # the second search was served from the cache, each test gets a new one
+    assert 'cache_hits_total{cache="tmdb_search"} 1.0' in lines
+    assert 'cache_misses_total{cache="tmdb_search"} 1.0' in lines
+    assert 'tmdb_circuit_state{state="closed"} 1.0' in lines
+    assert any(line.startswith("tmdb_rate_limit_tokens ") for line in lines)
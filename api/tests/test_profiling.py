@@ -0,0 +1,121 @@
+import re
+from datetime import date
+
+import pytest
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import profiling
+from app.api import app
+from app.config import ApiSettings
+from app.db import get_session
+from app.tables import Movie
+
+
+def profiled_client(session: AsyncSession, engine: AsyncEngine, monkeypatch, **kwargs):
+    """A test client for the app with profiling set up as by the settings"""
+    # time_endpoints replaces the calls, restore them after the test
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            monkeypatch.setattr(route.dependant, "call", route.dependant.call)
+    profiling.time_endpoints(app.routes)
+    profiling.instrument_engine(engine)
+
+    app.dependency_overrides[get_session] = lambda: session
+    settings = ApiSettings(**kwargs)
+    return TestClient(profiling.ProfilingMiddleware(app, settings=settings))
+
+
+@pytest.fixture
+def client(session: AsyncSession, engine: AsyncEngine, monkeypatch):
+    with profiled_client(
+        session, engine, monkeypatch, api_profiling="header"
+    ) as client:
+        yield client
+
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture
+async def movie(session: AsyncSession):
+    movie = Movie(title="The Big Lebowski", release_date=date(1998, 3, 6))
+    session.add(movie)
+    await session.commit()
+    await session.refresh(movie)
+    return movie
+
+
+def timings(server_timing: str) -> dict[str, tuple[float, str | None]]:
+    """{name: (duration, description)} of a Server-Timing header"""
+    result = {}
+    for metric in server_timing.split(", "):
+        match = re.fullmatch(r'(\w+);dur=([\d.]+)(?:;desc="(.*)")?', metric)
+        assert match, metric
+        result[match[1]] = (float(match[2]), match[3])
+    return result
+
+
+def test_not_profiled(client: TestClient, movie: Movie):
+    resp = client.get(f"/movie/{movie.id}")
+
+    assert resp.status_code == 200, resp.json()
+    assert "server-timing" not in resp.headers
+
+
+def test_server_timing(client: TestClient, movie: Movie):
+    resp = client.get(f"/movie/{movie.id}", headers={"X-Profile": "1"})
+
+    assert resp.status_code == 200, resp.json()
+    result = timings(resp.headers["server-timing"])
+    assert list(result) == ["db", "tmdb", "serialize", "app", "total"]
+    assert result["db"][1] == "queries: 1"
+    assert result["db"][0] > 0
+    assert result["tmdb"] == (0, "requests: 0")
+    assert result["serialize"][0] > 0
+    assert result["total"][0] >= result["db"][0] + result["serialize"][0]
+
+
+def test_server_timing_tmdb(client: TestClient, mocked_TMDB):
+    resp = client.get(
+        "/search_movies/", params={"query": "big"}, headers={"X-Profile": "1"}
+    )
+
+    assert resp.status_code == 200, resp.json()
+    result = timings(resp.headers["server-timing"])
+    assert result["tmdb"][1] == "requests: 1"
+    assert result["tmdb"][0] > 0
+
+
+def test_sql_and_cprofile(client: TestClient, movie: Movie, caplog):
+    resp = client.get(f"/movie/{movie.id}", headers={"X-Profile": "sql, cprofile"})
+
+    assert resp.status_code == 200, resp.json()
+    assert f"SQL of GET /movie/{movie.id} (1 statements):" in caplog.text
+    assert "FROM movie" in caplog.text
+    assert f"cProfile of GET /movie/{movie.id}:" in caplog.text
+    assert "cumulative" in caplog.text
+    assert not profiling.cprofile_running
+
+
+@pytest.mark.parametrize("sample_rate, profiled", [(1, True), (0, False)])
+async def test_always(
+    session: AsyncSession,
+    engine: AsyncEngine,
+    monkeypatch,
+    sample_rate: float,
+    profiled: bool,
+):
+    with profiled_client(
+        session,
+        engine,
+        monkeypatch,
+        api_profiling="always",
+        api_profiling_sample_rate=sample_rate,
+    ) as client:
+        resp = client.get("/movies/")
+    app.dependency_overrides.clear()
+
+    assert resp.status_code == 200, resp.json()
+    assert ("server-timing" in resp.headers) == profiled
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from app import rate_limit
+from app.rate_limit import RateLimiter, parse_retry_after
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the rate limiter"""
+
+    def monotonic():
+        return monotonic.now
+
+    monotonic.now = 0.0
+    monkeypatch.setattr(rate_limit.time, "monotonic", monotonic)
+    return monotonic
+
+
+def test_burst_then_rate(clock):
+    limiter = RateLimiter(rate=10, burst=3)
+
+    # the burst goes through without waiting
+    assert [limiter.reserve() for _ in range(3)] == [0, 0, 0]
+    # then requests wait for their turn, in order
+    assert limiter.reserve() == pytest.approx(0.1)
+    assert limiter.reserve() == pytest.approx(0.2)
+
+    # tokens refill with time, up to the burst
+    clock.now = 10
+    assert limiter.stats()["tokens"] == 3
+
+
+def test_too_many_requests(clock):
+    limiter = RateLimiter(rate=10, burst=3, min_rate=4)
+
+    limiter.on_response(429, "2")
+    assert limiter.rate == 5
+    assert limiter.throttled == 1
+    # nothing is let through until the retry after has passed
+    assert limiter.reserve() == 2
+
+    # the rate doesn't go below the minimum
+    limiter.on_response(429)
+    assert limiter.rate == 4
+
+    # and recovers with successful responses
+    for _ in range(20):
+        limiter.on_response(200)
+    assert limiter.rate == 10
+
+
+async def test_acquire_waiting(clock, monkeypatch):
+    limiter = RateLimiter(rate=10, burst=1)
+    slept = []
+
+    async def sleep(seconds):
+        assert limiter.stats()["waiting"] == 1
+        slept.append(seconds)
+
+    monkeypatch.setattr(rate_limit.asyncio, "sleep", sleep)
+
+    await limiter.acquire()
+    await limiter.acquire()
+    assert slept == [pytest.approx(0.1)]
+    assert limiter.stats()["waiting"] == 0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("3") == 3
+    assert parse_retry_after("-3") == 0
+    assert parse_retry_after("soon") is None
+
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert parse_retry_after(format_datetime(retry_at, usegmt=True)) == pytest.approx(
+        30, abs=2
+    )
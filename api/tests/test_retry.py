@@ -0,0 +1,83 @@
+import pytest
+
+from app import retry
+from app.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the circuit breaker"""
+
+    def monotonic():
+        return monotonic.now
+
+    monotonic.now = 0.0
+    monkeypatch.setattr(retry.time, "monotonic", monotonic)
+    return monotonic
+
+
+def test_circuit_opens(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    breaker.before_request()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    assert breaker.stats() == {"state": "open", "failures": 2, "rejected": 1}
+
+
+def test_circuit_success_resets(clock):
+    breaker = CircuitBreaker(failure_threshold=2)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+
+def test_circuit_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+
+    # after the reset timeout, a single trial request is let through
+    clock.now = 30
+    assert breaker.state == "half_open"
+    breaker.before_request()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+
+    # which opens the circuit again when it fails
+    breaker.record_failure()
+    clock.now = 59
+    assert breaker.state == "open"
+
+    # or closes it when it succeeds
+    clock.now = 60
+    breaker.before_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_request()
+
+
+def test_backoff_delay(monkeypatch):
+    policy = RetryPolicy(backoff=0.5, backoff_max=3)
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+
+    assert [policy.backoff_delay(attempt) for attempt in range(5)] == [
+        0.5,
+        1,
+        2,
+        3,
+        3,
+    ]
+
+
+def test_backoff_delay_jitter():
+    policy = RetryPolicy(backoff=1, backoff_max=10)
+    delays = {policy.backoff_delay(2) for _ in range(20)}
+    assert all(0 <= delay <= 4 for delay in delays)
+    assert len(delays) > 1
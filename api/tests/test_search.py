@@ -0,0 +1,87 @@
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.search import query_words
+from app.tables import Movie
+
+
+def search_titles(client: TestClient, q: str, **params) -> list[str]:
+    resp = client.get("/movies/search", params={"q": q, **params})
+    assert resp.status_code == 200, resp.json()
+    return [movie["title"] for movie in resp.json()]
+
+
+@pytest.fixture
+async def search_movies(session: AsyncSession):
+    movies = [
+        Movie(title="The Big Lebowski", release_date=date(1998, 3, 6)),
+        Movie(
+            title="Fight Club",
+            release_date=date(1999, 10, 15),
+            overview="An insomniac office worker and a soap maker form a fight club",
+        ),
+        Movie(
+            title="Barton Fink",
+            release_date=date(1991, 8, 21),
+            overview="A playwright goes to Hollywood, from the makers of Lebowski",
+        ),
+    ]
+    session.add_all(movies)
+    await session.commit()
+    yield movies
+
+
+def test_search_local_movies(client: TestClient, search_movies: list[Movie]):
+    assert search_titles(client, "fight") == ["Fight Club"]
+    # each word matches the start of a word
+    assert search_titles(client, "big leb") == ["The Big Lebowski"]
+    assert search_titles(client, "BIG LEBOWSKI") == ["The Big Lebowski"]
+    # the overview is searched as well
+    assert search_titles(client, "insomniac") == ["Fight Club"]
+    assert search_titles(client, "nothing") == []
+
+
+def test_search_local_movies_rank(client: TestClient, search_movies: list[Movie]):
+    # matches in the title before matches in the overview
+    assert search_titles(client, "lebowski") == ["The Big Lebowski", "Barton Fink"]
+    assert search_titles(client, "lebowski", limit=1) == ["The Big Lebowski"]
+
+
+def test_search_local_movies_syntax(client: TestClient, search_movies: list[Movie]):
+    """Search syntax in the query is ignored"""
+    assert search_titles(client, '"fight" AND club') == ["Fight Club"]
+    assert search_titles(client, "fight*:") == ["Fight Club"]
+    assert search_titles(client, '" * :') == []
+
+    resp = client.get("/movies/search", params={"q": ""})
+    assert resp.status_code == 422
+
+
+def test_search_local_movies_updates(client: TestClient, search_movies: list[Movie]):
+    """The search index is kept in sync with the movies"""
+    dude, fight_club, _ = search_movies
+
+    resp = client.patch(f"/movie/{dude.id}", json={"movie": {"title": "The Dude"}})
+    assert resp.status_code == 200, resp.json()
+    assert search_titles(client, "dude") == ["The Dude"]
+    assert search_titles(client, "big") == []
+
+    resp = client.delete(f"/movie/{fight_club.id}")
+    assert resp.status_code == 200, resp.json()
+    assert search_titles(client, "fight") == []
+
+
+def test_search_local_movies_from_tmdb(client: TestClient, mocked_TMDB_movie_results):
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [115, 550, 6978]})
+    assert resp.status_code == 200, resp.json()
+
+    # the overview from tmdb is stored and searched
+    assert search_titles(client, "nihilists") == ["The Big Lebowski"]
+
+
+def test_query_words():
+    assert query_words("The Big-Lebowski!") == ["the", "big", "lebowski"]
+    assert query_words(" * ") == []
@@ -0,0 +1,80 @@
+import json
+from datetime import date
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.config import get_api_settings
+from app.serializers import movie_dict
+from app.tables import Genre, Movie, MovieRead
+
+
+@pytest.fixture
+async def movies(session: AsyncSession):
+    comedy, drama = Genre(name="Comedy"), Genre(name="Drama")
+    movies = [
+        Movie(
+            title="The Big Lebowski",
+            release_date=date(1998, 3, 6),
+            runtime=117,
+            tmdb_id=115,
+            rating="R",
+            overview="The Dude abides",
+            genres=[comedy, drama],
+        ),
+        Movie(title="Alpha", release_date=date(2001, 5, 1)),
+    ]
+    session.add_all(movies)
+    await session.commit()
+    for movie in movies:
+        await session.refresh(movie)
+    yield movies
+
+
+@pytest.fixture
+def api_orjson(monkeypatch):
+    monkeypatch.setattr(get_api_settings(), "api_orjson", True)
+
+
+async def test_movie_dict(client: TestClient, movies: list[Movie]):
+    """The same as validating the movie through the response model"""
+    for movie in movies:
+        expected = jsonable_encoder(MovieRead.from_orm(movie))
+        assert json.loads(ORJSONResponse(movie_dict(movie)).body) == expected
+
+
+@pytest.mark.parametrize(
+    "url, params",
+    [
+        ("/movies/", {}),
+        ("/movies/", {"genre": "Comedy"}),
+        ("/movies/search", {"q": "dude"}),
+        ("/movies/random", {"n": 1, "exclude": 2}),
+    ],
+)
+async def test_orjson_responses(
+    client: TestClient, movies: list[Movie], monkeypatch, url: str, params: dict
+):
+    resp = client.get(url, params=params)
+    assert resp.status_code == 200, resp.json()
+
+    monkeypatch.setattr(get_api_settings(), "api_orjson", True)
+    resp_orjson = client.get(url, params=params)
+    assert resp_orjson.status_code == 200, resp_orjson.json()
+    assert resp_orjson.json() == resp.json()
+    assert resp_orjson.headers.get("etag") == resp.headers.get("etag")
+
+
+async def test_orjson_read_movie(client: TestClient, movies: list[Movie], api_orjson):
+    resp = client.get(f"/movie/{movies[0].id}")
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()["title"] == "The Big Lebowski"
+    assert [g["name"] for g in resp.json()["genres"]] == ["Comedy", "Drama"]
+
+    resp = client.get(
+        f"/movie/{movies[0].id}", headers={"If-None-Match": resp.headers["etag"]}
+    )
+    assert resp.status_code == 304
@@ -1,3 +1,5 @@
+import asyncio
+import time
 from collections import namedtuple
 
 import httpx
@@ -6,8 +8,11 @@ import respx
 from fastapi import HTTPException
 from loguru import logger
 
-from app.config import Settings
-from app.tmdb import formatter, get_movie_data, resp_error_handling
+from app import tmdb
+from app.config import ClientSettings, Settings
+from app.rate_limit import RateLimiter
+from app.retry import CircuitBreaker
+from app.tmdb import SingleFlight, create_client, get_movie_data, resp_error_handling
 
 MockRoutes = namedtuple("TestRoute", ["url", "method", "status_code"])
 
@@ -55,9 +60,11 @@ def test_error_handling_tmdb(test_route, mock_urls, caplog):
     assert str(status_code) in caplog.text
 
 
-async def test_get_movie_data(settings: Settings, mocked_TMDB_movie_results):
+async def test_get_movie_data(
+    settings: Settings, tmdb_client: httpx.AsyncClient, mocked_TMDB_movie_results
+):
     movie_data, rating, genres = await get_movie_data(
-        115, settings.tmdb_api_url, settings.tmdb_api_key
+        115, settings.tmdb_api_url, settings.tmdb_api_key, tmdb_client
     )
     assert movie_data.title == "The Big Lebowski"
     assert rating == "R"
@@ -65,14 +72,240 @@ async def test_get_movie_data(settings: Settings, mocked_TMDB_movie_results):
 
 
 async def test_get_movie_data_not_found(
-    settings: Settings, mocked_TMDB_movie_results, caplog
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+    caplog,
 ):
     with pytest.raises(HTTPException):
-        await get_movie_data(0, settings.tmdb_api_url, settings.tmdb_api_key)
+        await get_movie_data(
+            0, settings.tmdb_api_url, settings.tmdb_api_key, tmdb_client
+        )
 
     assert "404" in caplog.text
 
 
+async def test_get_movie_data_coalesced(
+    settings: Settings, tmdb_client: httpx.AsyncClient, mocked_TMDB_movie_results
+):
+    coalesced = tmdb.single_flight.coalesced
+    results = await asyncio.gather(
+        *[
+            get_movie_data(
+                115, settings.tmdb_api_url, settings.tmdb_api_key, tmdb_client
+            )
+            for _ in range(3)
+        ]
+    )
+
+    assert all(result == results[0] for result in results)
+    assert mocked_TMDB_movie_results.calls.call_count == 1
+    assert tmdb.single_flight.coalesced == coalesced + 2
+
+
+async def test_single_flight():
+    single_flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def fetch(value):
+        await release.wait()
+        return value
+
+    tasks = [
+        asyncio.create_task(single_flight.do("a", lambda: fetch(1))),
+        asyncio.create_task(single_flight.do("a", lambda: fetch(2))),
+        asyncio.create_task(single_flight.do("b", lambda: fetch(3))),
+    ]
+    await asyncio.sleep(0)
+    release.set()
+
+    assert await asyncio.gather(*tasks) == [1, 1, 3]
+    assert single_flight.stats() == {"calls": 2, "coalesced": 1}
+
+    # once complete, a new call for the key is made
+    assert await single_flight.do("a", lambda: fetch(4)) == 4
+
+
+async def test_single_flight_exception():
+    single_flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise HTTPException(404)
+
+    results = await asyncio.gather(
+        single_flight.do("a", fail),
+        single_flight.do("a", fail),
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, HTTPException) for r in results)
+    assert single_flight.stats() == {"calls": 1, "coalesced": 1}
+
+
+async def test_tmdb_get_too_many_requests(
+    settings: Settings, tmdb_client: httpx.AsyncClient, monkeypatch
+):
+    limiter = RateLimiter(rate=10, burst=10)
+    monkeypatch.setattr(tmdb, "rate_limiter", limiter)
+
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.side_effect = [
+            httpx.Response(429, headers={"Retry-After": "0"}),
+            httpx.Response(200, json={"results": []}),
+        ]
+        resp = await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+
+    assert resp.status_code == 200
+    assert route.call_count == 2
+    assert limiter.throttled == 1
+    assert limiter.rate < 10
+
+
+async def test_tmdb_get_server_error(
+    settings: Settings, tmdb_client: httpx.AsyncClient
+):
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.side_effect = [
+            httpx.Response(503),
+            httpx.ConnectError("connection refused"),
+            httpx.Response(200, json={"results": []}),
+        ]
+        resp = await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+
+    assert resp.status_code == 200
+    assert route.call_count == 3
+    assert tmdb.retry_policy.retries == 2
+    assert tmdb.circuit_breaker.state == "closed"
+
+
+async def test_tmdb_get_retries_exhausted(
+    settings: Settings, tmdb_client: httpx.AsyncClient
+):
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.side_effect = httpx.ConnectError("connection refused")
+        with pytest.raises(HTTPException) as exc_info:
+            await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+
+    assert exc_info.value.status_code == 504
+    assert route.call_count == tmdb.retry_policy.attempts
+
+
+async def test_tmdb_get_deadline(
+    settings: Settings, tmdb_client: httpx.AsyncClient, monkeypatch
+):
+    """A slow attempt is cancelled at the deadline, not after the client timeout"""
+    monkeypatch.setattr(tmdb.retry_policy, "deadline", 0.1)
+
+    requests = []
+
+    async def slow_response(request):
+        requests.append(request)
+        await asyncio.sleep(5)
+        return httpx.Response(200)
+
+    with respx.mock(assert_all_called=False) as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.side_effect = slow_response
+        start = time.monotonic()
+        with pytest.raises(HTTPException) as exc_info:
+            await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+
+    assert exc_info.value.status_code == 504
+    assert time.monotonic() - start < 1
+    assert len(requests) == 1
+
+
+async def test_tmdb_get_rate_limited_deadline(
+    settings: Settings, tmdb_client: httpx.AsyncClient, monkeypatch
+):
+    """Requests which wait out the deadline for the rate limiter aren't made, and
+    don't open the circuit"""
+    monkeypatch.setattr(tmdb, "rate_limiter", RateLimiter(rate=2, burst=1))
+    monkeypatch.setattr(tmdb, "circuit_breaker", CircuitBreaker(failure_threshold=2))
+    monkeypatch.setattr(tmdb.retry_policy, "deadline", 1)
+
+    async def get():
+        try:
+            return await tmdb.tmdb_get(
+                tmdb_client, f"{settings.tmdb_api_url}/search/movie"
+            )
+        except HTTPException as exc:
+            return exc
+
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.return_value = httpx.Response(200, json={"results": []})
+        results = await asyncio.gather(*[get() for _ in range(8)])
+
+    ok = [r for r in results if isinstance(r, httpx.Response)]
+    assert 0 < len(ok) < 8
+    assert all(r.status_code == 504 for r in results if isinstance(r, HTTPException))
+    assert route.call_count == len(ok)
+    assert tmdb.circuit_breaker.state == "closed"
+
+
+async def test_tmdb_get_not_retried(settings: Settings, tmdb_client: httpx.AsyncClient):
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/movie/1")
+        route.return_value = httpx.Response(404)
+        resp = await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/movie/1")
+
+    assert resp.status_code == 404
+    assert route.call_count == 1
+
+
+async def test_tmdb_get_circuit_open(
+    settings: Settings, tmdb_client: httpx.AsyncClient, monkeypatch
+):
+    monkeypatch.setattr(tmdb, "circuit_breaker", CircuitBreaker(failure_threshold=2))
+
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/search/movie")
+        route.return_value = httpx.Response(500)
+        # the circuit opens after the second attempt, so there isn't a third
+        with pytest.raises(HTTPException) as exc_info:
+            await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+        assert exc_info.value.status_code == 503
+        assert route.call_count == 2
+
+        # nor are further requests made
+        with pytest.raises(HTTPException) as exc_info:
+            await tmdb.tmdb_get(tmdb_client, f"{settings.tmdb_api_url}/search/movie")
+        assert exc_info.value.status_code == 503
+        assert route.call_count == 2
+
+
+async def test_create_client():
+    client_settings = ClientSettings(
+        tmdb_max_connections=4, tmdb_max_keepalive_connections=2, tmdb_timeout=3
+    )
+    async with create_client(client_settings) as client:
+        assert client.timeout.read == 3
+        assert client.timeout.connect == client_settings.tmdb_connect_timeout
+        pool = client._transport._pool
+        assert pool._max_connections == 4
+        assert pool._max_keepalive_connections == 2
+
+
+async def test_shared_client_lifetime():
+    with pytest.raises(RuntimeError):
+        tmdb.get_client()
+
+    await tmdb.open_client(ClientSettings())
+    client = tmdb.get_client()
+    # opening again keeps the same client
+    await tmdb.open_client(ClientSettings())
+    assert tmdb.get_client() is client
+
+    await tmdb.close_client()
+    assert client.is_closed
+    with pytest.raises(RuntimeError):
+        tmdb.get_client()
+
+
 @pytest.fixture
 def writer():
     def w(message):
@@ -86,17 +319,54 @@ def writer():
 
 
 async def test_api_key_obfuscated(writer, settings):
-    """Set up a logging handler and test our handler
-
-    caplog fixture doesn't use our custom formatter
-    """
+    """The api key is removed from the TMDB requests that are logged"""
+    handler_id = logger.add(writer, format="{message}")
 
-    logger.add(writer, format=formatter)
-
-    message = "Error from TMDB. Request: <Request('GET', 'https://api.themoviedb.org/3/movie/0?api_key=TESTING&append_to_response=release_dates')>, Response: <Response [404 Not Found]>"
-    logger.log(10, message)
+    request = httpx.Request(
+        "GET",
+        "https://api.themoviedb.org/3/movie/0",
+        params={
+            "api_key": settings.tmdb_api_key,
+            "append_to_response": "release_dates",
+        },
+    )
+    with pytest.raises(HTTPException):
+        resp_error_handling(httpx.Response(404, request=request))
+    logger.remove(handler_id)
 
     result = writer.read().rstrip("\n")
 
     assert f"api_key={settings.tmdb_api_key}" not in result
-    assert "api_key=xxxxxx" in result
+    assert "api_key=xxxxxx&append_to_response=release_dates" in result
+
+
+@pytest.mark.parametrize("circuit_open", [False, True])
+async def test_api_key_obfuscated_without_response(
+    writer,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    monkeypatch,
+    circuit_open,
+):
+    """The api key isn't logged when TMDB can't be reached, or isn't requested"""
+    breaker = CircuitBreaker(failure_threshold=1)
+    if circuit_open:
+        breaker.record_failure()
+    monkeypatch.setattr(tmdb, "circuit_breaker", breaker)
+    monkeypatch.setattr(tmdb.retry_policy, "attempts", 1)
+    handler_id = logger.add(writer, format="{message}")
+
+    with respx.mock(assert_all_called=False) as respx_mock:
+        route = respx_mock.get(f"{settings.tmdb_api_url}/movie/0")
+        route.side_effect = httpx.ConnectError("connection refused")
+        with pytest.raises(HTTPException):
+            await get_movie_data(
+                0, settings.tmdb_api_url, settings.tmdb_api_key, tmdb_client
+            )
+    logger.remove(handler_id)
+
+    result = writer.read()
+
+    expected = "circuit is open" if circuit_open else "Error requesting TMDB"
+    assert expected in result
+    assert settings.tmdb_api_key not in result
@@ -0,0 +1,197 @@
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+import respx
+from fastapi.testclient import TestClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import config, db, tmdb_cache
+from app.config import Settings
+from app.tables import TMDBCache
+
+DUDE_TMDB_ID = 115
+
+
+def test_create_from_tmdb_cached(client: TestClient, mocked_TMDB_movie_results):
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [DUDE_TMDB_ID]})
+    assert resp.status_code == 200, resp.json()
+    movie_id = resp.json()[str(DUDE_TMDB_ID)]["movie"]["id"]
+
+    resp = client.delete(f"/movie/{movie_id}")
+    assert resp.status_code == 200
+
+    # adding the movie again is served from the tmdb_cache table
+    resp = client.post("/tmdb_movie", json={"tmdb_ids": [DUDE_TMDB_ID]})
+    assert resp.status_code == 200, resp.json()
+    assert resp.json()[str(DUDE_TMDB_ID)]["movie"]["title"] == "The Big Lebowski"
+    assert mocked_TMDB_movie_results.calls.call_count == 1
+
+
+async def test_get_payloads(
+    session: AsyncSession,
+    client: TestClient,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+):
+    payloads, errors, to_refresh = await tmdb_cache.get_payloads(
+        session, {115, 550}, settings, tmdb_client
+    )
+    assert payloads[115]["title"] == "The Big Lebowski"
+    assert payloads[550]["title"] == "Fight Club"
+    assert errors == {}
+    assert to_refresh == set()
+
+    entry = await session.get(TMDBCache, 115)
+    assert entry.payload == payloads[115]
+
+    payloads, _, _ = await tmdb_cache.get_payloads(
+        session, {115, 550}, settings, tmdb_client
+    )
+    assert mocked_TMDB_movie_results.calls.call_count == 2
+
+
+async def test_get_payloads_errors(
+    session: AsyncSession,
+    client: TestClient,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+):
+    payloads, errors, _ = await tmdb_cache.get_payloads(
+        session, {115, 0}, settings, tmdb_client
+    )
+    # the movie that was found is still returned and stored
+    assert list(payloads) == [115]
+    assert errors[0].status_code == 404
+    assert await session.get(TMDBCache, 115) is not None
+
+
+async def test_get_payloads_concurrent(
+    session: AsyncSession,
+    client: TestClient,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+    monkeypatch,
+):
+    """Another request stores the same entry after this one found it missing"""
+    get_entries = tmdb_cache.get_entries
+
+    async def get_entries_then_other_request(session, tmdb_ids):
+        entries = await get_entries(session, tmdb_ids)
+        async with db.async_session_factory() as other_session:
+            other_session.add(TMDBCache(tmdb_id=DUDE_TMDB_ID, payload={"title": "Old"}))
+            await other_session.commit()
+        return entries
+
+    monkeypatch.setattr(tmdb_cache, "get_entries", get_entries_then_other_request)
+
+    payloads, errors, _ = await tmdb_cache.get_payloads(
+        session, {DUDE_TMDB_ID}, settings, tmdb_client
+    )
+    assert errors == {}
+    assert payloads[DUDE_TMDB_ID]["title"] == "The Big Lebowski"
+
+    entry = await session.get(TMDBCache, DUDE_TMDB_ID, populate_existing=True)
+    assert entry.payload["title"] == "The Big Lebowski"
+
+
+@pytest.fixture
+async def stale_entry(client: TestClient, session: AsyncSession, settings: Settings):
+    """An entry older than the max age, with an etag"""
+    fetched_at = datetime.utcnow() - timedelta(seconds=settings.tmdb_cache_max_age + 1)
+    entry = TMDBCache(
+        tmdb_id=DUDE_TMDB_ID,
+        payload={"title": "The Big Lebowski"},
+        fetched_at=fetched_at,
+        etag='"abc"',
+    )
+    session.add(entry)
+    await session.commit()
+    yield entry
+
+
+async def test_get_payloads_stale_not_modified(
+    stale_entry: TMDBCache,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+):
+    with respx.mock() as respx_mock:
+        route = respx_mock.get(
+            f"{config.TMDB_API_URL}/movie/{DUDE_TMDB_ID}",
+            headers={"If-None-Match": '"abc"'},
+        ).mock(return_value=httpx.Response(304))
+
+        payloads, _, _ = await tmdb_cache.get_payloads(
+            session, {DUDE_TMDB_ID}, settings, tmdb_client
+        )
+
+    assert route.call_count == 1
+    assert payloads[DUDE_TMDB_ID] == {"title": "The Big Lebowski"}
+    entry = await session.get(TMDBCache, DUDE_TMDB_ID)
+    assert datetime.utcnow() - entry.fetched_at < timedelta(minutes=1)
+
+
+async def test_get_payloads_stale_modified(
+    stale_entry: TMDBCache,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+):
+    with respx.mock() as respx_mock:
+        respx_mock.get(f"{config.TMDB_API_URL}/movie/{DUDE_TMDB_ID}").mock(
+            return_value=httpx.Response(
+                200, json={"title": "The Dude"}, headers={"ETag": '"def"'}
+            )
+        )
+
+        payloads, _, _ = await tmdb_cache.get_payloads(
+            session, {DUDE_TMDB_ID}, settings, tmdb_client
+        )
+
+    assert payloads[DUDE_TMDB_ID] == {"title": "The Dude"}
+    entry = await session.get(TMDBCache, DUDE_TMDB_ID)
+    assert entry.etag == '"def"'
+
+
+async def test_get_payloads_stale_tmdb_down(
+    stale_entry: TMDBCache,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+):
+    with respx.mock() as respx_mock:
+        respx_mock.get(f"{config.TMDB_API_URL}/movie/{DUDE_TMDB_ID}").mock(
+            return_value=httpx.Response(503)
+        )
+
+        payloads, _, _ = await tmdb_cache.get_payloads(
+            session, {DUDE_TMDB_ID}, settings, tmdb_client
+        )
+
+    # the stale entry is used, and still counts as stale
+    assert payloads[DUDE_TMDB_ID] == {"title": "The Big Lebowski"}
+    entry = await session.get(TMDBCache, DUDE_TMDB_ID)
+    assert entry.fetched_at == stale_entry.fetched_at
+
+
+async def test_refresh_entries(
+    client: TestClient,
+    session: AsyncSession,
+    settings: Settings,
+    tmdb_client: httpx.AsyncClient,
+    mocked_TMDB_movie_results,
+):
+    fetched_at = datetime.utcnow() - timedelta(days=1)
+    session.add(TMDBCache(tmdb_id=550, payload={}, fetched_at=fetched_at))
+    await session.commit()
+
+    await tmdb_cache.refresh_entries({550}, settings, tmdb_client)
+
+    entry = await session.get(TMDBCache, 550)
+    await session.refresh(entry)
+    assert entry.payload["title"] == "Fight Club"
+    assert entry.fetched_at > fetched_at
@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from httpx import AsyncClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import db, tables, tmdb_config
+from app.config import Settings
+from tests.conftest import MOCKED_TMDB_CONFIG_DATA
+
+NEW_CONFIG_DATA = {"images": {"secure_base_url": "https://images.example.com/t/p/"}}
+
+
+@pytest.fixture
+async def stored_configuration(session: AsyncSession, request):
+    """A stored configuration, fetched the number of days ago given by the test's param"""
+    await db.create_db_and_tables()
+    entry = tables.TMDBConfig(
+        payload=MOCKED_TMDB_CONFIG_DATA,
+        fetched_at=datetime.utcnow() - timedelta(days=request.param),
+    )
+    session.add(entry)
+    await session.commit()
+    return entry
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """Replaces the request to TMDB, returning NEW_CONFIG_DATA or raising if it's
+    set to an exception. The calls are counted"""
+    calls = {"count": 0, "raises": None, "done": asyncio.Event()}
+
+    async def fetch_configuration(settings, client):
+        calls["count"] += 1
+        calls["done"].set()
+        if calls["raises"] is not None:
+            raise calls["raises"]
+        return NEW_CONFIG_DATA
+
+    monkeypatch.setattr(tmdb_config, "fetch_configuration", fetch_configuration)
+    monkeypatch.setattr(tmdb_config, "configuration", None)
+    monkeypatch.setattr(tmdb_config, "fetched_at", None)
+    return calls
+
+
+async def test_fetch_configuration(
+    settings: Settings, tmdb_client: AsyncClient, mocked_TMDB_config_req
+):
+    payload = await tmdb_config.fetch_configuration(settings, tmdb_client)
+
+    assert payload["images"]["secure_base_url"] == "https://image.tmdb.org/t/p/"
+    assert mocked_TMDB_config_req.calls.call_count == 1
+
+
+@pytest.mark.parametrize("stored_configuration", [0], indirect=True)
+async def test_start_fresh_configuration_not_requested(
+    settings: Settings, tmdb_client: AsyncClient, stored_configuration, fetches
+):
+    await tmdb_config.start(settings, tmdb_client)
+    await asyncio.sleep(0.01)
+    await tmdb_config.stop()
+
+    assert tmdb_config.configuration == MOCKED_TMDB_CONFIG_DATA
+    assert fetches["count"] == 0
+
+
+@pytest.mark.parametrize("stored_configuration", [2], indirect=True)
+async def test_start_stale_configuration_refreshed(
+    settings: Settings,
+    tmdb_client: AsyncClient,
+    session: AsyncSession,
+    stored_configuration,
+    fetches,
+):
+    await tmdb_config.start(settings, tmdb_client)
+    # the stored configuration is available right away
+    assert tmdb_config.configuration == MOCKED_TMDB_CONFIG_DATA
+
+    # until the refresh is stored
+    for _ in range(100):
+        if tmdb_config.configuration == NEW_CONFIG_DATA:
+            break
+        await asyncio.sleep(0.01)
+    await tmdb_config.stop()
+
+    assert tmdb_config.configuration == NEW_CONFIG_DATA
+    await session.refresh(stored_configuration)
+    assert stored_configuration.payload == NEW_CONFIG_DATA
+    assert datetime.utcnow() - stored_configuration.fetched_at < timedelta(minutes=1)
+
+
+@pytest.mark.parametrize("stored_configuration", [2], indirect=True)
+async def test_start_offline_uses_stored_configuration(
+    settings: Settings, tmdb_client: AsyncClient, stored_configuration, fetches
+):
+    fetches["raises"] = HTTPException(503, "TMDB is unavailable")
+
+    await tmdb_config.start(settings, tmdb_client)
+    await asyncio.wait_for(fetches["done"].wait(), 1)
+    await tmdb_config.stop()
+
+    assert tmdb_config.configuration == MOCKED_TMDB_CONFIG_DATA
+    assert fetches["count"] == 1
+
+
+async def test_get_configuration_requested_once(
+    settings: Settings, tmdb_client: AsyncClient, fetches
+):
+    await db.create_db_and_tables()
+
+    results = await asyncio.gather(
+        tmdb_config.get_configuration(settings, tmdb_client),
+        tmdb_config.get_configuration(settings, tmdb_client),
+    )
+
+    assert results == [NEW_CONFIG_DATA, NEW_CONFIG_DATA]
+    assert fetches["count"] == 1
+    # later calls use the configuration we have
+    assert await tmdb_config.get_configuration(settings, tmdb_client) == NEW_CONFIG_DATA
+    assert fetches["count"] == 1
+
+
+async def test_read_tmdb_configuration(client: TestClient):
+    response = client.get("/tmdb/configuration")
+
+    assert response.status_code == 200
+    assert response.json() == MOCKED_TMDB_CONFIG_DATA